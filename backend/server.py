@@ -1,28 +1,112 @@
-from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi import FastAPI, APIRouter, HTTPException, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+import bson
+from bson import ObjectId
+from bson.errors import InvalidDocument
+from bson.raw_bson import RawBSONDocument
+from pymongo import ReplaceOne
+from pymongo.errors import AutoReconnect, BulkWriteError, DuplicateKeyError, OperationFailure
 import os
 import logging
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional, Any, Dict
+from typing import List, Optional, Any, Dict, Set, Tuple
 import uuid
-from datetime import datetime, timezone
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta, timezone
+from abc import ABC, abstractmethod
+import asyncio
+import atexit
+import copy
+import hashlib
+import importlib.util
+import ipaddress
+import json
+import queue
+import random
+import socket
+import time
+from contextlib import asynccontextmanager
+import httpcore
 import httpx
 import re
+from urllib.parse import quote, unquote
 
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
-
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# Configure logging
+# Log calls only put the record on a queue; a listener thread formats and
+# writes it, so log output never blocks the event loop. LOG_FORMAT=json
+# writes one JSON object per line, LOG_FORMAT=text the plain format.
+# Structured data goes in extra={'fields': {...}}.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')
+
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        for key, value in (getattr(record, 'fields', None) or {}).items():
+            entry.setdefault(key, value)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextLogFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            text = f"{text} {json.dumps(fields, ensure_ascii=False, default=str)}"
+        return text
+
+
+class DeferredFormatQueueHandler(QueueHandler):
+    """
+    QueueHandler that leaves formatting to the listener thread. The stdlib
+    prepare() formats the record (traceback included) on the caller's
+    thread and drops exc_info; this one only merges the message arguments.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def configure_logging() -> QueueListener:
+    handler = logging.StreamHandler()
+    if LOG_FORMAT == 'json':
+        handler.setFormatter(JsonLogFormatter())
+    else:
+        handler.setFormatter(TextLogFormatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredFormatQueueHandler(log_queue)
+    logging.basicConfig(level=LOG_LEVEL, handlers=[queue_handler])
+    listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    # Write out records still queued when the process exits
+    atexit.register(listener.stop)
+    return listener
+
+
+log_listener = configure_logging()
+logger = logging.getLogger(__name__)
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
 client = AsyncIOMotorClient(mongo_url)
@@ -53,6 +137,54 @@ class NowPlayingResponse(BaseModel):
     artwork: Optional[str] = None
     timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+class NowPlayingBatchRequest(BaseModel):
+    station_ids: List[str]
+
+class NowPlayingBatchItem(BaseModel):
+    station_id: str
+    success: bool
+    data: Optional[NowPlayingResponse] = None
+    error: Optional[str] = None
+
+class NowPlayingBatchResponse(BaseModel):
+    success: bool
+    count: int
+    results: List[NowPlayingBatchItem]
+
+class TrackHistoryEntry(BaseModel):
+    station_id: str
+    title: Optional[str] = None
+    artist: Optional[str] = None
+    song: Optional[str] = None
+    album: Optional[str] = None
+    source: Optional[str] = None
+    played_at: datetime
+
+class TrackHistoryResponse(BaseModel):
+    success: bool
+    count: int
+    items: List[TrackHistoryEntry]
+    next_cursor: Optional[str] = None
+
+class StreamResolveRequest(BaseModel):
+    station_id: Optional[str] = None
+    url: Optional[str] = None
+
+class StreamCandidate(BaseModel):
+    url: str
+    source: str
+    score: Optional[float] = None
+    ttfb_ms: Optional[int] = None
+    measured: bool = False
+
+class StreamResolveResponse(BaseModel):
+    success: bool
+    station_id: Optional[str] = None
+    url: str
+    playlist_type: str = Field(serialization_alias='playlistType')
+    candidates: List[str]
+    details: List[StreamCandidate]
+
 # CarPlay Log Models
 class CarPlayLogEntry(BaseModel):
     level: str = "info"  # info, warn, error, debug
@@ -89,37 +221,78 @@ async def get_status_checks():
     status_checks = await db.status_checks.find().to_list(1000)
     return [StatusCheck(**status_check) for status_check in status_checks]
 
+# ============== Fast JSON Responses ==============
+# Hot endpoints return a prebuilt Response so FastAPI skips re-validating
+# and re-encoding the body. The route decorators keep their response_model,
+# so the OpenAPI schema is unchanged. Plain dict payloads are encoded with
+# orjson (in requirements.txt); models are encoded by pydantic-core, which
+# produces the same bytes the regular response path would.
+
+try:
+    import orjson
+except ImportError:  # e.g. a dev environment without it: standard json module
+    orjson = None
+
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps_json(value: Any) -> bytes:
+    """
+    Encode a plain JSON-like value (dicts from Mongo included) to bytes.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(value, default=_json_default)
+        except orjson.JSONEncodeError:
+            # e.g. integers beyond 64 bits in client-supplied log context
+            pass
+    return json.dumps(value, default=_json_default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class FastJSONResponse(Response):
+    """
+    JSON response whose body is either already-encoded bytes or a plain
+    value encoded with `dumps_json`.
+    """
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, bytes):
+            return content
+        return dumps_json(content)
+
+
+class NowPlayingPayload:
+    """
+    A now-playing result with its ETag and encoded body, built once when a
+    cache is filled and reused by every request it answers.
+    """
+    __slots__ = ('now_playing', 'etag', 'body')
+
+    def __init__(self, now_playing: NowPlayingResponse):
+        self.now_playing = now_playing
+        self.etag = now_playing_etag(now_playing)
+        self.body = now_playing.model_dump_json().encode('utf-8')
+
+
 # ============== CarPlay Logging Endpoints ==============
 
 @api_router.post("/carplay/logs", response_model=CarPlayLogResponse)
 async def submit_carplay_logs(request: CarPlayLogRequest):
     """
     Receive CarPlay debug logs from the mobile app.
-    Stores logs in MongoDB and prints to server console for real-time debugging.
+    Buffers logs for a batched MongoDB write and echoes a sample
+    (CARPLAY_LOG_ECHO_SAMPLE) to the server log for real-time debugging.
+    Returns 503 with Retry-After while the buffer is full, 413 for an
+    upload over CARPLAY_LOG_MAX_UPLOAD_BYTES and 400 for one MongoDB
+    cannot store.
     """
     try:
-        # Log to console for real-time debugging
-        logger.info("=" * 60)
-        logger.info(f"📱 CARPLAY LOGS RECEIVED")
-        logger.info(f"Device: {request.device_model or 'Unknown'} | OS: {request.os_version or 'Unknown'}")
-        logger.info(f"App Version: {request.app_version or 'Unknown'} | Device ID: {request.device_id or 'Unknown'}")
-        logger.info("-" * 60)
-        
-        for log_entry in request.logs:
-            level_emoji = {
-                "error": "❌",
-                "warn": "⚠️",
-                "info": "ℹ️",
-                "debug": "🔍"
-            }.get(log_entry.level, "📝")
-            
-            logger.info(f"{level_emoji} [{log_entry.level.upper()}] {log_entry.message}")
-            if log_entry.context:
-                logger.info(f"   Context: {log_entry.context}")
-        
-        logger.info("=" * 60)
-        
-        # Store in MongoDB for historical analysis
+        # Buffered and stored in MongoDB in batches for historical analysis
         log_document = {
             "device_id": request.device_id,
             "device_model": request.device_model,
@@ -129,7 +302,22 @@ async def submit_carplay_logs(request: CarPlayLogRequest):
             "received_at": datetime.now(timezone.utc),
         }
         
-        await db.carplay_logs.insert_one(log_document)
+        if not carplay_log_writer.submit(log_document):
+            raise HTTPException(
+                status_code=503,
+                detail="CarPlay log buffer is full, retry later",
+                headers={"Retry-After": str(CARPLAY_LOG_RETRY_AFTER)},
+            )
+        
+        # Echo a sample of uploads to the console for real-time debugging
+        if CARPLAY_LOG_ECHO_SAMPLE > 0 and random.random() < CARPLAY_LOG_ECHO_SAMPLE:
+            logger.info("CarPlay logs received", extra={'fields': {
+                'device_id': request.device_id,
+                'device_model': request.device_model,
+                'os_version': request.os_version,
+                'app_version': request.app_version,
+                'logs': log_document["logs"],
+            }})
         
         return CarPlayLogResponse(
             success=True,
@@ -137,8 +325,10 @@ async def submit_carplay_logs(request: CarPlayLogRequest):
             message="Logs received successfully"
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error storing CarPlay logs: {e}")
+        logger.error("Error storing CarPlay logs: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.get("/carplay/logs")
@@ -149,6 +339,7 @@ async def get_carplay_logs(
 ):
     """
     Retrieve stored CarPlay logs for debugging.
+    Uploads appear once their batch is written (CARPLAY_LOG_FLUSH_INTERVAL).
     """
     try:
         query = {}
@@ -165,81 +356,182 @@ async def get_carplay_logs(
             for log_doc in logs:
                 log_doc["logs"] = [l for l in log_doc["logs"] if l.get("level") == level]
         
-        return {
+        return FastJSONResponse({
             "success": True,
             "count": len(logs),
             "logs": logs
-        }
+        })
         
     except Exception as e:
-        logger.error(f"Error fetching CarPlay logs: {e}")
+        logger.error("Error fetching CarPlay logs: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.delete("/carplay/logs")
 async def clear_carplay_logs():
     """
-    Clear all stored CarPlay logs.
+    Clear all stored CarPlay logs, including uploads not yet written.
     """
     try:
+        discarded = carplay_log_writer.clear()
         result = await db.carplay_logs.delete_many({})
         return {
             "success": True,
-            "deleted_count": result.deleted_count,
+            "deleted_count": result.deleted_count + discarded,
             "message": "All CarPlay logs cleared"
         }
     except Exception as e:
-        logger.error(f"Error clearing CarPlay logs: {e}")
+        logger.error("Error clearing CarPlay logs: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 # Now Playing API - Fetches ICY metadata from radio stream
 @api_router.get("/now-playing/{station_id}", response_model=NowPlayingResponse)
-async def get_now_playing(station_id: str):
+async def get_now_playing(
+    station_id: str,
+    request: Request,
+    since: Optional[str] = None,
+    wait: float = 0
+):
     """
     Get now playing information for a station.
-    1. Fetches station info from themegaradio API to get stream URL
-    2. Connects to stream with Icy-MetaData header to get real song title
-    3. Falls back to genre/tags if ICY metadata unavailable
+    Concurrent requests for the same station share one lookup.
+    Send the previous ETag in If-None-Match to get 304 while the song is unchanged.
+    Long-poll: with ?since=<etag>&wait=<seconds> the request is held until the
+    song changes (200) or the wait expires (304).
+    """
+    known_etag = since or request.headers.get('if-none-match')
+    payload = await serve_now_playing_payload(station_id)
+
+    if since and wait > 0 and etag_matches(since, payload.etag):
+        changed = await now_playing_broadcaster.wait_for_change(
+            station_id,
+            payload.etag,
+            min(wait, NOW_PLAYING_LONG_POLL_MAX_WAIT),
+        )
+        if changed is not None:
+            payload = NowPlayingPayload(changed)
+
+    headers = {
+        'ETag': payload.etag,
+        'Cache-Control': f"public, max-age={NOW_PLAYING_MAX_AGE}",
+    }
+    if etag_matches(known_etag, payload.etag):
+        return Response(status_code=304, headers=headers)
+
+    return FastJSONResponse(payload.body, headers=headers)
+
+
+async def serve_now_playing_payload(station_id: str) -> NowPlayingPayload:
+    """
+    Now playing for a client request: pre-warmed stations are answered
+    from memory with their pre-encoded body, everything else goes
+    through a lookup.
+    """
+    now_playing_warmer.record_request(station_id)
+    warm = now_playing_warmer.get(station_id)
+    if warm is not None:
+        return warm
+    return NowPlayingPayload(await lookup_now_playing(station_id))
+
+
+async def serve_now_playing(station_id: str) -> NowPlayingResponse:
+    return (await serve_now_playing_payload(station_id)).now_playing
+
+
+async def lookup_now_playing(station_id: str) -> NowPlayingResponse:
+    """
+    Coalesced now-playing lookup that also notifies push subscribers
+    when the title has changed.
+    """
+    now_playing = await now_playing_flights.run(station_id, load_now_playing, station_id)
+    now_playing_broadcaster.publish(station_id, now_playing)
+    now_playing_warmer.store(now_playing)
+    return now_playing
+
+
+async def load_now_playing(station_id: str) -> NowPlayingResponse:
+    """
+    Resolve now playing on the worker elected for this station; other
+    workers get its published result from the shared cache.
+    """
+    async def resolve_fallback(key: str) -> NowPlayingResponse:
+        return await resolve_now_playing(key, metadata=False)
+
+    return await shared_cache.elected_load(
+        'now_playing',
+        station_id,
+        resolve_now_playing,
+        NOW_PLAYING_SHARED_STALE_TTL,
+        fallback=resolve_fallback,
+        encode=lambda now_playing: now_playing.model_dump(mode='json'),
+        decode=NowPlayingResponse.model_validate,
+    )
+
+
+async def resolve_now_playing(station_id: str, metadata: bool = True) -> NowPlayingResponse:
+    """
+    Resolve now playing information for a station.
+    1. Fetches station info (cached) from themegaradio API to get stream URL
+    2. Resolves playlist URLs (cached) to the real audio stream
+    3. Reads the song title from the station's long-lived ICY monitor
+       (or from ID3/#EXTINF timed metadata for HLS stations)
+    4. Adds album/artwork from the track enrichment cache
+    5. Falls back to genre/tags if no metadata is available
+    With `metadata` False only steps 1 and 5 run, so no stream is touched.
     """
     station_name = "Unknown Station"
     fallback_title = "Live Radio"
     stream_url = None
 
     try:
-        async with httpx.AsyncClient(timeout=5.0) as http_client:
-            # Step 1: Get station data from themegaradio API
-            try:
-                response = await http_client.get(
-                    f"https://themegaradio.com/api/station/{station_id}"
-                )
-                if response.status_code == 200:
-                    station_data = response.json()
-                    station_name = station_data.get('name', 'Unknown Station')
-                    stream_url = station_data.get('url_resolved') or station_data.get('url')
-                    genres = station_data.get('genres', [])
-                    tags = station_data.get('tags', '')
-                    country = station_data.get('country', '')
-
-                    if genres:
-                        fallback_title = genres[0]
-                    elif tags:
-                        fallback_title = tags.split(',')[0].strip()
-                    elif country:
-                        fallback_title = country
-            except Exception as e:
-                logger.error(f"Error fetching station data: {e}")
+        # Step 1: Get station data (cached) from themegaradio API
+        try:
+            station_data = await station_cache.get(station_id)
+            if station_data:
+                station_name = station_data.get('name', 'Unknown Station')
+                # Skip candidates the health prober has seen failing
+                stream_url = stream_health.pick(station_stream_candidates(station_data))
+                genres = station_data.get('genres', [])
+                tags = station_data.get('tags', '')
+                country = station_data.get('country', '')
 
-        # Step 2: Try to fetch ICY metadata from the stream
-        if stream_url:
-            icy_result = await fetch_icy_stream_title(stream_url)
+                if genres:
+                    fallback_title = genres[0]
+                elif tags:
+                    fallback_title = tags.split(',')[0].strip()
+                elif country:
+                    fallback_title = country
+        except Exception as e:
+            logger.error("Error fetching station data: %s", e)
+
+        # Step 2: Follow .pls/.m3u playlists to the real audio stream
+        playlist_type = None
+        if stream_url and metadata:
+            resolved = await playlist_resolver.resolve(station_id, stream_url)
+            stream_url = resolved['url']
+            playlist_type = resolved['playlist_type']
+
+        # Step 3: Read ICY metadata from the shared per-station monitor,
+        # or timed metadata from the newest segment for HLS stations
+        if stream_url and metadata:
+            if playlist_type == 'hls':
+                icy_result = await hls_metadata.get_title(stream_url)
+                if icy_result:
+                    track_history.record(station_id, icy_result, 'hls')
+            else:
+                icy_result = await icy_monitors.get_title(station_id, stream_url)
             if icy_result:
+                # Step 4: Album and cover art from the shared track cache
+                enrichment = await artwork_enricher.enrich(icy_result.get('artist'), icy_result.get('song')) or {}
                 return NowPlayingResponse(
                     station_id=station_id,
                     title=icy_result.get('title', fallback_title),
                     artist=icy_result.get('artist', station_name),
                     song=icy_result.get('song'),
+                    album=icy_result.get('album') or enrichment.get('album'),
+                    artwork=enrichment.get('artwork'),
                 )
 
-        # Step 3: Fallback to genre/station info
+        # Step 5: Fallback to genre/station info
         return NowPlayingResponse(
             station_id=station_id,
             title=fallback_title,
@@ -247,92 +539,4396 @@ async def get_now_playing(station_id: str):
         )
 
     except Exception as e:
-        logger.error(f"Error in get_now_playing: {e}")
+        logger.error("Error in get_now_playing: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+NOW_PLAYING_MAX_AGE = int(os.environ.get('NOW_PLAYING_MAX_AGE', '10'))
+NOW_PLAYING_LONG_POLL_MAX_WAIT = float(os.environ.get('NOW_PLAYING_LONG_POLL_MAX_WAIT', '60'))
+NOW_PLAYING_BATCH_MAX_STATIONS = int(os.environ.get('NOW_PLAYING_BATCH_MAX_STATIONS', '100'))
+NOW_PLAYING_BATCH_CONCURRENCY = int(os.environ.get('NOW_PLAYING_BATCH_CONCURRENCY', '16'))
+NOW_PLAYING_BATCH_DEADLINE = float(os.environ.get('NOW_PLAYING_BATCH_DEADLINE', '4'))
+
+@api_router.post("/now-playing/batch", response_model=NowPlayingBatchResponse)
+async def get_now_playing_batch(request: NowPlayingBatchRequest):
+    """
+    Get now playing information for a list of stations in one call.
+    Stations are resolved concurrently; any station still pending when the
+    deadline passes is reported as a per-item failure.
+    """
+    station_ids = list(dict.fromkeys(request.station_ids))
+    if len(station_ids) > NOW_PLAYING_BATCH_MAX_STATIONS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {NOW_PLAYING_BATCH_MAX_STATIONS} stations per batch",
+        )
+
+    semaphore = asyncio.Semaphore(NOW_PLAYING_BATCH_CONCURRENCY)
+
+    async def resolve_one(station_id: str) -> NowPlayingResponse:
+        async with semaphore:
+            return await serve_now_playing(station_id)
+
+    tasks = {station_id: asyncio.create_task(resolve_one(station_id)) for station_id in station_ids}
+    pending = set()
+    if tasks:
+        _, pending = await asyncio.wait(tasks.values(), timeout=NOW_PLAYING_BATCH_DEADLINE)
+        # Shared lookups keep running in the background and warm the caches
+        for task in pending:
+            task.cancel()
+
+    results = []
+    for station_id, task in tasks.items():
+        if task in pending:
+            results.append(NowPlayingBatchItem(station_id=station_id, success=False, error="Timed out"))
+            continue
+
+        error = task.exception()
+        if error is None:
+            results.append(NowPlayingBatchItem(station_id=station_id, success=True, data=task.result()))
+        else:
+            detail = error.detail if isinstance(error, HTTPException) else str(error)
+            results.append(NowPlayingBatchItem(station_id=station_id, success=False, error=detail))
+
+    return NowPlayingBatchResponse(
+        success=True,
+        count=len(results),
+        results=results,
+    )
+
+
+@api_router.get("/now-playing/{station_id}/events")
+async def stream_now_playing_events(station_id: str):
+    """
+    Server-Sent Events stream of now playing updates for a station.
+    Sends the current title on connect, then one event per title change.
+    """
+    async def event_stream():
+        async with now_playing_broadcaster.subscribe(station_id) as subscriber:
+            while True:
+                try:
+                    now_playing = await asyncio.wait_for(subscriber.get(), NOW_PLAYING_SSE_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: now-playing\ndata: {now_playing.model_dump_json()}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        },
+    )
+
+
+@api_router.websocket("/now-playing/{station_id}/ws")
+async def now_playing_websocket(websocket: WebSocket, station_id: str):
+    """
+    WebSocket feed of now playing updates for a station.
+    Sends the current title on connect, then one message per title change.
+    """
+    await websocket.accept()
+    async with now_playing_broadcaster.subscribe(station_id) as subscriber:
+        async def pump():
+            while True:
+                now_playing = await subscriber.get()
+                await websocket.send_text(now_playing.model_dump_json())
+
+        pump_task = asyncio.create_task(pump())
+        try:
+            # Incoming messages are ignored; this only detects disconnects
+            while True:
+                await websocket.receive_text()
+        except WebSocketDisconnect:
+            pass
+        finally:
+            pump_task.cancel()
+
+
+@api_router.get("/now-playing/{station_id}/history", response_model=TrackHistoryResponse)
+async def get_now_playing_history(
+    station_id: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    limit: int = 50,
+    cursor: Optional[str] = None
+):
+    """
+    Recently played tracks for a station, newest first.
+    Pass the returned next_cursor to fetch the following page.
+    """
+    limit = max(1, min(limit, TRACK_HISTORY_MAX_PAGE))
+    query: Dict[str, Any] = {"station_id": station_id}
+
+    time_range = {}
+    if start:
+        time_range["$gte"] = start
+    if end:
+        time_range["$lt"] = end
+    if time_range:
+        query["ts"] = time_range
+
+    if cursor:
+        try:
+            cursor_ts, cursor_id = decode_history_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query["$or"] = [
+            {"ts": {"$lt": cursor_ts}},
+            {"ts": cursor_ts, "_id": {"$lt": cursor_id}},
+        ]
+
+    try:
+        docs = await db[TRACK_HISTORY_COLLECTION].find(query).sort(
+            [("ts", -1), ("_id", -1)]
+        ).limit(limit + 1).to_list(limit + 1)
+    except Exception as e:
+        logger.error("Error fetching track history: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
+    next_cursor = None
+    if len(docs) > limit:
+        docs = docs[:limit]
+        next_cursor = encode_history_cursor(docs[-1]["ts"], docs[-1]["_id"])
 
-async def fetch_icy_stream_title(stream_url: str) -> Optional[dict]:
+    items = [
+        TrackHistoryEntry(
+            station_id=doc["station_id"],
+            title=doc.get("title"),
+            artist=doc.get("artist"),
+            song=doc.get("song"),
+            album=doc.get("album"),
+            source=doc.get("source"),
+            played_at=doc["ts"].replace(tzinfo=timezone.utc),
+        )
+        for doc in docs
+    ]
+    return TrackHistoryResponse(
+        success=True,
+        count=len(items),
+        items=items,
+        next_cursor=next_cursor,
+    )
+
+
+async def fetch_icy_stream_title(stream_url: str, station_id: Optional[str] = None) -> Optional[dict]:
     """
     Connect to a radio stream with Icy-MetaData:1 header,
     read enough bytes to extract the StreamTitle from ICY metadata.
     """
+    metadata = await fetch_icy_metadata(stream_url)
+    if metadata:
+        return parse_icy_stream_title(metadata, station_id)
+    return None
+
+
+async def fetch_icy_metadata(stream_url: str) -> Optional[bytes]:
+    """
+    One-shot ICY probe: read the stream only up to the first non-empty
+    metadata block (or ICY_PROBE_MAX_BLOCKS blocks) and return its raw bytes.
+    """
     try:
-        async with httpx.AsyncClient(timeout=5.0, follow_redirects=True) as http_client:
-            async with http_client.stream(
+        async with host_breakers.guard(stream_url), http_pools.host_slot(stream_url, HOST_SLOT_WAIT):
+            async with http_pools.streams.stream(
                 'GET',
                 stream_url,
-                headers={
-                    'Icy-MetaData': '1',
-                    'User-Agent': 'MegaRadio/1.0',
-                }
+                headers=ICY_REQUEST_HEADERS,
             ) as response:
-                # Get the ICY metadata interval
-                metaint_str = response.headers.get('icy-metaint')
-                if not metaint_str:
-                    logger.debug(f"No icy-metaint header for {stream_url}")
+                if response.status_code != 200:
+                    # Possibly transient; only repeated failures are cached
+                    logger.debug("ICY probe got HTTP %s for %s", response.status_code, stream_url)
+                    icy_capabilities.record_error(stream_url)
                     return None
 
-                metaint = int(metaint_str)
-                if metaint <= 0:
+                # Get the ICY metadata interval
+                metaint = icy_metaint(response)
+                if not metaint:
+                    logger.debug("No icy-metaint header for %s", stream_url)
+                    icy_capabilities.record_unsupported(stream_url, 'no_metaint')
                     return None
 
-                # Read metaint bytes of audio data + metadata block
-                buffer = b''
-                async for chunk in response.aiter_bytes(chunk_size=4096):
-                    buffer += chunk
-                    # We need metaint + 1 (length byte) + up to 4080 (max meta)
-                    if len(buffer) > metaint + 256:
+                parser = IcyMetadataParser(metaint)
+                async for chunk in response.aiter_bytes():
+                    for block in parser.feed(chunk):
+                        if block:
+                            icy_capabilities.record_supported(stream_url)
+                            return block
+                    if parser.blocks >= ICY_PROBE_MAX_BLOCKS:
+                        icy_capabilities.record_unsupported(stream_url, 'empty_metadata')
                         break
 
-                if len(buffer) <= metaint:
-                    return None
+    except UnsafeUpstreamError as e:
+        logger.debug("ICY metadata fetch refused for %s: %s", stream_url, e)
+        icy_capabilities.record_unsupported(stream_url, 'unsafe_address')
+    except HostUnavailableError as e:
+        logger.debug("ICY metadata fetch skipped for %s: %s", stream_url, e)
+    except Exception as e:
+        logger.debug("ICY metadata fetch failed for %s: %s", stream_url, e)
+        icy_capabilities.record_error(stream_url)
+
+    return None
 
-                # The metadata starts right after metaint bytes of audio
-                meta_length_byte = buffer[metaint]
-                meta_length = meta_length_byte * 16
 
-                if meta_length == 0:
-                    return None
+def parse_icy_stream_title(metadata: bytes, station_id: Optional[str] = None) -> Optional[dict]:
+    """
+    Extract StreamTitle='Artist - Title'; from a raw ICY metadata block.
+    """
+    return title_normalizer.parse(station_id, metadata)[1]
 
-                meta_start = metaint + 1
-                meta_end = meta_start + meta_length
 
-                if len(buffer) < meta_end:
-                    return None
+def parse_stream_title_text(stream_title: str, station_id: Optional[str] = None) -> Optional[dict]:
+    """
+    Split an "Artist - Song" title into its parts.
+    """
+    return title_normalizer.rules_for(station_id).apply(stream_title)
+
+
+# ============== ICY Metadata Parsing ==============
+#
+# An ICY body interleaves `metaint` audio bytes with metadata blocks: one
+# length byte, then length*16 bytes of `Key='value';` pairs padded with NULs.
+
+ICY_PROBE_MAX_BLOCKS = 2
+ICY_EMPTY_BLOCK_LIMIT = 3
+
+# Values may contain quotes ("Guns N' Roses"), so a value only ends at a
+# quote-semicolon followed by the next key or the end of the block.
+ICY_METADATA_PAIR = re.compile(r"(\w+)='(.*?)'(?:;(?=\s*\w+=)|;?\s*$)", re.DOTALL)
+
+
+def icy_metaint(response: httpx.Response) -> int:
+    """
+    The response's icy-metaint interval, or 0 if ICY is not offered.
+    """
+    metaint_str = response.headers.get('icy-metaint', '').strip()
+    if response.status_code != 200 or not metaint_str.isdigit():
+        return 0
+    return int(metaint_str)
+
+
+def parse_icy_metadata(metadata: bytes, encoding: Optional[str] = None) -> Dict[str, str]:
+    """
+    Parse every Key='value'; pair in a raw ICY metadata block.
+    """
+    meta_str = decode_icy_text(metadata.rstrip(b'\0'), encoding).strip()
+    return {key: value for key, value in ICY_METADATA_PAIR.findall(meta_str)}
+
+
+class IcyMetadataParser:
+    """
+    Incremental state machine over an ICY stream body. Audio bytes are
+    skipped through a memoryview without being copied; only metadata
+    bytes are collected, exactly length*16 of them per block.
+    """
+
+    AUDIO = 0
+    LENGTH = 1
+    METADATA = 2
+
+    def __init__(self, metaint: int):
+        self.metaint = metaint
+        self.audio_bytes = 0
+        self.blocks = 0
+        self._state = self.AUDIO
+        self._remaining = metaint
+        self._metadata = bytearray()
+
+    def feed(self, chunk: bytes, audio: Optional[List[memoryview]] = None) -> List[bytes]:
+        """
+        Consume a chunk of the stream body and return the metadata blocks
+        completed by it, in order. Empty blocks are returned as b''.
+        If `audio` is given, the chunk's audio runs are appended to it as
+        memoryview slices.
+        """
+        blocks = []
+        view = memoryview(chunk)
+        pos = 0
+        end = len(view)
+
+        while pos < end:
+            if self._state == self.AUDIO:
+                step = min(self._remaining, end - pos)
+                if audio is not None:
+                    audio.append(view[pos:pos + step])
+                pos += step
+                self._remaining -= step
+                self.audio_bytes += step
+                if not self._remaining:
+                    self._state = self.LENGTH
+
+            elif self._state == self.LENGTH:
+                length = view[pos] * 16
+                pos += 1
+                if length:
+                    self._state = self.METADATA
+                    self._remaining = length
+                else:
+                    self.blocks += 1
+                    blocks.append(b'')
+                    self._state = self.AUDIO
+                    self._remaining = self.metaint
+
+            else:
+                step = min(self._remaining, end - pos)
+                self._metadata += view[pos:pos + step]
+                pos += step
+                self._remaining -= step
+                if not self._remaining:
+                    self.blocks += 1
+                    blocks.append(bytes(self._metadata))
+                    self._metadata.clear()
+                    self._state = self.AUDIO
+                    self._remaining = self.metaint
+
+        return blocks
+
+
+# ============== Title Normalization ==============
+#
+# Many stations send ICY titles in a legacy single-byte charset (Latin-1,
+# CP1251, CP1254) rather than UTF-8. The encoding is detected per block and
+# titles are cleaned up with per-station rules loaded from TITLE_RULES_FILE:
+#
+#   {"<station_id>": {"encoding": "cp1254", "separators": [" / "],
+#                     "swap": true, "junk": ["^Reklam"], "strip": ["\\s*\\[.*\\]$"]}}
+#
+# Rules are compiled once; parse results are memoized per raw metadata
+# block, so an unchanged title costs a dictionary lookup.
+
+TITLE_RULES_FILE = os.environ.get('TITLE_RULES_FILE', '')
+TITLE_MEMO_MAX_ENTRIES = int(os.environ.get('TITLE_MEMO_MAX_ENTRIES', '20000'))
+
+DEFAULT_TITLE_SEPARATORS = [' - ', ' – ', ' — ', ' ~ ']
+DEFAULT_JUNK_TITLES = [
+    r'^(advert(isement)?|commercial|reklam|werbung|publicidad|jingle)s?\b',
+    r'^(unknown|untitled|n/?a|-)$',
+    r'^(https?://|www\.)\S+$',
+]
 
-                metadata = buffer[meta_start:meta_end]
-                meta_str = metadata.decode('utf-8', errors='ignore').strip('\0')
-
-                # Parse StreamTitle='Artist - Title';
-                match = re.search(r"StreamTitle='([^']*)'", meta_str)
-                if match:
-                    stream_title = match.group(1).strip()
-                    if stream_title:
-                        # Try to split "Artist - Song"
-                        parts = stream_title.split(' - ', 1)
-                        if len(parts) == 2:
-                            return {
-                                'artist': parts[0].strip(),
-                                'song': parts[1].strip(),
-                                'title': stream_title,
-                            }
-                        return {'title': stream_title}
+# Letters that only appear in Turkish among the Windows Latin code pages:
+# ğ Ğ ş Ş ı İ in CP1254 are ð Ð þ Þ ý Ý in CP1252.
+CP1254_MARKER_BYTES = frozenset(b'\xf0\xd0\xfe\xde\xfd\xdd')
+# Cyrillic words put several CP1251 letters in a row; Turkish ones rarely
+# have more than one special letter together, and a run made only of the
+# markers above (Р Э Ю р э ю in CP1251) is not a plausible Russian word.
+CYRILLIC_MIN_RUN = 3
 
+
+def decode_icy_text(raw: bytes, encoding: Optional[str] = None) -> str:
+    """
+    Decode ICY metadata bytes: the station's configured encoding if set,
+    else UTF-8 if valid, else the most plausible Windows code page.
+    """
+    if encoding:
+        return raw.decode(encoding, errors='replace')
+    try:
+        return raw.decode('utf-8')
+    except UnicodeDecodeError:
+        pass
+
+    high = [b for b in raw if b >= 0x80]
+    # Cyrillic text is mostly high bytes, all of them letters in CP1251;
+    # Latin text only has the odd accented letter among ASCII
+    letters = sum(1 for b in raw if (0x41 <= b <= 0x5a) or (0x61 <= b <= 0x7a))
+    cyrillic = 0
+    run = 0
+    run_is_turkish = True
+    cyrillic_word = False
+    for b in raw:
+        if b >= 0xc0 or b in (0xa8, 0xb8):
+            cyrillic += 1
+            run += 1
+            run_is_turkish = run_is_turkish and b in CP1254_MARKER_BYTES
+            cyrillic_word = cyrillic_word or (run >= CYRILLIC_MIN_RUN and not run_is_turkish)
+        else:
+            run = 0
+            run_is_turkish = True
+    if cyrillic > letters and cyrillic_word:
+        return raw.decode('cp1251', errors='replace')
+    if any(b in CP1254_MARKER_BYTES for b in high):
+        return raw.decode('cp1254', errors='replace')
+    try:
+        return raw.decode('cp1252')
+    except UnicodeDecodeError:
+        return raw.decode('latin-1')
+
+
+class TitleRules:
+    """
+    Compiled normalization rules for one station (or the defaults).
+    """
+
+    def __init__(self, config: Optional[dict] = None):
+        config = config or {}
+        self.encoding = config.get('encoding')
+        self.separators = config.get('separators') or DEFAULT_TITLE_SEPARATORS
+        self.swap = bool(config.get('swap', False))
+        self.junk = [re.compile(p, re.IGNORECASE) for p in DEFAULT_JUNK_TITLES + config.get('junk', [])]
+        self.strip = [re.compile(p, re.IGNORECASE) for p in config.get('strip', [])]
+
+    def apply(self, stream_title: str) -> Optional[dict]:
+        """
+        Clean up a decoded title and split it into artist and song.
+        Returns None for empty or junk titles.
+        """
+        for pattern in self.strip:
+            stream_title = pattern.sub('', stream_title)
+        stream_title = ' '.join(stream_title.split())
+        if not stream_title or any(p.search(stream_title) for p in self.junk):
+            return None
+
+        for separator in self.separators:
+            artist, found, song = stream_title.partition(separator)
+            if found and artist.strip() and song.strip():
+                artist, song = artist.strip(), song.strip()
+                if self.swap:
+                    artist, song = song, artist
+                return {'artist': artist, 'song': song, 'title': f"{artist} - {song}"}
+        return {'title': stream_title}
+
+
+def load_title_rules(path: str) -> Dict[str, TitleRules]:
+    if not path:
+        return {}
+    try:
+        with open(path, encoding='utf-8') as rules_file:
+            config = json.load(rules_file)
+        return {station_id: TitleRules(rules) for station_id, rules in config.items()}
     except Exception as e:
-        logger.debug(f"ICY metadata fetch failed for {stream_url}: {e}")
+        logger.error("Error loading title rules from %s: %s", path, e)
+        return {}
 
-    return None
 
-# Include the router in the main app
-app.include_router(api_router)
+class TitleNormalizer:
+    """
+    Memoized ICY block -> (metadata pairs, title info) parsing with
+    per-station rules.
+    """
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_credentials=True,
-    allow_origins=["*"],
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+    def __init__(self, station_rules: Dict[str, TitleRules], max_entries: int):
+        self.default_rules = TitleRules()
+        self.station_rules = station_rules
+        self.max_entries = max_entries
+        self._memo: "OrderedDict[Tuple[Optional[str], bytes], Tuple[Dict[str, str], Optional[dict]]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.suppressed = 0
+
+    def rules_for(self, station_id: Optional[str]) -> TitleRules:
+        return self.station_rules.get(station_id, self.default_rules)
+
+    def parse(self, station_id: Optional[str], metadata: bytes) -> Tuple[Dict[str, str], Optional[dict]]:
+        rules = self.rules_for(station_id)
+        # Stations on the default rules share memo entries
+        key = (station_id if rules is not self.default_rules else None, metadata)
+        cached = self._memo.get(key)
+        if cached is not None:
+            self.hits += 1
+            self._memo.move_to_end(key)
+            return cached
+
+        self.misses += 1
+        pairs = parse_icy_metadata(metadata, rules.encoding)
+        stream_title = pairs.get('StreamTitle', '')
+        title_info = rules.apply(stream_title)
+        if title_info is None and stream_title.strip():
+            self.suppressed += 1
+
+        result = (pairs, title_info)
+        self._memo[key] = result
+        while len(self._memo) > self.max_entries:
+            self._memo.popitem(last=False)
+        return result
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'station_rules': len(self.station_rules),
+            'entries': len(self._memo),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / lookups, 3) if lookups else None,
+            'suppressed': self.suppressed,
+        }
+
+
+title_normalizer = TitleNormalizer(load_title_rules(TITLE_RULES_FILE), TITLE_MEMO_MAX_ENTRIES)
+
+
+# ============== HTTP Client Pools ==============
+#
+# Application-lifetime clients so catalog lookups and stream probes reuse
+# keep-alive connections instead of paying a TCP+TLS handshake per request.
+# The stream pool also carries the long-lived ICY monitor connections, which
+# do not take a per-host slot; relayed streams use a pool of their own.
+# Stream and relay requests only go to public addresses (see Upstream
+# Address Checks).
+
+CATALOG_API_BASE = os.environ.get('CATALOG_API_BASE', 'https://themegaradio.com')
+CATALOG_HTTP2 = os.environ.get('CATALOG_HTTP2', 'false').lower() in ('1', 'true', 'yes')
+CATALOG_MAX_CONNECTIONS = int(os.environ.get('CATALOG_MAX_CONNECTIONS', '50'))
+# Sized for ICY_MONITOR_MAX_STATIONS (500) long-lived monitors plus ~200
+# concurrent probe, playlist and HLS requests
+STREAM_MAX_CONNECTIONS = int(os.environ.get('STREAM_MAX_CONNECTIONS', '700'))
+STREAM_MAX_CONNECTIONS_PER_HOST = int(os.environ.get('STREAM_MAX_CONNECTIONS_PER_HOST', '8'))
+# Relayed streams have their own pool so they can't starve the stream pool:
+# RELAY_MAX_STREAMS (200) upstreams plus headroom for redirect hops.
+# Total outbound to stream hosts is STREAM_ + RELAY_MAX_CONNECTIONS (950).
+RELAY_MAX_CONNECTIONS = int(os.environ.get('RELAY_MAX_CONNECTIONS', '250'))
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get('HTTP_KEEPALIVE_EXPIRY', '30'))
+
+ICY_REQUEST_HEADERS = {
+    'Icy-MetaData': '1',
+    'User-Agent': 'MegaRadio/1.0',
+}
+
+
+class HttpClientPools:
+    """
+    Shared httpx clients for the themegaradio catalog API and for radio
+    stream hosts. Opened on app startup and closed on shutdown.
+    """
+
+    def __init__(self):
+        self._catalog: Optional[httpx.AsyncClient] = None
+        self._streams: Optional[httpx.AsyncClient] = None
+        self._relays: Optional[httpx.AsyncClient] = None
+        self._catalog_transport: Optional[httpx.AsyncHTTPTransport] = None
+        self._streams_transport: Optional[httpx.AsyncHTTPTransport] = None
+        self._relays_transport: Optional[httpx.AsyncHTTPTransport] = None
+        self._host_slots: Dict[str, asyncio.Semaphore] = {}
+        self._host_active: Dict[str, int] = {}
+        self.catalog_http2 = False
+        self.host_waits = 0
+        self.host_slot_timeouts = 0
+        self.requests = {'catalog': 0, 'streams': 0, 'relays': 0}
+
+    def _count_request(self, pool_name: str):
+        async def hook(request: httpx.Request):
+            self.requests[pool_name] += 1
+        return hook
+
+    async def open(self):
+        if self._catalog is not None:
+            return
+
+        http2 = CATALOG_HTTP2
+        if http2 and importlib.util.find_spec('h2') is None:
+            logger.warning("CATALOG_HTTP2 is enabled but the 'h2' package is not installed; using HTTP/1.1")
+            http2 = False
+        self.catalog_http2 = http2
+
+        self._catalog_transport = httpx.AsyncHTTPTransport(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=CATALOG_MAX_CONNECTIONS,
+                max_keepalive_connections=CATALOG_MAX_CONNECTIONS,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+        )
+        self._catalog = httpx.AsyncClient(
+            base_url=CATALOG_API_BASE,
+            transport=self._catalog_transport,
+            timeout=5.0,
+            event_hooks={'request': [self._count_request('catalog')]},
+        )
+
+        self._streams_transport = checked_transport(
+            upstream_policy,
+            limits=httpx.Limits(
+                max_connections=STREAM_MAX_CONNECTIONS,
+                max_keepalive_connections=STREAM_MAX_CONNECTIONS_PER_HOST * 4,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+        )
+        self._streams = httpx.AsyncClient(
+            transport=self._streams_transport,
+            timeout=5.0,
+            follow_redirects=True,
+            # Checked on every request and connection, so redirects and
+            # re-resolved names can't reach private hosts either
+            event_hooks={'request': [upstream_policy.check_request, self._count_request('streams')]},
+        )
+
+        self._relays_transport = checked_transport(
+            upstream_policy,
+            limits=httpx.Limits(
+                max_connections=RELAY_MAX_CONNECTIONS,
+                max_keepalive_connections=0,
+            ),
+        )
+        self._relays = httpx.AsyncClient(
+            transport=self._relays_transport,
+            timeout=5.0,
+            follow_redirects=True,
+            event_hooks={'request': [upstream_policy.check_request, self._count_request('relays')]},
+        )
+
+    async def close(self):
+        clients = [c for c in (self._catalog, self._streams, self._relays) if c is not None]
+        self._catalog = self._streams = self._relays = None
+        self._catalog_transport = self._streams_transport = self._relays_transport = None
+        for http_client in clients:
+            await http_client.aclose()
+
+    @property
+    def catalog(self) -> httpx.AsyncClient:
+        if self._catalog is None:
+            raise RuntimeError("HTTP client pools are not open")
+        return self._catalog
+
+    @property
+    def streams(self) -> httpx.AsyncClient:
+        if self._streams is None:
+            raise RuntimeError("HTTP client pools are not open")
+        return self._streams
+
+    @property
+    def relays(self) -> httpx.AsyncClient:
+        if self._relays is None:
+            raise RuntimeError("HTTP client pools are not open")
+        return self._relays
+
+    @asynccontextmanager
+    async def host_slot(self, url: str, timeout: Optional[float] = None):
+        """
+        Cap concurrent short-lived requests to a single stream host.
+        Raises HostUnavailableError if no slot frees up within `timeout`.
+        """
+        host = httpx.URL(url).host
+        slot = self._host_slots.get(host)
+        if slot is None:
+            slot = self._host_slots[host] = asyncio.Semaphore(STREAM_MAX_CONNECTIONS_PER_HOST)
+        if slot.locked():
+            self.host_waits += 1
+
+        try:
+            await asyncio.wait_for(slot.acquire(), timeout)
+        except asyncio.TimeoutError:
+            self.host_slot_timeouts += 1
+            raise HostUnavailableError(f"All {STREAM_MAX_CONNECTIONS_PER_HOST} slots for {host} are busy")
+
+        self._host_active[host] = self._host_active.get(host, 0) + 1
+        try:
+            yield
+        finally:
+            slot.release()
+            self._host_active[host] -= 1
+            if not self._host_active[host]:
+                del self._host_active[host]
+
+    @staticmethod
+    def _pool_stats(transport: Optional[httpx.AsyncHTTPTransport]) -> dict:
+        # httpcore keeps its connection list on the transport's pool
+        pool = getattr(transport, '_pool', None)
+        connections = list(getattr(pool, 'connections', []))
+        return {
+            'connections': len(connections),
+            'idle': sum(1 for c in connections if c.is_idle()),
+        }
+
+    def stats(self) -> dict:
+        return {
+            'open': self._catalog is not None,
+            'catalog': {
+                'base_url': CATALOG_API_BASE,
+                'http2': self.catalog_http2,
+                'max_connections': CATALOG_MAX_CONNECTIONS,
+                'requests': self.requests['catalog'],
+                **self._pool_stats(self._catalog_transport),
+            },
+            'streams': {
+                'max_connections': STREAM_MAX_CONNECTIONS,
+                'max_connections_per_host': STREAM_MAX_CONNECTIONS_PER_HOST,
+                'active_hosts': dict(self._host_active),
+                'host_waits': self.host_waits,
+                'host_slot_timeouts': self.host_slot_timeouts,
+                'requests': self.requests['streams'],
+                **self._pool_stats(self._streams_transport),
+            },
+            'relays': {
+                'max_connections': RELAY_MAX_CONNECTIONS,
+                'requests': self.requests['relays'],
+                **self._pool_stats(self._relays_transport),
+            },
+        }
+
+
+http_pools = HttpClientPools()
+
+
+# ============== Adaptive Catalog Requests ==============
+#
+# Catalog timeouts follow observed latency instead of a fixed 5 s: the limit
+# is a multiple of the recent p99, clamped to a sane range. With hedging on,
+# a request still unanswered at the p95 latency gets a duplicate and
+# whichever answers first wins.
+
+CATALOG_TIMEOUT_MIN = float(os.environ.get('CATALOG_TIMEOUT_MIN', '0.5'))
+CATALOG_TIMEOUT_MAX = float(os.environ.get('CATALOG_TIMEOUT_MAX', '5'))
+CATALOG_TIMEOUT_P99_MULTIPLIER = float(os.environ.get('CATALOG_TIMEOUT_P99_MULTIPLIER', '2'))
+CATALOG_HEDGING = os.environ.get('CATALOG_HEDGING', 'true').lower() in ('1', 'true', 'yes')
+CATALOG_LATENCY_WINDOW = 256
+CATALOG_LATENCY_MIN_SAMPLES = 20
+
+
+class LatencyTracker:
+    """
+    Rolling window of request latencies with percentile lookups.
+    """
+
+    def __init__(self, window: int, min_samples: int):
+        self.min_samples = min_samples
+        self._samples: deque = deque(maxlen=window)
+
+    def observe(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, p: float) -> Optional[float]:
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(len(ordered) * p / 100))
+        return ordered[index]
+
+    def stats(self) -> dict:
+        def rounded(value: Optional[float]) -> Optional[float]:
+            return round(value, 4) if value is not None else None
+
+        return {
+            'samples': len(self._samples),
+            'p50': rounded(self.percentile(50)),
+            'p95': rounded(self.percentile(95)),
+            'p99': rounded(self.percentile(99)),
+        }
+
+
+class HedgedCatalogRequests:
+    """
+    GET requests to the catalog API with latency-derived timeouts and
+    optional hedging.
+    """
+
+    def __init__(self, hedging: bool):
+        self.hedging = hedging
+        self.latency = LatencyTracker(CATALOG_LATENCY_WINDOW, CATALOG_LATENCY_MIN_SAMPLES)
+        self.requests = 0
+        self.timeouts = 0
+        self.hedges_fired = 0
+        self.hedges_won = 0
+
+    def timeout(self) -> float:
+        p99 = self.latency.percentile(99)
+        if p99 is None:
+            return CATALOG_TIMEOUT_MAX
+        return min(max(p99 * CATALOG_TIMEOUT_P99_MULTIPLIER, CATALOG_TIMEOUT_MIN), CATALOG_TIMEOUT_MAX)
+
+    async def get(self, path: str) -> httpx.Response:
+        self.requests += 1
+        timeout = self.timeout()
+        hedge_after = self.latency.percentile(95) if self.hedging else None
+
+        primary = asyncio.create_task(self._attempt(path, timeout))
+        if hedge_after is None or hedge_after >= timeout:
+            return await primary
+
+        done, _ = await asyncio.wait({primary}, timeout=hedge_after)
+        if done:
+            return primary.result()
+
+        self.hedges_fired += 1
+        hedge = asyncio.create_task(self._attempt(path, timeout))
+        pending = {primary, hedge}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.hedges_won += 1
+                        return task.result()
+            # Both attempts failed; surface the primary's error
+            return primary.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _attempt(self, path: str, timeout: float) -> httpx.Response:
+        started = time.monotonic()
+        try:
+            response = await http_pools.catalog.get(path, timeout=timeout)
+        except httpx.TimeoutException:
+            # Record the timeout itself so the window can adapt upward;
+            # attempts cancelled by a winning hedge are not recorded at all
+            self.timeouts += 1
+            self.latency.observe(timeout)
+            raise
+        self.latency.observe(time.monotonic() - started)
+        return response
+
+    def stats(self) -> dict:
+        return {
+            **self.latency.stats(),
+            'timeout': round(self.timeout(), 3),
+            'hedging': self.hedging,
+            'requests': self.requests,
+            'timeouts': self.timeouts,
+            'hedges_fired': self.hedges_fired,
+            'hedges_won': self.hedges_won,
+        }
+
+
+catalog_requests = HedgedCatalogRequests(CATALOG_HEDGING)
+
+
+# ============== Host Circuit Breakers ==============
+#
+# A hung stream host (e.g. a shared Shoutcast server carrying hundreds of
+# stations) should cost callers nothing once it is known to be down. After
+# HOST_BREAKER_FAILURE_THRESHOLD consecutive failures a host's breaker opens
+# and requests fail fast for HOST_BREAKER_COOLDOWN seconds; then a single
+# trial request decides whether it closes again.
+
+HOST_BREAKER_FAILURE_THRESHOLD = int(os.environ.get('HOST_BREAKER_FAILURE_THRESHOLD', '5'))
+HOST_BREAKER_COOLDOWN = float(os.environ.get('HOST_BREAKER_COOLDOWN', '30'))
+HOST_SLOT_WAIT = float(os.environ.get('HOST_SLOT_WAIT', '1'))
+
+
+class HostUnavailableError(Exception):
+    """
+    Raised instead of contacting a host whose breaker is open or whose
+    concurrency cap stayed saturated.
+    """
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int, cooldown: float):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+        self.rejected = 0
+        self._trial_inflight = False
+
+    def allow(self) -> bool:
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            if self._trial_inflight:
+                self.rejected += 1
+                return False
+            self._trial_inflight = True
+            return True
+        if self.state == self.OPEN:
+            self.rejected += 1
+            return False
+        return True
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self._trial_inflight = False
+
+    def cancel_trial(self):
+        self._trial_inflight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial_inflight = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.trips += 1
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def stats(self) -> dict:
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'trips': self.trips,
+            'rejected': self.rejected,
+        }
+
+
+class HostBreakers:
+    """
+    One circuit breaker per upstream host.
+    """
+
+    def __init__(self, failure_threshold: int, cooldown: float):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def get(self, url: str) -> CircuitBreaker:
+        host = httpx.URL(url).host
+        breaker = self._breakers.get(host)
+        if breaker is None:
+            breaker = self._breakers[host] = CircuitBreaker(self.failure_threshold, self.cooldown)
+        return breaker
+
+    @asynccontextmanager
+    async def guard(self, url: str):
+        """
+        Fail fast if the host's breaker is open; otherwise run the body
+        and count any exception it raises against the host.
+        """
+        breaker = self.get(url)
+        if not breaker.allow():
+            raise HostUnavailableError(f"Circuit open for {httpx.URL(url).host}")
+        try:
+            yield
+        except HostUnavailableError:
+            breaker.cancel_trial()
+            raise
+        except Exception:
+            breaker.record_failure()
+            raise
+        except BaseException:
+            # Cancelled (or shutting down): says nothing about the host, but
+            # a half-open trial must be released or the host stays rejected
+            breaker.cancel_trial()
+            raise
+        breaker.record_success()
+
+    def stats(self) -> dict:
+        troubled = {
+            host: breaker.stats() for host, breaker in self._breakers.items()
+            if breaker.state != CircuitBreaker.CLOSED or breaker.failures
+        }
+        return {
+            'hosts': len(self._breakers),
+            'open': sorted(h for h, b in troubled.items() if b['state'] != CircuitBreaker.CLOSED),
+            'rejected': sum(b.rejected for b in self._breakers.values()),
+            'trips': sum(b.trips for b in self._breakers.values()),
+            'troubled': troubled,
+        }
+
+
+host_breakers = HostBreakers(HOST_BREAKER_FAILURE_THRESHOLD, HOST_BREAKER_COOLDOWN)
+
+
+# ============== Upstream Address Checks ==============
+#
+# Stream URLs come from clients (relay paths, /stream/resolve bodies) and
+# from playlists, so every request on the stream and relay clients,
+# redirects included, must go to a public address: never loopback, private
+# networks, link-local (cloud metadata endpoints) or reserved ranges.
+# Verdicts are cached per host and port for UPSTREAM_CHECK_TTL seconds and
+# reject bad hosts early; the address each connection actually reached is
+# checked again, so a name that re-resolves between the check and the
+# connect (DNS rebinding) still can't reach a private host.
+
+UPSTREAM_ALLOW_PRIVATE = os.environ.get('UPSTREAM_ALLOW_PRIVATE', 'false').lower() in ('1', 'true', 'yes')
+UPSTREAM_CHECK_TTL = float(os.environ.get('UPSTREAM_CHECK_TTL', '300'))
+UPSTREAM_CHECK_MAX_ENTRIES = 10000
+
+
+class UnsafeUpstreamError(HostUnavailableError):
+    """
+    Raised for an upstream URL that is not http(s) or that resolves to a
+    non-public address.
+    """
+
+
+def is_public_address(address: str) -> bool:
+    ip = ipaddress.ip_address(address.split('%', 1)[0])
+    if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+class UpstreamAddressPolicy:
+    """
+    Resolves upstream hosts and rejects the ones with any non-public
+    address. Installed as a request hook on the stream client.
+    """
+
+    def __init__(self, ttl: float, max_entries: int, allow_private: bool):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.allow_private = allow_private
+        self._verdicts: "OrderedDict[Tuple[str, int], Tuple[float, Optional[str]]]" = OrderedDict()
+        self.lookups = 0
+        self.rejected = 0
+
+    async def check(self, url) -> None:
+        """
+        Raise UnsafeUpstreamError unless `url` is http(s) on a public address.
+        """
+        try:
+            parsed = url if isinstance(url, httpx.URL) else httpx.URL(url)
+        except Exception:
+            self.rejected += 1
+            raise UnsafeUpstreamError(f"Invalid upstream URL: {url}")
+        if parsed.scheme not in ('http', 'https') or not parsed.host:
+            self.rejected += 1
+            raise UnsafeUpstreamError(f"Not an http(s) stream URL: {url}")
+        if self.allow_private:
+            return
+
+        key = (parsed.host, parsed.port or (443 if parsed.scheme == 'https' else 80))
+        verdict = self._verdicts.get(key)
+        if verdict is None or time.monotonic() >= verdict[0]:
+            verdict = (time.monotonic() + self.ttl, await self._resolve(*key))
+            self._verdicts[key] = verdict
+            self._verdicts.move_to_end(key)
+            while len(self._verdicts) > self.max_entries:
+                self._verdicts.popitem(last=False)
+        if verdict[1]:
+            self.rejected += 1
+            raise UnsafeUpstreamError(verdict[1])
+
+    async def check_request(self, request: httpx.Request):
+        await self.check(request.url)
+
+    def check_connected(self, host: str, address: Optional[str]) -> None:
+        """
+        Raise UnsafeUpstreamError unless a connection to `host` reached a
+        public `address`.
+        """
+        if self.allow_private:
+            return
+        if not address or not is_public_address(address):
+            self.rejected += 1
+            raise UnsafeUpstreamError(f"{host} connected to non-public address {address}")
+
+    async def _resolve(self, host: str, port: int) -> Optional[str]:
+        """
+        The reason to reject `host`, or None if all its addresses are public.
+        """
+        self.lookups += 1
+        try:
+            infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            # Not cached: the name may resolve on the next attempt
+            raise HostUnavailableError(f"Cannot resolve {host}: {e}")
+        for info in infos:
+            address = info[4][0]
+            if not is_public_address(address):
+                return f"{host} resolves to non-public address {address}"
+        return None
+
+    def stats(self) -> dict:
+        return {
+            'allow_private': self.allow_private,
+            'hosts': len(self._verdicts),
+            'lookups': self.lookups,
+            'rejected': self.rejected,
+        }
+
+
+class CheckedNetworkBackend(httpcore.AsyncNetworkBackend):
+    """
+    httpcore network backend that runs every new connection's peer
+    address through an UpstreamAddressPolicy before it is used.
+    """
+
+    def __init__(self, policy: UpstreamAddressPolicy):
+        self.policy = policy
+        self._backend = httpcore.AnyIOBackend()
+
+    async def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        stream = await self._backend.connect_tcp(
+            host, port, timeout=timeout, local_address=local_address, socket_options=socket_options,
+        )
+        server_addr = stream.get_extra_info('server_addr')
+        try:
+            self.policy.check_connected(host, server_addr[0] if server_addr else None)
+        except UnsafeUpstreamError:
+            await stream.aclose()
+            raise
+        return stream
+
+    async def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        raise UnsafeUpstreamError(f"Unix socket upstreams are not allowed: {path}")
+
+    async def sleep(self, seconds: float) -> None:
+        await self._backend.sleep(seconds)
+
+
+upstream_policy = UpstreamAddressPolicy(UPSTREAM_CHECK_TTL, UPSTREAM_CHECK_MAX_ENTRIES, UPSTREAM_ALLOW_PRIVATE)
+
+
+def checked_transport(policy: UpstreamAddressPolicy, **kwargs) -> httpx.AsyncHTTPTransport:
+    """
+    An httpx transport whose connections are checked by `policy`.
+    """
+    transport = httpx.AsyncHTTPTransport(**kwargs)
+    # httpx has no option for it, but its httpcore pool takes a network
+    # backend. Proxied pools connect to the proxy, which resolves the
+    # upstream itself, so they keep the request hook check only.
+    if type(transport._pool) is httpcore.AsyncConnectionPool:
+        transport._pool._network_backend = CheckedNetworkBackend(policy)
+    return transport
+
+
+# ============== Request Coalescing ==============
+
+class SingleFlight:
+    """
+    Collapses concurrent calls with the same key into one in-flight
+    operation whose result (or exception) is shared by every caller.
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Task] = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    async def run(self, key: str, fn, *args):
+        task = self._calls.get(key)
+        if task is None:
+            self.executed += 1
+            task = asyncio.create_task(fn(*args))
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._finish(key, t))
+        else:
+            self.coalesced += 1
+        # A caller that disconnects must not cancel the shared operation
+        return await asyncio.shield(task)
+
+    def _finish(self, key: str, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            # Mark the exception retrieved even if every caller went away
+            task.exception()
+
+    def stats(self) -> dict:
+        return {
+            'executed': self.executed,
+            'coalesced': self.coalesced,
+            'inflight': len(self._calls),
+        }
+
+
+now_playing_flights = SingleFlight()
+
+
+# ============== Now Playing Subscriptions ==============
+#
+# Push updates for SSE and WebSocket clients. One watcher task per subscribed
+# station follows the ICY monitor and fans each title change out to every
+# subscriber queue. Stations without a local monitor (HLS stations, stations
+# over ICY_MONITOR_MAX_STATIONS, stations whose lease another worker holds)
+# have nothing to wake the watcher, so it polls every NOW_PLAYING_POLL_INTERVAL
+# seconds instead; HLS playlists are still fetched at most once per target
+# duration and remote results are a single cache read.
+
+NOW_PLAYING_WATCH_INTERVAL = float(os.environ.get('NOW_PLAYING_WATCH_INTERVAL', '15'))
+NOW_PLAYING_POLL_INTERVAL = float(os.environ.get('NOW_PLAYING_POLL_INTERVAL', '3'))
+NOW_PLAYING_SSE_KEEPALIVE = float(os.environ.get('NOW_PLAYING_SSE_KEEPALIVE', '15'))
+NOW_PLAYING_SUBSCRIBER_QUEUE_SIZE = 8
+
+
+def now_playing_version(now_playing: NowPlayingResponse) -> tuple:
+    """
+    The fields that make up a title change; the timestamp is ignored.
+    """
+    return (
+        now_playing.title,
+        now_playing.artist,
+        now_playing.song,
+        now_playing.album,
+        now_playing.artwork,
+    )
+
+
+def now_playing_etag(now_playing: NowPlayingResponse) -> str:
+    """
+    Weak ETag over the title fields: the body also carries a timestamp,
+    so equal tags mean the same song, not byte-identical payloads.
+    """
+    digest = hashlib.blake2b(
+        json.dumps(now_playing_version(now_playing), ensure_ascii=False).encode('utf-8'),
+        digest_size=8,
+    ).hexdigest()
+    return f'W/"{digest}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    Weak comparison of an If-None-Match header against `etag`.
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    opaque = etag.removeprefix('W/')
+    return any(tag.strip().removeprefix('W/') == opaque for tag in if_none_match.split(','))
+
+
+class NowPlayingBroadcaster:
+    """
+    Fans now playing updates out to per-station subscriber queues,
+    publishing only when the title actually changes.
+    """
+
+    def __init__(self):
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = {}
+        self._pollers: Dict[str, int] = {}
+        self._changed: Dict[str, asyncio.Event] = {}
+        self._watchers: Dict[str, asyncio.Task] = {}
+        self._latest: Dict[str, NowPlayingResponse] = {}
+        self.published = 0
+        self.dropped = 0
+        self.long_polls = 0
+        self.long_poll_timeouts = 0
+
+    @asynccontextmanager
+    async def subscribe(self, station_id: str):
+        subscriber: asyncio.Queue = asyncio.Queue(maxsize=NOW_PLAYING_SUBSCRIBER_QUEUE_SIZE)
+        self._subscribers.setdefault(station_id, set()).add(subscriber)
+        latest = self._latest.get(station_id)
+        if latest is not None:
+            subscriber.put_nowait(latest)
+        self._ensure_watcher(station_id)
+        try:
+            yield subscriber
+        finally:
+            subscribers = self._subscribers.get(station_id, set())
+            subscribers.discard(subscriber)
+            if not subscribers:
+                self._subscribers.pop(station_id, None)
+            self._release(station_id)
+
+    async def wait_for_change(self, station_id: str, since_etag: str, timeout: float) -> Optional[NowPlayingResponse]:
+        """
+        Long-poll: wait until the station's title no longer matches
+        `since_etag`. All waiters for a station park on one event that the
+        watcher sets on each change. Returns None on timeout.
+        """
+        self.long_polls += 1
+        self._pollers[station_id] = self._pollers.get(station_id, 0) + 1
+        self._ensure_watcher(station_id)
+        deadline = time.monotonic() + timeout
+        try:
+            while True:
+                latest = self._latest.get(station_id)
+                if latest is not None and now_playing_etag(latest) != since_etag:
+                    return latest
+                changed = self._changed.setdefault(station_id, asyncio.Event())
+                remaining = deadline - time.monotonic()
+                try:
+                    if remaining <= 0:
+                        raise asyncio.TimeoutError
+                    await asyncio.wait_for(changed.wait(), remaining)
+                except asyncio.TimeoutError:
+                    self.long_poll_timeouts += 1
+                    return None
+        finally:
+            self._pollers[station_id] -= 1
+            if not self._pollers[station_id]:
+                del self._pollers[station_id]
+            self._release(station_id)
+
+    def _ensure_watcher(self, station_id: str):
+        if station_id not in self._watchers:
+            self._watchers[station_id] = asyncio.create_task(self._watch(station_id))
+
+    def _release(self, station_id: str):
+        # Stop watching once the last subscriber and long-poller are gone
+        if station_id in self._subscribers or station_id in self._pollers:
+            return
+        self._latest.pop(station_id, None)
+        self._changed.pop(station_id, None)
+        watcher = self._watchers.pop(station_id, None)
+        if watcher:
+            watcher.cancel()
+
+    def publish(self, station_id: str, now_playing: NowPlayingResponse):
+        if station_id not in self._watchers:
+            return
+        latest = self._latest.get(station_id)
+        if latest is not None and now_playing_version(latest) == now_playing_version(now_playing):
+            return
+
+        self._latest[station_id] = now_playing
+        self.published += 1
+        for subscriber in self._subscribers.get(station_id, ()):
+            if subscriber.full():
+                # A slow subscriber only needs the newest title
+                subscriber.get_nowait()
+                self.dropped += 1
+            subscriber.put_nowait(now_playing)
+
+        changed = self._changed.pop(station_id, None)
+        if changed is not None:
+            changed.set()
+
+    async def _watch(self, station_id: str):
+        while True:
+            try:
+                await lookup_now_playing(station_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.debug("Now playing watcher for %s failed: %s", station_id, e)
+
+            monitor = icy_monitors.get(station_id)
+            if monitor and monitor.running:
+                await monitor.wait_for_change(NOW_PLAYING_WATCH_INTERVAL)
+            else:
+                await asyncio.sleep(NOW_PLAYING_POLL_INTERVAL)
+
+    async def stop(self):
+        watchers = list(self._watchers.values())
+        self._watchers.clear()
+        for watcher in watchers:
+            watcher.cancel()
+        await asyncio.gather(*watchers, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            'stations': len(self._watchers),
+            'subscribers': sum(len(s) for s in self._subscribers.values()),
+            'long_pollers': sum(self._pollers.values()),
+            'published': self.published,
+            'dropped': self.dropped,
+            'long_polls': self.long_polls,
+            'long_poll_timeouts': self.long_poll_timeouts,
+        }
+
+
+now_playing_broadcaster = NowPlayingBroadcaster()
+
+
+# ============== Now Playing Pre-warming ==============
+#
+# The most requested stations (by exponentially decayed request count) plus
+# any listed in PREWARM_STATIONS are refreshed in the background, so their
+# requests are answered from memory. Each station is refreshed every
+# PREWARM_INTERVAL seconds at its own offset within the interval, so
+# refreshes are spread out instead of arriving in bursts; PREWARM_CONCURRENCY
+# caps how many run at once.
+
+PREWARM_TOP_N = int(os.environ.get('PREWARM_TOP_N', '50'))
+PREWARM_STATIONS = [s.strip() for s in os.environ.get('PREWARM_STATIONS', '').split(',') if s.strip()]
+PREWARM_INTERVAL = float(os.environ.get('PREWARM_INTERVAL', '10'))
+PREWARM_CONCURRENCY = int(os.environ.get('PREWARM_CONCURRENCY', '8'))
+PREWARM_RANK_INTERVAL = float(os.environ.get('PREWARM_RANK_INTERVAL', '60'))
+PREWARM_TICK = 0.5
+# Request counts halve every ranking round
+PREWARM_DECAY = 0.5
+PREWARM_MAX_TRACKED = 10000
+
+
+class NowPlayingWarmer:
+    """
+    Keeps now-playing results for the top stations fresh in memory.
+    """
+
+    def __init__(self, top_n: int, pinned: List[str], interval: float, concurrency: int):
+        self.top_n = top_n
+        self.pinned = pinned
+        self.interval = interval
+        self._request_counts: Dict[str, float] = {}
+        self._due: Dict[str, float] = {}
+        self._results: Dict[str, Tuple[float, NowPlayingPayload]] = {}
+        self._refreshing: Set[str] = set()
+        self._refresh_tasks: Set[asyncio.Task] = set()
+        self._slots = asyncio.Semaphore(concurrency)
+        self._task: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_failures = 0
+
+    def start(self):
+        if self._task is None and (self.top_n or self.pinned):
+            self._rank()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Refreshes must not outlive the HTTP pools they use
+        tasks = list(self._refresh_tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def record_request(self, station_id: str):
+        if station_id in self._request_counts or len(self._request_counts) < PREWARM_MAX_TRACKED:
+            self._request_counts[station_id] = self._request_counts.get(station_id, 0.0) + 1
+
+    def get(self, station_id: str) -> Optional[NowPlayingPayload]:
+        """
+        The warm result for a warmed station. An overdue result (refreshes
+        failing upstream) is still served rather than blocking the request.
+        """
+        if station_id not in self._due:
+            return None
+        entry = self._results.get(station_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        if time.monotonic() - entry[0] > self.interval * 2:
+            self.stale_hits += 1
+        else:
+            self.hits += 1
+        return entry[1]
+
+    def store(self, now_playing: NowPlayingResponse):
+        if now_playing.station_id in self._due:
+            # Encoded once here; every hit until the next refresh reuses it
+            self._results[now_playing.station_id] = (time.monotonic(), NowPlayingPayload(now_playing))
+
+    def _rank(self):
+        ranked = sorted(self._request_counts.items(), key=lambda item: item[1], reverse=True)
+        wanted = list(dict.fromkeys(self.pinned + [station_id for station_id, _ in ranked[:self.top_n]]))
+
+        now = time.monotonic()
+        for station_id in list(self._due):
+            if station_id not in wanted:
+                del self._due[station_id]
+                self._results.pop(station_id, None)
+        for index, station_id in enumerate(wanted):
+            if station_id not in self._due:
+                # Spread first refreshes evenly over one interval
+                self._due[station_id] = now + self.interval * index / max(len(wanted), 1)
+
+        self._request_counts = {
+            station_id: count * PREWARM_DECAY
+            for station_id, count in self._request_counts.items()
+            if count * PREWARM_DECAY >= 0.1
+        }
+
+    async def _run(self):
+        next_rank = time.monotonic() + PREWARM_RANK_INTERVAL
+        while True:
+            await asyncio.sleep(PREWARM_TICK)
+            now = time.monotonic()
+            if now >= next_rank:
+                self._rank()
+                next_rank = now + PREWARM_RANK_INTERVAL
+            for station_id, due in list(self._due.items()):
+                if due <= now and station_id not in self._refreshing:
+                    # Keep the station's slot in the schedule even if this
+                    # refresh runs late
+                    self._due[station_id] = due + self.interval if due + self.interval > now else now + self.interval
+                    self._refreshing.add(station_id)
+                    task = asyncio.create_task(self._refresh(station_id))
+                    self._refresh_tasks.add(task)
+                    task.add_done_callback(self._refresh_tasks.discard)
+
+    async def _refresh(self, station_id: str):
+        try:
+            async with self._slots:
+                if station_id in self._due:
+                    await lookup_now_playing(station_id)
+                    self.refreshes += 1
+        except Exception as e:
+            self.refresh_failures += 1
+            logger.debug("Pre-warm refresh failed for %s: %s", station_id, e)
+        finally:
+            self._refreshing.discard(station_id)
+
+    def stats(self) -> dict:
+        return {
+            'warmed': len(self._due),
+            'stations': sorted(self._due),
+            'cached': len(self._results),
+            'top_n': self.top_n,
+            'pinned': len(self.pinned),
+            'interval': self.interval,
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+            'refreshes': self.refreshes,
+            'refresh_failures': self.refresh_failures,
+            'refreshing': len(self._refreshing),
+        }
+
+
+now_playing_warmer = NowPlayingWarmer(PREWARM_TOP_N, PREWARM_STATIONS, PREWARM_INTERVAL, PREWARM_CONCURRENCY)
+
+
+# ============== Shared Cache ==============
+#
+# With several uvicorn workers, per-process caches and ICY monitors would
+# multiply upstream traffic by the worker count. Station documents and
+# now-playing results therefore also go through a cache backend. The
+# in-memory backend (default) serves one process; the MongoDB backend
+# (SHARED_CACHE_BACKEND=mongo) is shared by every worker.
+#
+# A lease elects one refresher per key. Only the worker holding a station's
+# now-playing lease resolves it (and so runs its ICY monitor); the others
+# serve the result it stores. Leases are renewed by refreshes once half their
+# TTL has passed and expire when the holder goes quiet, letting another
+# worker take over. A worker that loses the lease before a result is
+# published answers with the station's genre rather than opening a second
+# monitor. The in-memory backend has no other workers, so station documents
+# (already held by the station cache) and now-playing results skip it.
+
+SHARED_CACHE_BACKEND = os.environ.get('SHARED_CACHE_BACKEND', 'memory').lower()
+SHARED_CACHE_MAX_ENTRIES = int(os.environ.get('SHARED_CACHE_MAX_ENTRIES', '20000'))
+SHARED_CACHE_LEASE_TTL = float(os.environ.get('SHARED_CACHE_LEASE_TTL', '30'))
+SHARED_CACHE_WAIT = float(os.environ.get('SHARED_CACHE_WAIT', '2'))
+SHARED_CACHE_POLL_INTERVAL = 0.1
+NOW_PLAYING_SHARED_STALE_TTL = float(os.environ.get('NOW_PLAYING_SHARED_STALE_TTL', '60'))
+SHARED_CACHE_COLLECTION = 'shared_cache'
+SHARED_LEASE_COLLECTION = 'cache_leases'
+
+
+class CacheBackend(ABC):
+    """
+    Key/value store for JSON-serializable values with expiry, plus
+    per-key refresher leases.
+    """
+
+    name = 'base'
+    shared = False
+
+    def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[Tuple[Any, float]]:
+        """
+        (value, stored_at as epoch seconds), or None if missing/expired.
+        """
+
+    @abstractmethod
+    async def set(self, key: str, value: Any, ttl: float):
+        """
+        Store `value` under `key` for `ttl` seconds.
+        """
+
+    @abstractmethod
+    async def acquire_lease(self, key: str, ttl: float) -> bool:
+        """
+        Take or renew the refresher lease for `key`. False if another
+        worker holds it.
+        """
+
+    def stats(self) -> dict:
+        return {}
+
+
+class MemoryCacheBackend(CacheBackend):
+    """
+    Single-process backend; every lease is granted.
+    """
+
+    name = 'memory'
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, float, Any]]" = OrderedDict()
+
+    async def get(self, key: str) -> Optional[Tuple[Any, float]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, stored_at, value = entry
+        if time.time() >= expires_at:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value, stored_at
+
+    async def set(self, key: str, value: Any, ttl: float):
+        now = time.time()
+        self._entries[key] = (now + ttl, now, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def acquire_lease(self, key: str, ttl: float) -> bool:
+        return True
+
+    def stats(self) -> dict:
+        return {'entries': len(self._entries)}
+
+
+class MongoCacheBackend(CacheBackend):
+    """
+    Backend shared by all workers through MongoDB. Expired entries and
+    leases are removed by TTL indexes.
+    """
+
+    name = 'mongo'
+    shared = True
+
+    def __init__(self):
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._index_task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._index_task is None:
+            self._index_task = asyncio.create_task(self._ensure_indexes())
+
+    async def _ensure_indexes(self):
+        try:
+            await db[SHARED_CACHE_COLLECTION].create_index('expires_at', expireAfterSeconds=0)
+            await db[SHARED_LEASE_COLLECTION].create_index('expires_at', expireAfterSeconds=0)
+        except Exception as e:
+            logger.error("Error preparing shared cache collections: %s", e)
+
+    async def get(self, key: str) -> Optional[Tuple[Any, float]]:
+        doc = await db[SHARED_CACHE_COLLECTION].find_one({'_id': key})
+        # The TTL monitor only runs once a minute; check expiry ourselves
+        if doc is None or doc['expires_at'].replace(tzinfo=timezone.utc) <= datetime.now(timezone.utc):
+            return None
+        return doc['value'], doc['stored_at']
+
+    async def set(self, key: str, value: Any, ttl: float):
+        now = datetime.now(timezone.utc)
+        await db[SHARED_CACHE_COLLECTION].replace_one(
+            {'_id': key},
+            {'_id': key, 'value': value, 'stored_at': now.timestamp(), 'expires_at': now + timedelta(seconds=ttl)},
+            upsert=True,
+        )
+
+    async def acquire_lease(self, key: str, ttl: float) -> bool:
+        now = datetime.now(timezone.utc)
+        try:
+            # Matches only a free (expired) lease or our own; an upsert
+            # against someone else's live lease hits the unique _id
+            await db[SHARED_LEASE_COLLECTION].update_one(
+                {'_id': key, '$or': [{'owner': self.worker_id}, {'expires_at': {'$lte': now}}]},
+                {'$set': {'owner': self.worker_id, 'expires_at': now + timedelta(seconds=ttl)}},
+                upsert=True,
+            )
+            return True
+        except DuplicateKeyError:
+            return False
+
+    def stats(self) -> dict:
+        return {'worker_id': self.worker_id}
+
+
+def create_cache_backend(name: str) -> CacheBackend:
+    if name == 'mongo':
+        return MongoCacheBackend()
+    if name != 'memory':
+        logger.warning("Unknown SHARED_CACHE_BACKEND '%s'; using memory", name)
+    return MemoryCacheBackend(SHARED_CACHE_MAX_ENTRIES)
+
+
+class SharedCache:
+    """
+    Load-through helpers on top of a CacheBackend.
+    """
+
+    def __init__(self, backend: CacheBackend, max_entries: int):
+        self.backend = backend
+        self.max_entries = max_entries
+        # Leases this worker holds: key -> local expiry (monotonic)
+        self._held_leases: "OrderedDict[str, float]" = OrderedDict()
+        # Decoded published values: key -> (stored_at, value)
+        self._decode_memo: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.leases_won = 0
+        self.leases_lost = 0
+        self.lease_renewals = 0
+        self.remote_results = 0
+        self.fallbacks = 0
+        self.errors = 0
+
+    def start(self):
+        self.backend.start()
+
+    async def stop(self):
+        await self.backend.stop()
+
+    async def cached_load(self, namespace: str, key: str, loader, ttl: float, stale_ttl: float = 0):
+        """
+        Return the cached value if younger than `ttl`; otherwise one worker
+        (the lease holder) calls `loader` and stores the result while the
+        others wait up to SHARED_CACHE_WAIT for it. None is not cached.
+        Without a shared backend the caller's in-process cache is the only
+        layer worth having, so `loader` is simply called.
+        """
+        if not self.backend.shared:
+            return await loader(key)
+
+        cache_key = f"{namespace}:{key}"
+        try:
+            cached = await self.backend.get(cache_key)
+            if cached is not None and time.time() - cached[1] < ttl:
+                self.hits += 1
+                return cached[0]
+            self.misses += 1
+
+            if not await self._acquire_lease(cache_key):
+                self.leases_lost += 1
+                fresh = await self._wait_for_refresh(cache_key, cached[1] if cached else 0)
+                if fresh is not None:
+                    self.remote_results += 1
+                    return fresh[0]
+            else:
+                self.leases_won += 1
+        except Exception as e:
+            self.errors += 1
+            logger.warning("Shared cache unavailable for %s: %s", cache_key, e)
+            return await loader(key)
+
+        value = await loader(key)
+        if value is not None:
+            await self._store(cache_key, value, ttl + stale_ttl)
+        return value
+
+    async def elected_load(self, namespace: str, key: str, loader, stale_ttl: float,
+                           fallback=None, encode=None, decode=None):
+        """
+        The lease holder calls `loader` and publishes the result; other
+        workers serve the published value (up to `stale_ttl` old) instead of
+        calling `loader` themselves. A worker that loses the lease before
+        anything is published waits up to SHARED_CACHE_WAIT for it, then
+        answers with `fallback`, which is never published. `encode` and
+        `decode` convert values to and from their stored form. Without a
+        shared backend there is no one to publish to, so `loader` is simply
+        called.
+        """
+        if not self.backend.shared:
+            return await loader(key)
+
+        cache_key = f"{namespace}:{key}"
+        try:
+            elected = await self._acquire_lease(cache_key)
+            cached = None
+            if not elected:
+                cached = await self.backend.get(cache_key) or await self._wait_for_refresh(cache_key, 0)
+        except Exception as e:
+            self.errors += 1
+            logger.warning("Shared cache unavailable for %s: %s", cache_key, e)
+            return await loader(key)
+
+        if not elected:
+            self.leases_lost += 1
+            if cached is not None:
+                self.remote_results += 1
+                return self._decoded(cache_key, cached, decode)
+            self.fallbacks += 1
+            return await (fallback or loader)(key)
+
+        self.leases_won += 1
+        value = await loader(key)
+        if value is not None:
+            await self._store(cache_key, encode(value) if encode else value, stale_ttl)
+        return value
+
+    def _decoded(self, cache_key: str, cached: Tuple[Any, float], decode) -> Any:
+        """
+        Decode a published value once per publication rather than on
+        every lookup that serves it.
+        """
+        if decode is None:
+            return cached[0]
+        stored_at = cached[1]
+        memo = self._decode_memo.get(cache_key)
+        if memo is not None and memo[0] == stored_at:
+            self._decode_memo.move_to_end(cache_key)
+            return memo[1]
+        value = decode(cached[0])
+        self._decode_memo[cache_key] = (stored_at, value)
+        self._decode_memo.move_to_end(cache_key)
+        while len(self._decode_memo) > self.max_entries:
+            self._decode_memo.popitem(last=False)
+        return value
+
+    async def _acquire_lease(self, cache_key: str) -> bool:
+        """
+        Take or renew the lease for `cache_key`. A lease this worker holds
+        is only renewed once less than half its TTL is left, so the lease
+        holder doesn't write to the backend on every lookup.
+        """
+        held_until = self._held_leases.get(cache_key)
+        if held_until is not None and time.monotonic() < held_until - SHARED_CACHE_LEASE_TTL / 2:
+            return True
+
+        requested_at = time.monotonic()
+        if not await self.backend.acquire_lease(cache_key, SHARED_CACHE_LEASE_TTL):
+            self._held_leases.pop(cache_key, None)
+            return False
+        if held_until is not None:
+            self.lease_renewals += 1
+        self._held_leases[cache_key] = requested_at + SHARED_CACHE_LEASE_TTL
+        self._held_leases.move_to_end(cache_key)
+        while len(self._held_leases) > self.max_entries:
+            self._held_leases.popitem(last=False)
+        return True
+
+    async def _wait_for_refresh(self, cache_key: str, older_than: float) -> Optional[Tuple[Any, float]]:
+        deadline = time.monotonic() + SHARED_CACHE_WAIT
+        while time.monotonic() < deadline:
+            await asyncio.sleep(SHARED_CACHE_POLL_INTERVAL)
+            cached = await self.backend.get(cache_key)
+            if cached is not None and cached[1] > older_than:
+                return cached
+        return None
+
+    async def _store(self, cache_key: str, value: Any, ttl: float):
+        try:
+            await self.backend.set(cache_key, value, ttl)
+        except Exception as e:
+            self.errors += 1
+            logger.warning("Shared cache write failed for %s: %s", cache_key, e)
+
+    def stats(self) -> dict:
+        return {
+            'backend': self.backend.name,
+            'shared': self.backend.shared,
+            **self.backend.stats(),
+            'hits': self.hits,
+            'misses': self.misses,
+            'leases_won': self.leases_won,
+            'leases_lost': self.leases_lost,
+            'lease_renewals': self.lease_renewals,
+            'held_leases': len(self._held_leases),
+            'remote_results': self.remote_results,
+            'fallbacks': self.fallbacks,
+            'errors': self.errors,
+        }
+
+
+shared_cache = SharedCache(create_cache_backend(SHARED_CACHE_BACKEND), SHARED_CACHE_MAX_ENTRIES)
+
+
+# ============== Station Info Cache ==============
+#
+# Station name, stream URLs, genres and tags almost never change, so lookups
+# are served from memory. Entries older than the TTL are still returned while
+# a background refresh fetches the new copy (stale-while-revalidate).
+
+STATION_CACHE_TTL = float(os.environ.get('STATION_CACHE_TTL', '600'))
+STATION_CACHE_STALE_TTL = float(os.environ.get('STATION_CACHE_STALE_TTL', '86400'))
+STATION_CACHE_MAX_ENTRIES = int(os.environ.get('STATION_CACHE_MAX_ENTRIES', '10000'))
+
+
+async def fetch_station_info(station_id: str) -> Optional[dict]:
+    """
+    Fetch a station document from the themegaradio catalog API.
+    Returns None if the station does not exist.
+    """
+    async with host_breakers.guard(CATALOG_API_BASE):
+        response = await catalog_requests.get(f"/api/station/{station_id}")
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.json()
+
+
+class StationInfoCache:
+    """
+    In-process LRU cache of station documents with a TTL and
+    stale-while-revalidate refresh.
+    """
+
+    def __init__(self, loader, ttl: float, stale_ttl: float, max_entries: int):
+        self._loader = loader
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, dict]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_failures = 0
+        self.evictions = 0
+
+    async def get(self, station_id: str) -> Optional[dict]:
+        entry = self._entries.get(station_id)
+        if entry is not None:
+            fetched_at, data = entry
+            age = time.monotonic() - fetched_at
+            if age < self.ttl:
+                self.hits += 1
+                self._entries.move_to_end(station_id)
+                return data
+            if age < self.ttl + self.stale_ttl:
+                self.stale_hits += 1
+                self._entries.move_to_end(station_id)
+                self._load(station_id)
+                return data
+            del self._entries[station_id]
+
+        self.misses += 1
+        # Concurrent misses for the same station share one upstream call
+        return await asyncio.shield(self._load(station_id))
+
+    def _load(self, station_id: str) -> asyncio.Task:
+        task = self._inflight.get(station_id)
+        if task is None:
+            task = asyncio.create_task(self._fetch(station_id))
+            self._inflight[station_id] = task
+            task.add_done_callback(lambda _: self._inflight.pop(station_id, None))
+        return task
+
+    async def _fetch(self, station_id: str) -> Optional[dict]:
+        refresh = station_id in self._entries
+        try:
+            data = await self._loader(station_id)
+        except Exception as e:
+            if not refresh:
+                raise
+            # Keep serving the stale copy until the next refresh attempt
+            self.refresh_failures += 1
+            logger.warning("Station info refresh failed for %s: %s", station_id, e)
+            return self._entries[station_id][1] if station_id in self._entries else None
+
+        if refresh:
+            self.refreshes += 1
+        if data is None:
+            self._entries.pop(station_id, None)
+            return None
+
+        self._entries[station_id] = (time.monotonic(), data)
+        self._entries.move_to_end(station_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return data
+
+    def recent(self, limit: int) -> List[Tuple[str, dict]]:
+        """
+        The most recently used cached stations, newest first.
+        """
+        items = []
+        for station_id in reversed(self._entries):
+            items.append((station_id, self._entries[station_id][1]))
+            if len(items) >= limit:
+                break
+        return items
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'max_entries': self.max_entries,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+            'hit_ratio': round((self.hits + self.stale_hits) / lookups, 3) if lookups else None,
+            'refreshes': self.refreshes,
+            'refresh_failures': self.refresh_failures,
+            'evictions': self.evictions,
+            'inflight': len(self._inflight),
+        }
+
+
+async def load_station_info(station_id: str) -> Optional[dict]:
+    return await shared_cache.cached_load('station', station_id, fetch_station_info, STATION_CACHE_TTL, STATION_CACHE_STALE_TTL)
+
+
+station_cache = StationInfoCache(
+    load_station_info,
+    ttl=STATION_CACHE_TTL,
+    stale_ttl=STATION_CACHE_STALE_TTL,
+    max_entries=STATION_CACHE_MAX_ENTRIES,
+)
+
+
+# ============== Playlist Resolution ==============
+#
+# Many catalog URLs point at .pls/.m3u/.asx playlists rather than audio. The
+# resolver detects playlist responses by content type, extension or body,
+# follows them to the real stream and caches the final URL and redirect
+# chain per station, so later probes go straight to the audio endpoint.
+
+PLAYLIST_CACHE_TTL = float(os.environ.get('PLAYLIST_CACHE_TTL', '3600'))
+PLAYLIST_FAILURE_TTL = float(os.environ.get('PLAYLIST_FAILURE_TTL', '120'))
+PLAYLIST_CACHE_MAX_ENTRIES = int(os.environ.get('PLAYLIST_CACHE_MAX_ENTRIES', '10000'))
+PLAYLIST_MAX_BYTES = 64 * 1024
+PLAYLIST_MAX_DEPTH = 3
+
+PLAYLIST_CONTENT_TYPES = {
+    'audio/x-scpls': 'pls',
+    'application/pls+xml': 'pls',
+    'audio/x-mpegurl': 'm3u',
+    'audio/mpegurl': 'm3u',
+    'application/vnd.apple.mpegurl': 'hls',
+    'application/x-mpegurl': 'hls',
+    'video/x-ms-asf': 'asx',
+    'video/x-ms-asx': 'asx',
+    'audio/x-ms-wax': 'asx',
+}
+PLAYLIST_EXTENSIONS = {
+    '.pls': 'pls',
+    '.m3u': 'm3u',
+    '.m3u8': 'hls',
+    '.asx': 'asx',
+}
+PLAYLIST_PLS_ENTRY = re.compile(r'^\s*File\d+\s*=\s*(\S+)', re.IGNORECASE | re.MULTILINE)
+PLAYLIST_ASX_ENTRY = re.compile(r'<ref\s+href\s*=\s*"([^"]+)"', re.IGNORECASE)
+
+
+def detect_playlist_type(url: str, content_type: str, head: bytes = b'') -> Optional[str]:
+    """
+    Classify a response as a playlist ('pls', 'm3u', 'hls', 'asx') or
+    None for a direct audio stream. The body wins over the content type,
+    and the URL extension is only trusted for untyped or text responses.
+    """
+    sniff = head[:1024].lstrip().lower()
+    if sniff.startswith(b'[playlist]'):
+        return 'pls'
+    if sniff.startswith(b'#extm3u'):
+        return 'hls' if b'#ext-x-' in head.lower() else 'm3u'
+    if sniff.startswith(b'<asx'):
+        return 'asx'
+
+    mime = content_type.split(';')[0].strip().lower()
+    if mime in PLAYLIST_CONTENT_TYPES:
+        return PLAYLIST_CONTENT_TYPES[mime]
+    if mime.startswith(('audio/', 'video/')):
+        return None
+
+    path = httpx.URL(url).path.lower()
+    return next((kind for ext, kind in PLAYLIST_EXTENSIONS.items() if path.endswith(ext)), None)
+
+
+def parse_playlist(kind: str, text: str, base_url: str) -> List[str]:
+    """
+    Extract stream URLs from a .pls, .m3u or .asx playlist body.
+    """
+    entries = []
+    if kind == 'pls':
+        entries = PLAYLIST_PLS_ENTRY.findall(text)
+    elif kind == 'asx':
+        entries = PLAYLIST_ASX_ENTRY.findall(text)
+    if not entries:
+        # Plain URL-per-line lists, including mislabelled .pls files
+        entries = [
+            line.strip() for line in text.splitlines()
+            if line.strip() and not line.strip().startswith('#')
+        ]
+    base = httpx.URL(base_url)
+    return list(dict.fromkeys(str(base.join(entry)) for entry in entries))
+
+
+class PlaylistResolver:
+    """
+    Follows playlist URLs to the real stream and caches the result
+    per station for PLAYLIST_CACHE_TTL seconds.
+    """
+
+    def __init__(self, ttl: float, failure_ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.failure_ttl = failure_ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, dict]]" = OrderedDict()
+        self._flights = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+        self.playlists = 0
+        self.failures = 0
+
+    async def resolve(self, station_id: str, stream_url: str) -> dict:
+        """
+        Returns {'url', 'source_url', 'playlist_type', 'chain', 'entries'};
+        'url' is the audio endpoint to connect to ('direct' streams resolve
+        to themselves after redirects).
+        """
+        entry = self._entries.get(station_id)
+        if entry is not None:
+            expires_at, resolved = entry
+            if resolved['source_url'] == stream_url and time.monotonic() < expires_at:
+                self.hits += 1
+                self._entries.move_to_end(station_id)
+                return resolved
+
+        self.misses += 1
+        return await self._flights.run(station_id, self._resolve_and_store, station_id, stream_url)
+
+    async def _resolve_and_store(self, station_id: str, stream_url: str) -> dict:
+        try:
+            resolved = await self._resolve(stream_url)
+            ttl = self.ttl
+        except Exception as e:
+            logger.debug("Playlist resolution failed for %s: %s", stream_url, e)
+            self.failures += 1
+            resolved = {
+                'url': stream_url,
+                'source_url': stream_url,
+                'playlist_type': detect_playlist_type(stream_url, '') or 'direct',
+                'chain': [stream_url],
+                'entries': [],
+            }
+            ttl = self.failure_ttl
+
+        self._entries[station_id] = (time.monotonic() + ttl, resolved)
+        self._entries.move_to_end(station_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return resolved
+
+    async def _resolve(self, stream_url: str) -> dict:
+        url = stream_url
+        chain: List[str] = []
+        entries: List[str] = []
+        playlist_type = 'direct'
+
+        for _ in range(PLAYLIST_MAX_DEPTH):
+            async with host_breakers.guard(url), http_pools.host_slot(url, HOST_SLOT_WAIT):
+                async with http_pools.streams.stream(
+                    'GET',
+                    url,
+                    headers={'User-Agent': ICY_REQUEST_HEADERS['User-Agent']},
+                ) as response:
+                    chain.extend(str(r.url) for r in response.history)
+                    final_url = str(response.url)
+                    chain.append(final_url)
+                    response.raise_for_status()
+
+                    content_type = response.headers.get('content-type', '')
+                    kind = detect_playlist_type(final_url, content_type)
+                    if kind is None and content_type.lower().startswith('audio/'):
+                        return self._result(stream_url, final_url, playlist_type, chain, entries)
+
+                    # Read the whole playlist, or just the first chunk of an
+                    # untyped response to sniff it
+                    body = bytearray()
+                    async for chunk in response.aiter_bytes():
+                        body += chunk
+                        if kind is None or len(body) >= PLAYLIST_MAX_BYTES:
+                            break
+                    kind = detect_playlist_type(final_url, content_type, bytes(body))
+
+            if kind is None:
+                return self._result(stream_url, final_url, playlist_type, chain, entries)
+            if kind == 'hls':
+                # HLS playlists are the stream itself; they have no ICY data
+                return self._result(stream_url, final_url, 'hls', chain, entries)
+
+            self.playlists += 1
+            if playlist_type == 'direct':
+                playlist_type = kind
+            entries = parse_playlist(kind, body[:PLAYLIST_MAX_BYTES].decode('utf-8', errors='ignore'), final_url)
+            if not entries:
+                raise ValueError(f"Empty {kind} playlist at {final_url}")
+            url = entries[0]
+
+        raise ValueError(f"Playlist nesting deeper than {PLAYLIST_MAX_DEPTH} at {stream_url}")
+
+    @staticmethod
+    def _result(source_url: str, url: str, playlist_type: str, chain: List[str], entries: List[str]) -> dict:
+        return {
+            'url': url,
+            'source_url': source_url,
+            'playlist_type': playlist_type,
+            'chain': chain,
+            'entries': entries,
+        }
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'playlists': self.playlists,
+            'failures': self.failures,
+        }
+
+
+playlist_resolver = PlaylistResolver(PLAYLIST_CACHE_TTL, PLAYLIST_FAILURE_TTL, PLAYLIST_CACHE_MAX_ENTRIES)
+
+
+# ============== HLS Timed Metadata ==============
+#
+# HLS stations carry no icy-metaint; their titles live in ID3 frames inside
+# segments (TIT2/TPE1) or in #EXTINF titles. Only the newest segment is
+# downloaded, and only when the media sequence has moved on, and only up to
+# the end of its ID3 tag. Playlists are not re-fetched more often than their
+# target duration. Stations whose segments keep coming back without tags are
+# backed off so their audio is not downloaded on every poll.
+
+HLS_SEGMENT_MAX_BYTES = int(os.environ.get('HLS_SEGMENT_MAX_BYTES', str(4 * 1024 * 1024)))
+HLS_PLAYLIST_MAX_BYTES = 256 * 1024
+HLS_STATE_MAX_ENTRIES = int(os.environ.get('HLS_STATE_MAX_ENTRIES', '5000'))
+HLS_MIN_REFRESH = 2.0
+HLS_UNTAGGED_SEGMENT_LIMIT = int(os.environ.get('HLS_UNTAGGED_SEGMENT_LIMIT', '3'))
+HLS_UNTAGGED_BASE_BACKOFF = float(os.environ.get('HLS_UNTAGGED_BASE_BACKOFF', '300'))
+HLS_UNTAGGED_MAX_BACKOFF = float(os.environ.get('HLS_UNTAGGED_MAX_BACKOFF', '3600'))
+
+HLS_ATTRIBUTE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+HLS_EXTINF_ATTRIBUTE = re.compile(r'(\w+)="([^"]*)"')
+ID3_TEXT_ENCODINGS = {0: 'latin-1', 1: 'utf-16', 2: 'utf-16-be', 3: 'utf-8'}
+TS_PACKET_SIZE = 188
+
+
+def parse_m3u8(text: str, base_url: str) -> dict:
+    """
+    Parse an HLS master or media playlist into variants, segments
+    (url, #EXTINF title) and sequence information.
+    """
+    base = httpx.URL(base_url)
+    playlist = {'variants': [], 'segments': [], 'media_sequence': 0, 'target_duration': None}
+    pending_bandwidth = None
+    pending_title = None
+
+    for raw_line in text.splitlines():
+        line = raw_line.strip()
+        if not line:
+            continue
+        if line.startswith('#EXT-X-STREAM-INF:'):
+            attributes = dict(HLS_ATTRIBUTE.findall(line.split(':', 1)[1]))
+            bandwidth = attributes.get('BANDWIDTH', '0')
+            pending_bandwidth = int(bandwidth) if bandwidth.isdigit() else 0
+        elif line.startswith('#EXT-X-MEDIA-SEQUENCE:'):
+            value = line.split(':', 1)[1].strip()
+            playlist['media_sequence'] = int(value) if value.isdigit() else 0
+        elif line.startswith('#EXT-X-TARGETDURATION:'):
+            try:
+                playlist['target_duration'] = float(line.split(':', 1)[1])
+            except ValueError:
+                pass
+        elif line.startswith('#EXTINF:'):
+            pending_title = line.split(',', 1)[1].strip() if ',' in line else ''
+        elif not line.startswith('#'):
+            url = str(base.join(line))
+            if pending_bandwidth is not None:
+                playlist['variants'].append((pending_bandwidth, url))
+                pending_bandwidth = None
+            else:
+                playlist['segments'].append((url, pending_title or ''))
+                pending_title = None
+
+    return playlist
+
+
+def parse_hls_extinf_title(title: str) -> Optional[dict]:
+    """
+    Turn an #EXTINF title into title info. Supports both plain
+    "Artist - Song" and title="...",artist="..." attribute forms.
+    """
+    attributes = dict(HLS_EXTINF_ATTRIBUTE.findall(title))
+    if attributes.get('title'):
+        artist = attributes.get('artist', '').strip()
+        song = attributes['title'].strip()
+        return build_title_info(artist, song)
+    if title and '=' not in title:
+        return parse_stream_title_text(title)
+    return None
+
+
+def build_title_info(artist: str, song: str) -> Optional[dict]:
+    if artist and song:
+        return {'artist': artist, 'song': song, 'title': f"{artist} - {song}"}
+    if song or artist:
+        return {'title': song or artist}
+    return None
+
+
+def decode_id3_text(frame: bytes) -> str:
+    if not frame:
+        return ''
+    encoding = ID3_TEXT_ENCODINGS.get(frame[0], 'latin-1')
+    return frame[1:].decode(encoding, errors='ignore').replace('\0', ' ').strip()
+
+
+def syncsafe_int(data: bytes) -> int:
+    # ID3 sizes use 7 bits per byte
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+def parse_id3_tags(data: bytes) -> Dict[str, str]:
+    """
+    Collect TIT2/TPE1/TALB text frames from every ID3v2.3/2.4 tag in `data`.
+    """
+    frames: Dict[str, str] = {}
+    pos = data.find(b'ID3')
+    while pos != -1 and pos + 10 <= len(data):
+        version = data[pos + 3]
+        flags = data[pos + 5]
+        size_bytes = data[pos + 6:pos + 10]
+        if version not in (3, 4) or any(b & 0x80 for b in size_bytes):
+            pos = data.find(b'ID3', pos + 3)
+            continue
+
+        size = syncsafe_int(size_bytes)
+        body = data[pos + 10:pos + 10 + size]
+        offset = 0
+        if flags & 0x40 and len(body) >= 4:
+            # Skip the extended header
+            offset = int.from_bytes(body[:4], 'big')
+            if version == 3:
+                offset += 4
+
+        while offset + 10 <= len(body):
+            frame_id = body[offset:offset + 4]
+            if not frame_id.strip(b'\0'):
+                break
+            raw_size = body[offset + 4:offset + 8]
+            if version == 4:
+                frame_size = syncsafe_int(raw_size)
+            else:
+                frame_size = int.from_bytes(raw_size, 'big')
+            if offset + 10 + frame_size > len(body):
+                # Truncated tag: don't report a cut-off text frame
+                break
+            frame = body[offset + 10:offset + 10 + frame_size]
+            if frame_id in (b'TIT2', b'TPE1', b'TALB'):
+                text = decode_id3_text(frame)
+                if text:
+                    frames[frame_id.decode()] = text
+            offset += 10 + frame_size
+
+        pos = data.find(b'ID3', pos + 10 + size)
+    return frames
+
+
+def demux_ts_payloads(data: bytes) -> List[bytes]:
+    """
+    Reassemble the payload of each PID in an MPEG-TS segment so ID3 tags
+    split across 188-byte packets can be found.
+    """
+    payloads: Dict[int, bytearray] = {}
+    view = memoryview(data)
+    for start in range(0, len(data) - TS_PACKET_SIZE + 1, TS_PACKET_SIZE):
+        packet = view[start:start + TS_PACKET_SIZE]
+        if packet[0] != 0x47:
+            break
+        pid = ((packet[1] & 0x1f) << 8) | packet[2]
+        adaptation = (packet[3] >> 4) & 0x3
+        offset = 4
+        if adaptation & 0x2:
+            offset += 1 + packet[4]
+        if adaptation & 0x1 and offset < TS_PACKET_SIZE:
+            payloads.setdefault(pid, bytearray()).extend(packet[offset:])
+    return [bytes(payload) for payload in payloads.values()]
+
+
+def segment_tag_complete(segment: bytes) -> bool:
+    """
+    Whether a (possibly partial) segment already holds a whole ID3 tag.
+    """
+    payloads = demux_ts_payloads(segment) if segment[:1] == b'\x47' else [segment]
+    for payload in payloads:
+        pos = payload.find(b'ID3')
+        if pos != -1 and pos + 10 <= len(payload):
+            if pos + 10 + syncsafe_int(payload[pos + 6:pos + 10]) <= len(payload):
+                return True
+    return False
+
+
+def extract_segment_tags(segment: bytes) -> Dict[str, str]:
+    if segment[:1] == b'\x47':
+        frames: Dict[str, str] = {}
+        for payload in demux_ts_payloads(segment):
+            frames.update(parse_id3_tags(payload))
+        return frames
+    # Packed audio (AAC/MP3 segments) starts with its ID3 tag
+    return parse_id3_tags(segment)
+
+
+class HlsMetadataReader:
+    """
+    Reads song titles for HLS stations, remembering per playlist the chosen
+    variant, the last media sequence seen and the title it carried.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._states: "OrderedDict[str, dict]" = OrderedDict()
+        self._flights = SingleFlight()
+        self.playlist_fetches = 0
+        self.not_modified = 0
+        self.unchanged = 0
+        self.segment_downloads = 0
+        self.segment_bytes = 0
+        self.untagged_skips = 0
+        self.extinf_titles = 0
+        self.id3_titles = 0
+
+    async def get_title(self, playlist_url: str) -> Optional[dict]:
+        state = self._states.get(playlist_url)
+        if state is not None:
+            self._states.move_to_end(playlist_url)
+            if time.monotonic() < state['next_refresh_at']:
+                return state['title_info']
+        try:
+            return await self._flights.run(playlist_url, self._refresh, playlist_url)
+        except HostUnavailableError as e:
+            logger.debug("HLS metadata skipped for %s: %s", playlist_url, e)
+        except Exception as e:
+            logger.debug("HLS metadata fetch failed for %s: %s", playlist_url, e)
+        return state['title_info'] if state else None
+
+    async def _refresh(self, playlist_url: str) -> Optional[dict]:
+        state = self._states.get(playlist_url)
+        if state is None:
+            state = {
+                'media_url': None,
+                'etag': None,
+                'last_modified': None,
+                'sequence': None,
+                'title_info': None,
+                'next_refresh_at': 0.0,
+                'untagged': 0,
+                'segments_retry_at': 0.0,
+            }
+            self._states[playlist_url] = state
+            while len(self._states) > self.max_entries:
+                self._states.popitem(last=False)
+
+        media_url = state['media_url'] or playlist_url
+        playlist = await self._fetch_playlist(media_url, state)
+        if playlist is None:
+            # 304 Not Modified: same segments, same title
+            self.not_modified += 1
+            return state['title_info']
+
+        if playlist['variants']:
+            # Master playlist: follow the lowest-bandwidth variant, whose
+            # segments are the cheapest to download
+            media_url = min(playlist['variants'])[1]
+            state['media_url'] = media_url
+            state['etag'] = state['last_modified'] = None
+            playlist = await self._fetch_playlist(media_url, state) or {'segments': []}
+
+        state['next_refresh_at'] = time.monotonic() + max(playlist.get('target_duration') or 0, HLS_MIN_REFRESH)
+        if not playlist['segments']:
+            return state['title_info']
+
+        sequence = playlist['media_sequence'] + len(playlist['segments']) - 1
+        if sequence == state['sequence']:
+            self.unchanged += 1
+            return state['title_info']
+
+        segment_url, extinf_title = playlist['segments'][-1]
+        title_info = parse_hls_extinf_title(extinf_title)
+        if title_info:
+            self.extinf_titles += 1
+        elif time.monotonic() < state['segments_retry_at']:
+            # Recent segments carried no tags; don't download audio for nothing
+            self.untagged_skips += 1
+        else:
+            tags = extract_segment_tags(await self._fetch_segment(segment_url))
+            title_info = build_title_info(tags.get('TPE1', ''), tags.get('TIT2', ''))
+            if title_info:
+                self.id3_titles += 1
+                if tags.get('TALB'):
+                    title_info['album'] = tags['TALB']
+            else:
+                self._record_untagged(state)
+        # Only now: a failed segment download is retried on the next refresh
+        state['sequence'] = sequence
+
+        if title_info:
+            state['untagged'] = 0
+            state['title_info'] = title_info
+        return state['title_info']
+
+    def _record_untagged(self, state: dict):
+        state['untagged'] += 1
+        excess = state['untagged'] - HLS_UNTAGGED_SEGMENT_LIMIT
+        if excess >= 0:
+            backoff = min(HLS_UNTAGGED_BASE_BACKOFF * 2 ** excess, HLS_UNTAGGED_MAX_BACKOFF)
+            state['segments_retry_at'] = time.monotonic() + backoff
+
+    async def _fetch_playlist(self, url: str, state: dict) -> Optional[dict]:
+        headers = {'User-Agent': ICY_REQUEST_HEADERS['User-Agent']}
+        if state['etag']:
+            headers['If-None-Match'] = state['etag']
+        if state['last_modified']:
+            headers['If-Modified-Since'] = state['last_modified']
+
+        self.playlist_fetches += 1
+        async with host_breakers.guard(url), http_pools.host_slot(url, HOST_SLOT_WAIT):
+            response = await http_pools.streams.get(url, headers=headers)
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
+
+        state['etag'] = response.headers.get('etag')
+        state['last_modified'] = response.headers.get('last-modified')
+        return parse_m3u8(response.text[:HLS_PLAYLIST_MAX_BYTES], str(response.url))
+
+    async def _fetch_segment(self, url: str) -> bytes:
+        """
+        Download a segment only as far as its ID3 tag: packed audio carries
+        it at the very start and MPEG-TS in its first PES packets.
+        """
+        self.segment_downloads += 1
+        body = bytearray()
+        tagged = False
+        async with host_breakers.guard(url), http_pools.host_slot(url, HOST_SLOT_WAIT):
+            async with http_pools.streams.stream('GET', url, headers={'User-Agent': ICY_REQUEST_HEADERS['User-Agent']}) as response:
+                response.raise_for_status()
+                async for chunk in response.aiter_bytes():
+                    scanned = max(len(body) - 2, 0)
+                    body += chunk
+                    if len(body) >= HLS_SEGMENT_MAX_BYTES:
+                        break
+                    if body[:1] != b'\x47' and len(body) >= 3 and body[:3] != b'ID3':
+                        # Packed audio without a leading tag has no tag at all
+                        break
+                    tagged = tagged or body.find(b'ID3', scanned) != -1
+                    if tagged and segment_tag_complete(bytes(body)):
+                        break
+        self.segment_bytes += len(body)
+        return bytes(body)
+
+    def stats(self) -> dict:
+        return {
+            'playlists': len(self._states),
+            'playlist_fetches': self.playlist_fetches,
+            'not_modified': self.not_modified,
+            'unchanged': self.unchanged,
+            'segment_downloads': self.segment_downloads,
+            'segment_bytes': self.segment_bytes,
+            'untagged_skips': self.untagged_skips,
+            'extinf_titles': self.extinf_titles,
+            'id3_titles': self.id3_titles,
+        }
+
+
+hls_metadata = HlsMetadataReader(HLS_STATE_MAX_ENTRIES)
+
+
+# ============== ICY Capability Cache ==============
+#
+# Remembers stream URLs that offer no ICY titles (no icy-metaint, only empty
+# metadata blocks, or persistent connection failures) so now-playing serves
+# the genre fallback without connecting. Entries expire with exponential
+# back-off, after which the stream is probed again.
+
+ICY_NEGATIVE_BASE_TTL = float(os.environ.get('ICY_NEGATIVE_BASE_TTL', '300'))
+ICY_NEGATIVE_MAX_TTL = float(os.environ.get('ICY_NEGATIVE_MAX_TTL', '21600'))
+ICY_NEGATIVE_MAX_ENTRIES = int(os.environ.get('ICY_NEGATIVE_MAX_ENTRIES', '50000'))
+ICY_NEGATIVE_ERROR_THRESHOLD = int(os.environ.get('ICY_NEGATIVE_ERROR_THRESHOLD', '3'))
+
+
+class IcyCapabilityCache:
+    """
+    Negative cache of stream URLs without usable ICY metadata.
+    """
+
+    def __init__(self, base_ttl: float, max_ttl: float, max_entries: int, error_threshold: int):
+        self.base_ttl = base_ttl
+        self.max_ttl = max_ttl
+        self.max_entries = max_entries
+        self.error_threshold = error_threshold
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()
+        # Consecutive connection failures of URLs not (yet) negative-cached
+        self._errors: "OrderedDict[str, int]" = OrderedDict()
+        self.skipped = 0
+        self.reprobes = 0
+
+    def should_probe(self, stream_url: str) -> bool:
+        entry = self._entries.get(stream_url)
+        if entry is None:
+            return True
+        if time.monotonic() >= entry['retry_at']:
+            self.reprobes += 1
+            # Push retry_at forward so only one caller re-probes at a time
+            entry['retry_at'] = time.monotonic() + self.base_ttl
+            return True
+        self.skipped += 1
+        return False
+
+    def record_unsupported(self, stream_url: str, reason: str):
+        entry = self._entries.pop(stream_url, None) or {'failures': 0}
+        entry['failures'] += 1
+        entry['reason'] = reason
+        backoff = min(self.base_ttl * 2 ** (entry['failures'] - 1), self.max_ttl)
+        entry['retry_at'] = time.monotonic() + backoff
+        self._entries[stream_url] = entry
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def record_error(self, stream_url: str):
+        """
+        Count a failed probe. A single failure may be transient, so the URL
+        is only cached once `error_threshold` probes in a row have failed.
+        """
+        errors = self._errors.pop(stream_url, 0) + 1
+        if errors >= self.error_threshold:
+            self.record_unsupported(stream_url, 'error')
+            return
+        self._errors[stream_url] = errors
+        while len(self._errors) > self.max_entries:
+            self._errors.popitem(last=False)
+
+    def record_supported(self, stream_url: str):
+        self._entries.pop(stream_url, None)
+        self._errors.pop(stream_url, None)
+
+    def stats(self) -> dict:
+        reasons: Dict[str, int] = {}
+        for entry in self._entries.values():
+            reasons[entry['reason']] = reasons.get(entry['reason'], 0) + 1
+        return {
+            'entries': len(self._entries),
+            'reasons': reasons,
+            'pending_errors': len(self._errors),
+            'skipped': self.skipped,
+            'reprobes': self.reprobes,
+        }
+
+
+icy_capabilities = IcyCapabilityCache(
+    ICY_NEGATIVE_BASE_TTL, ICY_NEGATIVE_MAX_TTL, ICY_NEGATIVE_MAX_ENTRIES, ICY_NEGATIVE_ERROR_THRESHOLD,
+)
+
+
+# ============== ICY Metadata Monitors ==============
+#
+# One long-lived ICY connection per actively requested station. Each monitor
+# parses metadata blocks as the broadcaster sends them, so now-playing requests
+# are answered from memory instead of opening a new stream every poll.
+
+ICY_MONITOR_IDLE_SECONDS = float(os.environ.get('ICY_MONITOR_IDLE_SECONDS', '120'))
+ICY_MONITOR_MAX_STATIONS = int(os.environ.get('ICY_MONITOR_MAX_STATIONS', '500'))
+ICY_MONITOR_FIRST_TITLE_WAIT = float(os.environ.get('ICY_MONITOR_FIRST_TITLE_WAIT', '5'))
+ICY_MONITOR_RECONNECT_DELAY = float(os.environ.get('ICY_MONITOR_RECONNECT_DELAY', '5'))
+ICY_MONITOR_MAX_RECONNECT_DELAY = 300.0
+ICY_MONITOR_REAP_INTERVAL = 15.0
+ICY_MONITOR_TIMEOUT = httpx.Timeout(10.0, read=30.0)
+ICY_MONITOR_MAX_FAILURES = 3
+
+
+class IcyStationMonitor:
+    """
+    Keeps a single ICY connection open for one station and remembers
+    the most recent StreamTitle it has seen.
+    """
+
+    def __init__(self, station_id: str, stream_url: str):
+        self.station_id = station_id
+        self.stream_url = stream_url
+        self.title_info: Optional[dict] = None
+        self.metadata: Dict[str, str] = {}
+        self.supported: Optional[bool] = None
+        self.connected = False
+        self.metadata_blocks = 0
+        self.reconnects = 0
+        self.last_requested = time.monotonic()
+        self.updated_at: Optional[float] = None
+        self._first_result = asyncio.Event()
+        self._changed = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def touch(self):
+        self.last_requested = time.monotonic()
+
+    async def wait_for_title(self, timeout: float) -> Optional[dict]:
+        """
+        Return the current title, waiting up to `timeout` seconds for the
+        first metadata block when the monitor has only just started.
+        """
+        if not self._first_result.is_set():
+            try:
+                await asyncio.wait_for(self._first_result.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.title_info
+
+    async def _run(self):
+        delay = ICY_MONITOR_RECONNECT_DELAY
+        failures = 0
+        while True:
+            try:
+                await self._consume()
+                delay = ICY_MONITOR_RECONNECT_DELAY
+                failures = 0
+            except asyncio.CancelledError:
+                raise
+            except UnsafeUpstreamError as e:
+                # Not a passing condition: retrying won't make it public
+                logger.info("ICY monitor for %s refused: %s", self.station_id, e)
+                self.supported = False
+                icy_capabilities.record_unsupported(self.stream_url, 'unsafe_address')
+            except HostUnavailableError as e:
+                # Host is tripped; wait it out without blaming the station,
+                # but back off so a long outage isn't polled at the base rate
+                logger.debug("ICY monitor for %s waiting: %s", self.station_id, e)
+                delay = min(delay * 2, ICY_MONITOR_MAX_RECONNECT_DELAY)
+            except Exception as e:
+                logger.debug("ICY monitor for %s disconnected: %s", self.station_id, e)
+                delay = min(delay * 2, ICY_MONITOR_MAX_RECONNECT_DELAY)
+                failures += 1
+                if failures >= ICY_MONITOR_MAX_FAILURES:
+                    self.supported = False
+                    icy_capabilities.record_unsupported(self.stream_url, 'error')
+            finally:
+                self.connected = False
+
+            # A dead connection means the last title can no longer be trusted
+            if self.title_info is not None:
+                self.title_info = None
+                self._notify_change()
+            self._first_result.set()
+
+            if self.supported is False:
+                logger.info("ICY monitor for %s stopped: no usable ICY metadata", self.station_id)
+                return
+
+            self.reconnects += 1
+            await asyncio.sleep(delay)
+
+    async def _consume(self):
+        request = http_pools.streams.build_request(
+            'GET',
+            self.stream_url,
+            headers=ICY_REQUEST_HEADERS,
+            timeout=ICY_MONITOR_TIMEOUT,
+        )
+        # Only the connect counts toward the host's breaker; a long-lived
+        # stream that drops later says nothing about the host's health
+        async with host_breakers.guard(self.stream_url):
+            response = await http_pools.streams.send(request, stream=True)
+        try:
+            if response.status_code != 200:
+                # Counted as a connection failure by _run, not as "no ICY"
+                raise httpx.HTTPStatusError(
+                    f"HTTP {response.status_code}", request=request, response=response,
+                )
+            metaint = icy_metaint(response)
+            if not metaint:
+                self.supported = False
+                icy_capabilities.record_unsupported(self.stream_url, 'no_metaint')
+                return
+
+            self.supported = True
+            self.connected = True
+
+            parser = IcyMetadataParser(metaint)
+            titled = False
+            async for chunk in response.aiter_bytes():
+                for block in parser.feed(chunk):
+                    if block:
+                        titled = self._on_metadata(block) or titled
+                if titled:
+                    continue
+                if parser.blocks >= ICY_EMPTY_BLOCK_LIMIT:
+                    # Servers send the current title in the first block
+                    # after connect; all-empty blocks mean no titles at all
+                    self.supported = False
+                    icy_capabilities.record_unsupported(self.stream_url, 'empty_metadata')
+                    return
+                if parser.blocks:
+                    icy_capabilities.record_supported(self.stream_url)
+        finally:
+            await response.aclose()
+
+    def _on_metadata(self, metadata: bytes) -> bool:
+        self.metadata_blocks += 1
+        self.metadata, title_info = title_normalizer.parse(self.station_id, metadata)
+        if title_info and title_info != self.title_info:
+            logger.debug("ICY title for %s: %s", self.station_id, title_info.get('title'))
+            self.title_info = title_info
+            self._notify_change()
+            track_history.record(self.station_id, title_info, 'icy')
+        # A suppressed (junk/ad) title still shows the station sends titles
+        titled = bool(self.metadata.get('StreamTitle', '').strip())
+        if titled:
+            self.updated_at = time.monotonic()
+            self._first_result.set()
+        return titled
+
+    def _notify_change(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait_for_change(self, timeout: float) -> bool:
+        """
+        Wait until the title changes. Returns False on timeout.
+        """
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def stats(self) -> dict:
+        return {
+            'station_id': self.station_id,
+            'stream_url': self.stream_url,
+            'connected': self.connected,
+            'supported': self.supported,
+            'title': (self.title_info or {}).get('title'),
+            'metadata': self.metadata,
+            'metadata_blocks': self.metadata_blocks,
+            'reconnects': self.reconnects,
+            'idle_seconds': round(time.monotonic() - self.last_requested, 1),
+        }
+
+
+class IcyMonitorRegistry:
+    """
+    Owns the per-station monitors: starts them on first request and shuts
+    down the ones nobody has asked about for `idle_seconds`.
+    """
+
+    def __init__(self, idle_seconds: float, max_stations: int):
+        self.idle_seconds = idle_seconds
+        self.max_stations = max_stations
+        self._monitors: Dict[str, IcyStationMonitor] = {}
+        self._reaper: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._reaper is None:
+            self._reaper = asyncio.create_task(self._reap_loop())
+
+    async def stop(self):
+        if self._reaper:
+            self._reaper.cancel()
+            self._reaper = None
+        monitors = list(self._monitors.values())
+        self._monitors.clear()
+        await asyncio.gather(*(m.stop() for m in monitors), return_exceptions=True)
+
+    def acquire(self, station_id: str, stream_url: str) -> Optional[IcyStationMonitor]:
+        """
+        Get the running monitor for a station, starting one if needed.
+        Returns None once the registry is at capacity.
+        """
+        monitor = self._monitors.get(station_id)
+        if monitor and (monitor.stream_url != stream_url or not monitor.running):
+            # Stream URL changed, or a monitor that gave up is due a re-probe
+            asyncio.create_task(monitor.stop())
+            del self._monitors[station_id]
+            monitor = None
+
+        if monitor is None:
+            if len(self._monitors) >= self.max_stations:
+                return None
+            monitor = IcyStationMonitor(station_id, stream_url)
+            monitor.start()
+            self._monitors[station_id] = monitor
+
+        monitor.touch()
+        return monitor
+
+    def get(self, station_id: str) -> Optional[IcyStationMonitor]:
+        return self._monitors.get(station_id)
+
+    async def get_title(self, station_id: str, stream_url: str) -> Optional[dict]:
+        if not icy_capabilities.should_probe(stream_url):
+            # Known to have no ICY titles; serve the fallback without connecting
+            return None
+        monitor = self.acquire(station_id, stream_url)
+        if monitor is None:
+            # Over capacity: fall back to a one-shot probe
+            return await fetch_icy_stream_title(stream_url, station_id)
+        if monitor.supported is False:
+            return None
+        return await monitor.wait_for_title(ICY_MONITOR_FIRST_TITLE_WAIT)
+
+    async def _reap_loop(self):
+        while True:
+            await asyncio.sleep(ICY_MONITOR_REAP_INTERVAL)
+            now = time.monotonic()
+            idle = [
+                station_id for station_id, m in self._monitors.items()
+                if now - m.last_requested > self.idle_seconds
+            ]
+            for station_id in idle:
+                monitor = self._monitors.pop(station_id)
+                logger.info("Stopping idle ICY monitor for %s", station_id)
+                await monitor.stop()
+
+    def stats(self) -> dict:
+        return {
+            'active': len(self._monitors),
+            'connected': sum(1 for m in self._monitors.values() if m.connected),
+            'max_stations': self.max_stations,
+            'idle_seconds': self.idle_seconds,
+            'stations': [m.stats() for m in self._monitors.values()],
+        }
+
+
+icy_monitors = IcyMonitorRegistry(ICY_MONITOR_IDLE_SECONDS, ICY_MONITOR_MAX_STATIONS)
+
+# ============== Track History ==============
+#
+# Every title transition is appended to a MongoDB time-series collection
+# (a plain collection with a TTL index where time-series is unsupported).
+# Writes are deduplicated against the station's previous title, buffered in
+# memory and flushed with insert_many off the request path.
+
+TRACK_HISTORY_COLLECTION = 'now_playing_history'
+TRACK_HISTORY_RETENTION_DAYS = int(os.environ.get('TRACK_HISTORY_RETENTION_DAYS', '90'))
+TRACK_HISTORY_BATCH_SIZE = int(os.environ.get('TRACK_HISTORY_BATCH_SIZE', '500'))
+TRACK_HISTORY_FLUSH_INTERVAL = float(os.environ.get('TRACK_HISTORY_FLUSH_INTERVAL', '5'))
+TRACK_HISTORY_MAX_PENDING = int(os.environ.get('TRACK_HISTORY_MAX_PENDING', '20000'))
+TRACK_HISTORY_MAX_PAGE = 200
+TRACK_HISTORY_LAST_TITLES = 50000
+
+
+def encode_history_cursor(ts: datetime, doc_id: ObjectId) -> str:
+    millis = int(ts.replace(tzinfo=timezone.utc).timestamp() * 1000)
+    return f"{millis}_{doc_id}"
+
+
+def decode_history_cursor(cursor: str) -> Tuple[datetime, ObjectId]:
+    try:
+        millis, doc_id = cursor.split('_', 1)
+        ts = datetime.fromtimestamp(int(millis) / 1000, tz=timezone.utc)
+        return ts, ObjectId(doc_id)
+    except Exception:
+        raise ValueError(f"Invalid history cursor: {cursor}")
+
+
+class TrackHistoryWriter:
+    """
+    Buffers title transitions and writes them to MongoDB in batches.
+    """
+
+    def __init__(self, batch_size: int, flush_interval: float, max_pending: int):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending: List[dict] = []
+        self._last_titles: "OrderedDict[str, Optional[str]]" = OrderedDict()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.written = 0
+        self.deduplicated = 0
+        self.dropped = 0
+        self.flush_failures = 0
+
+    def record(self, station_id: str, title_info: dict, source: str):
+        """
+        Queue a title for the station unless it repeats the previous one.
+        Never blocks; titles are dropped if the buffer is full.
+        """
+        title = title_info.get('title')
+        if not title:
+            return
+        if station_id in self._last_titles and self._last_titles[station_id] == title:
+            self.deduplicated += 1
+            return
+        self._last_titles[station_id] = title
+        self._last_titles.move_to_end(station_id)
+        while len(self._last_titles) > TRACK_HISTORY_LAST_TITLES:
+            self._last_titles.popitem(last=False)
+
+        if len(self._pending) >= self.max_pending:
+            self.dropped += 1
+            return
+        self._pending.append({
+            'ts': datetime.now(timezone.utc),
+            'station_id': station_id,
+            'title': title,
+            'artist': title_info.get('artist'),
+            'song': title_info.get('song'),
+            'album': title_info.get('album'),
+            'source': source,
+        })
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    async def _ensure_collection(self):
+        retention = TRACK_HISTORY_RETENTION_DAYS * 86400
+        try:
+            existing = await db.list_collection_names(filter={'name': TRACK_HISTORY_COLLECTION})
+            if not existing:
+                try:
+                    await db.create_collection(
+                        TRACK_HISTORY_COLLECTION,
+                        timeseries={'timeField': 'ts', 'metaField': 'station_id', 'granularity': 'minutes'},
+                        expireAfterSeconds=retention,
+                    )
+                except OperationFailure as e:
+                    # MongoDB < 5.0: fall back to a regular collection with a TTL index
+                    logger.warning("Time-series collections unavailable (%s); using a regular collection", e)
+                    await db[TRACK_HISTORY_COLLECTION].create_index('ts', expireAfterSeconds=retention)
+            await db[TRACK_HISTORY_COLLECTION].create_index([('station_id', 1), ('ts', -1), ('_id', -1)])
+        except Exception as e:
+            logger.error("Error preparing track history collection: %s", e)
+
+    async def _flush_loop(self):
+        # Prepared here rather than in start() so an unreachable database
+        # never holds up application startup
+        await self._ensure_collection()
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        while self._pending:
+            batch = self._pending[:self.batch_size]
+            del self._pending[:self.batch_size]
+            try:
+                await db[TRACK_HISTORY_COLLECTION].insert_many(batch, ordered=False)
+                self.written += len(batch)
+            except Exception as e:
+                self.flush_failures += 1
+                self.dropped += len(batch)
+                logger.error("Error writing track history: %s", e)
+                return
+
+    def stats(self) -> dict:
+        return {
+            'pending': len(self._pending),
+            'written': self.written,
+            'deduplicated': self.deduplicated,
+            'dropped': self.dropped,
+            'flush_failures': self.flush_failures,
+        }
+
+
+track_history = TrackHistoryWriter(TRACK_HISTORY_BATCH_SIZE, TRACK_HISTORY_FLUSH_INTERVAL, TRACK_HISTORY_MAX_PENDING)
+
+
+# ============== CarPlay Log Ingestion ==============
+#
+# Devices upload their CarPlay debug logs every few seconds. Uploads are
+# acknowledged as soon as they are buffered and written to MongoDB with
+# insert_many once CARPLAY_LOG_BATCH_SIZE uploads are waiting or every
+# CARPLAY_LOG_FLUSH_INTERVAL seconds. Uploads are BSON-encoded on arrival,
+# so one MongoDB can't store is refused with 400 instead of failing its
+# batch, and the buffer is bounded by encoded size: at most
+# CARPLAY_LOG_MAX_PENDING_BYTES, beyond which uploads get 503 and the app
+# keeps them for its next attempt. A single upload over
+# CARPLAY_LOG_MAX_UPLOAD_BYTES would never fit and gets 413.
+
+CARPLAY_LOG_BATCH_SIZE = int(os.environ.get('CARPLAY_LOG_BATCH_SIZE', '200'))
+CARPLAY_LOG_FLUSH_INTERVAL = float(os.environ.get('CARPLAY_LOG_FLUSH_INTERVAL', '2'))
+CARPLAY_LOG_MAX_PENDING_BYTES = int(os.environ.get('CARPLAY_LOG_MAX_PENDING_BYTES', str(64 * 1024 * 1024)))
+CARPLAY_LOG_MAX_UPLOAD_BYTES = int(os.environ.get('CARPLAY_LOG_MAX_UPLOAD_BYTES', str(1024 * 1024)))
+CARPLAY_LOG_RETRY_AFTER = 5
+# Fraction of uploads echoed to the server log; 0 turns the echo off
+CARPLAY_LOG_ECHO_SAMPLE = float(os.environ.get('CARPLAY_LOG_ECHO_SAMPLE', '0.1'))
+
+
+class CarPlayLogWriter:
+    """
+    Write-behind buffer for CarPlay log uploads.
+    """
+
+    def __init__(self, batch_size: int, flush_interval: float, max_pending_bytes: int, max_upload_bytes: int):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending_bytes = max_pending_bytes
+        self.max_upload_bytes = min(max_upload_bytes, max_pending_bytes)
+        self._pending: List[RawBSONDocument] = []
+        self._pending_bytes = 0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.accepted = 0
+        self.rejected = 0
+        self.invalid = 0
+        self.too_large = 0
+        self.written = 0
+        self.dropped = 0
+        self.flush_failures = 0
+
+    def submit(self, document: dict) -> bool:
+        """
+        Buffer an upload for the next batch. Returns False without
+        buffering when the buffer is full; raises HTTPException (400/413)
+        for an upload that could never be stored.
+        """
+        # The _id is assigned here so a retried batch cannot be stored twice
+        try:
+            encoded = RawBSONDocument(bson.encode({'_id': ObjectId(), **document}))
+        except (InvalidDocument, OverflowError) as e:
+            self.invalid += 1
+            raise HTTPException(status_code=400, detail=f"Logs cannot be stored: {e}")
+        size = len(encoded.raw)
+        if size > self.max_upload_bytes:
+            self.too_large += 1
+            raise HTTPException(
+                status_code=413,
+                detail=f"Upload is {size} bytes encoded; at most {self.max_upload_bytes} are accepted",
+            )
+        if self._pending_bytes + size > self.max_pending_bytes:
+            self.rejected += 1
+            return False
+        self._pending.append(encoded)
+        self._pending_bytes += size
+        self.accepted += 1
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+        return True
+
+    def clear(self) -> int:
+        """
+        Discard buffered uploads; returns how many were discarded.
+        """
+        discarded = len(self._pending)
+        self._pending = []
+        self._pending_bytes = 0
+        return discarded
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            # A batch interrupted mid-write goes back to the buffer
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        while self._pending:
+            batch = self._pending[:self.batch_size]
+            del self._pending[:self.batch_size]
+            try:
+                await db.carplay_logs.insert_many(batch, ordered=False)
+                self.written += len(batch)
+            except BulkWriteError as e:
+                # Per-document errors. Duplicate keys come from retrying a
+                # batch the server had already written
+                errors = e.details.get('writeErrors', [])
+                duplicates = sum(1 for error in errors if error.get('code') == 11000)
+                self.written += e.details.get('nInserted', 0) + duplicates
+                self.dropped += len(errors) - duplicates
+                if len(errors) > duplicates:
+                    logger.error("Dropped %s CarPlay log uploads: %s", len(errors) - duplicates, errors[0].get('errmsg'))
+            except AutoReconnect as e:
+                # Transient (including NetworkTimeout and
+                # ServerSelectionTimeoutError): keep the batch for the next flush
+                self._pending[:0] = batch
+                self.flush_failures += 1
+                logger.error("Error writing CarPlay logs: %s", e)
+                return
+            except asyncio.CancelledError:
+                self._pending[:0] = batch
+                raise
+            except Exception as e:
+                # Anything else would fail the same way on every retry and
+                # hold up the uploads behind it
+                self.dropped += len(batch)
+                logger.error("Dropped %s CarPlay log uploads: %s", len(batch), e)
+            self._pending_bytes -= sum(len(document.raw) for document in batch)
+
+    def stats(self) -> dict:
+        return {
+            'pending': len(self._pending),
+            'pending_bytes': self._pending_bytes,
+            'max_pending_bytes': self.max_pending_bytes,
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'invalid': self.invalid,
+            'too_large': self.too_large,
+            'written': self.written,
+            'dropped': self.dropped,
+            'flush_failures': self.flush_failures,
+        }
+
+
+carplay_log_writer = CarPlayLogWriter(
+    CARPLAY_LOG_BATCH_SIZE,
+    CARPLAY_LOG_FLUSH_INTERVAL,
+    CARPLAY_LOG_MAX_PENDING_BYTES,
+    CARPLAY_LOG_MAX_UPLOAD_BYTES,
+)
+
+
+# ============== Artwork Enrichment ==============
+#
+# Album name and cover art are looked up per track, not per station: the key
+# is the normalized artist+song, so one lookup serves every station playing
+# that track. Results (including misses) are memoized in memory and in
+# MongoDB. Requests wait at most ARTWORK_LOOKUP_BUDGET seconds; a slower
+# lookup keeps running and its result shows up on the next poll/push.
+# Enrichment is opt-in: with ARTWORK_PROVIDER=itunes, track titles are sent
+# to Apple's rate-limited search API.
+
+ARTWORK_PROVIDER = os.environ.get('ARTWORK_PROVIDER', 'none')
+ARTWORK_LOOKUP_BUDGET = float(os.environ.get('ARTWORK_LOOKUP_BUDGET', '0.3'))
+ARTWORK_CACHE_TTL = float(os.environ.get('ARTWORK_CACHE_TTL', str(30 * 86400)))
+ARTWORK_MISS_TTL = float(os.environ.get('ARTWORK_MISS_TTL', '86400'))
+ARTWORK_CACHE_MAX_ENTRIES = int(os.environ.get('ARTWORK_CACHE_MAX_ENTRIES', '20000'))
+ARTWORK_MAX_CONCURRENCY = int(os.environ.get('ARTWORK_MAX_CONCURRENCY', '4'))
+ARTWORK_COLLECTION = 'track_artwork'
+
+
+def normalize_track_key(artist: str, song: str) -> str:
+    """
+    Cache key for a track: case-folded, punctuation and extra whitespace removed.
+    """
+    def clean(text: str) -> str:
+        text = re.sub(r'[\(\[].*?[\)\]]', ' ', text.casefold())
+        return ' '.join(re.sub(r'[^\w\s]', ' ', text).split())
+    return f"{clean(artist)}|{clean(song)}"
+
+
+class ArtworkProvider:
+    """
+    Looks up album and artwork for a track.
+    `lookup` returns {'album': ..., 'artwork': ...} or None if unknown.
+    """
+
+    name = 'none'
+    enabled = False
+
+    async def lookup(self, artist: str, song: str) -> Optional[dict]:
+        return None
+
+    async def close(self):
+        pass
+
+
+class ItunesArtworkProvider(ArtworkProvider):
+    """
+    iTunes Search API: free, no API key, returns album name and cover art.
+    Uses its own small client so lookups never compete with stream traffic.
+    """
+
+    name = 'itunes'
+    enabled = True
+    SEARCH_URL = 'https://itunes.apple.com/search'
+
+    def __init__(self):
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=5.0,
+                limits=httpx.Limits(
+                    max_connections=ARTWORK_MAX_CONCURRENCY,
+                    keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+                ),
+            )
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def lookup(self, artist: str, song: str) -> Optional[dict]:
+        async with host_breakers.guard(self.SEARCH_URL):
+            response = await self.client.get(
+                self.SEARCH_URL,
+                params={'term': f"{artist} {song}", 'media': 'music', 'entity': 'song', 'limit': 1},
+            )
+            response.raise_for_status()
+            results = response.json().get('results', [])
+        if not results:
+            return None
+
+        track = results[0]
+        artwork = track.get('artworkUrl100')
+        if artwork:
+            # The API serves any size from the same path
+            artwork = artwork.replace('100x100bb', '600x600bb')
+        return {'album': track.get('collectionName'), 'artwork': artwork}
+
+
+ARTWORK_PROVIDERS = {
+    'none': ArtworkProvider,
+    'itunes': ItunesArtworkProvider,
+}
+
+
+class ArtworkEnricher:
+    """
+    Memoized album/artwork lookups shared by all stations and listeners.
+    """
+
+    def __init__(self, provider: ArtworkProvider, budget: float, max_entries: int):
+        self.provider = provider
+        self.budget = budget
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, Optional[dict]]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._lookup_slots = asyncio.Semaphore(ARTWORK_MAX_CONCURRENCY)
+        self._index_task: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.misses = 0
+        self.persistent_hits = 0
+        self.provider_lookups = 0
+        self.provider_failures = 0
+        self.over_budget = 0
+
+    def start(self):
+        if self._index_task is None:
+            self._index_task = asyncio.create_task(self._ensure_indexes())
+
+    async def stop(self):
+        tasks = list(self._inflight.values())
+        if self._index_task:
+            tasks.append(self._index_task)
+            self._index_task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.provider.close()
+
+    async def _ensure_indexes(self):
+        try:
+            await db[ARTWORK_COLLECTION].create_index('expires_at', expireAfterSeconds=0)
+        except Exception as e:
+            logger.error("Error preparing artwork cache collection: %s", e)
+
+    async def enrich(self, artist: Optional[str], song: Optional[str]) -> Optional[dict]:
+        """
+        Album/artwork for a track, or None if unknown or not found within the budget.
+        """
+        if not self.provider.enabled or not artist or not song:
+            return None
+        key = normalize_track_key(artist, song)
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, data = entry
+            if time.monotonic() < expires_at:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return data
+            del self._entries[key]
+
+        self.misses += 1
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._load(key, artist, song))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+
+        done, _ = await asyncio.wait({task}, timeout=self.budget)
+        if not done:
+            self.over_budget += 1
+            return None
+        return task.result() if not task.cancelled() else None
+
+    async def _load(self, key: str, artist: str, song: str) -> Optional[dict]:
+        try:
+            doc = await db[ARTWORK_COLLECTION].find_one({'_id': key})
+        except Exception as e:
+            logger.warning("Artwork cache read failed: %s", e)
+            doc = None
+        if doc is not None:
+            self.persistent_hits += 1
+            data = doc.get('data')
+            ttl = (doc['expires_at'].replace(tzinfo=timezone.utc) - datetime.now(timezone.utc)).total_seconds()
+            self._remember(key, data, max(ttl, 0))
+            return data
+
+        self.provider_lookups += 1
+        try:
+            async with self._lookup_slots:
+                data = await self.provider.lookup(artist, song)
+        except Exception as e:
+            # Not memoized, so the next poll retries
+            self.provider_failures += 1
+            logger.warning("Artwork lookup failed for %s - %s: %s", artist, song, e)
+            return None
+
+        if data is not None and not (data.get('album') or data.get('artwork')):
+            data = None
+        ttl = ARTWORK_CACHE_TTL if data else ARTWORK_MISS_TTL
+        self._remember(key, data, ttl)
+        try:
+            await db[ARTWORK_COLLECTION].replace_one(
+                {'_id': key},
+                {
+                    '_id': key,
+                    'data': data,
+                    'provider': self.provider.name,
+                    'expires_at': datetime.now(timezone.utc) + timedelta(seconds=ttl),
+                },
+                upsert=True,
+            )
+        except Exception as e:
+            logger.warning("Artwork cache write failed: %s", e)
+        return data
+
+    def _remember(self, key: str, data: Optional[dict], ttl: float):
+        self._entries[key] = (time.monotonic() + ttl, data)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            'provider': self.provider.name,
+            'budget': self.budget,
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'persistent_hits': self.persistent_hits,
+            'provider_lookups': self.provider_lookups,
+            'provider_failures': self.provider_failures,
+            'over_budget': self.over_budget,
+            'inflight': len(self._inflight),
+        }
+
+
+if ARTWORK_PROVIDER not in ARTWORK_PROVIDERS:
+    logger.warning("Unknown ARTWORK_PROVIDER '%s'; artwork enrichment disabled", ARTWORK_PROVIDER)
+artwork_enricher = ArtworkEnricher(
+    ARTWORK_PROVIDERS.get(ARTWORK_PROVIDER, ArtworkProvider)(),
+    budget=ARTWORK_LOOKUP_BUDGET,
+    max_entries=ARTWORK_CACHE_MAX_ENTRIES,
+)
+
+
+# ============== Stream Health ==============
+#
+# A background prober checks the stream URLs of recently requested stations
+# so dead candidates are known before a listener tries them. Each probe
+# records time-to-first-byte, status, content type, bitrate and ICY support;
+# an exponentially weighted availability score smooths out one-off blips.
+# Results are served from memory and persisted to MongoDB.
+
+STREAM_HEALTH_INTERVAL = float(os.environ.get('STREAM_HEALTH_INTERVAL', '300'))
+STREAM_HEALTH_CONCURRENCY = int(os.environ.get('STREAM_HEALTH_CONCURRENCY', '10'))
+# Separate slots for probes a request is waiting on (/stream/resolve), so
+# they never queue behind a background round
+STREAM_HEALTH_ON_DEMAND_CONCURRENCY = int(os.environ.get('STREAM_HEALTH_ON_DEMAND_CONCURRENCY', '10'))
+STREAM_HEALTH_TIMEOUT = float(os.environ.get('STREAM_HEALTH_TIMEOUT', '8'))
+STREAM_HEALTH_MAX_STATIONS = int(os.environ.get('STREAM_HEALTH_MAX_STATIONS', '1000'))
+STREAM_HEALTH_MAX_URLS = int(os.environ.get('STREAM_HEALTH_MAX_URLS', '20000'))
+STREAM_HEALTH_SCORE_ALPHA = 0.3
+STREAM_HEALTH_DEAD_FAILURES = 2
+STREAM_HEALTH_RETENTION_DAYS = 7
+STREAM_HEALTH_COLLECTION = 'stream_health'
+
+
+def station_stream_candidates(station_data: dict) -> List[str]:
+    """
+    The station's stream URLs in preference order, without duplicates.
+    """
+    candidates = []
+    for key in ('url_resolved', 'urlResolved', 'url'):
+        url = station_data.get(key)
+        if url and url not in candidates:
+            candidates.append(url)
+    return candidates
+
+
+def parse_bitrate(headers: httpx.Headers) -> Optional[int]:
+    """
+    Stream bitrate in kbps from icy-br / ice-audio-info headers.
+    """
+    value = headers.get('icy-br') or headers.get('x-audiocast-bitrate')
+    if not value:
+        match = re.search(r'(?:ice-)?bitrate=(\d+)', headers.get('ice-audio-info', ''))
+        value = match.group(1) if match else None
+    if value:
+        match = re.match(r'\s*(\d+)', value)
+        if match:
+            return int(match.group(1))
+    return None
+
+
+class StreamHealthProber:
+    """
+    Periodic stream URL checks with a rolling availability score per URL.
+    """
+
+    def __init__(self, interval: float, concurrency: int, on_demand_concurrency: int, max_urls: int):
+        self.interval = interval
+        self.max_urls = max_urls
+        self._records: "OrderedDict[str, dict]" = OrderedDict()
+        self._slots = asyncio.Semaphore(concurrency)
+        self._on_demand_slots = asyncio.Semaphore(on_demand_concurrency)
+        self._task: Optional[asyncio.Task] = None
+        self.rounds = 0
+        self.probes = 0
+        self.failures = 0
+        self.last_round_seconds: Optional[float] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def get(self, url: str) -> Optional[dict]:
+        return self._records.get(url)
+
+    def is_fresh(self, url: str, max_age: Optional[float] = None) -> bool:
+        record = self._records.get(url)
+        max_age = max_age if max_age is not None else self.interval * 3
+        return record is not None and time.time() - record['checked_at'].timestamp() < max_age
+
+    def is_dead(self, url: str) -> bool:
+        """
+        True if recent probes of `url` keep failing.
+        """
+        record = self._records.get(url)
+        return (
+            record is not None
+            and self.is_fresh(url)
+            and record['consecutive_failures'] >= STREAM_HEALTH_DEAD_FAILURES
+        )
+
+    def pick(self, candidates: List[str]) -> Optional[str]:
+        """
+        The first candidate not known to be dead (or the first, if all are).
+        """
+        for url in candidates:
+            if not self.is_dead(url):
+                return url
+        return candidates[0] if candidates else None
+
+    async def probe(self, url: str, station_id: Optional[str] = None, on_demand: bool = False) -> dict:
+        """
+        Check one stream URL now and update its record. `on_demand` probes
+        (a request is waiting) use their own slots, not the rounds' ones.
+        """
+        result = {'status': None, 'content_type': None, 'bitrate': None, 'icy': False, 'ttfb_ms': None, 'error': None}
+        slots = self._on_demand_slots if on_demand else self._slots
+        try:
+            async with slots, host_breakers.guard(url), http_pools.host_slot(url, HOST_SLOT_WAIT):
+                # TTFB excludes time spent waiting for a slot
+                started = time.monotonic()
+                async with http_pools.streams.stream(
+                    'GET',
+                    url,
+                    headers=ICY_REQUEST_HEADERS,
+                    timeout=STREAM_HEALTH_TIMEOUT,
+                ) as response:
+                    result['status'] = response.status_code
+                    result['content_type'] = response.headers.get('content-type')
+                    result['bitrate'] = parse_bitrate(response.headers)
+                    result['icy'] = icy_metaint(response) > 0
+                    async for chunk in response.aiter_raw():
+                        if chunk:
+                            result['ttfb_ms'] = round((time.monotonic() - started) * 1000)
+                            break
+        except Exception as e:
+            result['error'] = str(e) or type(e).__name__
+
+        ok = (
+            result['status'] == 200
+            and result['ttfb_ms'] is not None
+            and not (result['content_type'] or '').startswith('text/html')
+        )
+        return self._record(url, station_id, ok, result)
+
+    def _record(self, url: str, station_id: Optional[str], ok: bool, result: dict) -> dict:
+        self.probes += 1
+        if not ok:
+            self.failures += 1
+
+        previous = self._records.get(url)
+        alpha = STREAM_HEALTH_SCORE_ALPHA
+        record = {
+            'url': url,
+            'station_ids': list(previous['station_ids']) if previous else [],
+            'checked_at': datetime.now(timezone.utc),
+            'ok': ok,
+            **result,
+            'checks': (previous['checks'] if previous else 0) + 1,
+            'consecutive_failures': 0 if ok else (previous['consecutive_failures'] if previous else 0) + 1,
+            'score': round(previous['score'] * (1 - alpha) + alpha * ok, 3) if previous else float(ok),
+            'ttfb_avg_ms': previous.get('ttfb_avg_ms') if previous else None,
+        }
+        if result['ttfb_ms'] is not None:
+            avg = record['ttfb_avg_ms']
+            record['ttfb_avg_ms'] = result['ttfb_ms'] if avg is None else round(avg * (1 - alpha) + alpha * result['ttfb_ms'])
+        if station_id and station_id not in record['station_ids']:
+            record['station_ids'].append(station_id)
+
+        self._remember(record)
+        return record
+
+    def _remember(self, record: dict):
+        self._records[record['url']] = record
+        self._records.move_to_end(record['url'])
+        while len(self._records) > self.max_urls:
+            self._records.popitem(last=False)
+
+    async def _run(self):
+        await self._load()
+        while True:
+            started = time.monotonic()
+            try:
+                await self.probe_round()
+            except Exception as e:
+                logger.error("Stream health round failed: %s", e)
+            self.last_round_seconds = round(time.monotonic() - started, 1)
+            await asyncio.sleep(max(self.interval - self.last_round_seconds, 0))
+
+    async def probe_round(self):
+        targets = []
+        for station_id, station_data in station_cache.recent(STREAM_HEALTH_MAX_STATIONS):
+            for url in station_stream_candidates(station_data):
+                targets.append((url, station_id))
+        if not targets:
+            return
+
+        records = await asyncio.gather(*(self.probe(url, station_id) for url, station_id in targets))
+        self.rounds += 1
+        await self._persist(records)
+
+    async def _load(self):
+        try:
+            collection = db[STREAM_HEALTH_COLLECTION]
+            await collection.create_index('checked_at', expireAfterSeconds=STREAM_HEALTH_RETENTION_DAYS * 86400)
+            await collection.create_index('station_ids')
+            docs = await collection.find().sort('checked_at', 1).to_list(self.max_urls)
+            for doc in docs:
+                doc.pop('_id', None)
+                doc['checked_at'] = doc['checked_at'].replace(tzinfo=timezone.utc)
+                self._remember(doc)
+        except Exception as e:
+            logger.error("Error loading stream health records: %s", e)
+
+    async def _persist(self, records: List[dict]):
+        try:
+            await db[STREAM_HEALTH_COLLECTION].bulk_write(
+                [ReplaceOne({'_id': r['url']}, {'_id': r['url'], **r}, upsert=True) for r in records],
+                ordered=False,
+            )
+        except Exception as e:
+            logger.error("Error saving stream health records: %s", e)
+
+    def stats(self) -> dict:
+        return {
+            'urls': len(self._records),
+            'dead': sum(1 for url in self._records if self.is_dead(url)),
+            'rounds': self.rounds,
+            'probes': self.probes,
+            'failures': self.failures,
+            'last_round_seconds': self.last_round_seconds,
+        }
+
+
+stream_health = StreamHealthProber(
+    STREAM_HEALTH_INTERVAL, STREAM_HEALTH_CONCURRENCY, STREAM_HEALTH_ON_DEMAND_CONCURRENCY, STREAM_HEALTH_MAX_URLS,
+)
+
+
+# ============== Stream Resolution ==============
+#
+# POST /api/stream/resolve returns every playable URL for a station -
+# url_resolved, url, backups, playlist entries and finally our relay - best
+# first. Ranking uses the health prober's availability score and TTFB;
+# candidates without a recent measurement are probed in parallel within a
+# short deadline. Rankings are cached briefly and playlist expansion shares
+# the now-playing playlist cache.
+
+STREAM_RESOLVE_CACHE_TTL = float(os.environ.get('STREAM_RESOLVE_CACHE_TTL', '60'))
+STREAM_RESOLVE_CACHE_MAX_ENTRIES = int(os.environ.get('STREAM_RESOLVE_CACHE_MAX_ENTRIES', '5000'))
+STREAM_RESOLVE_PROBE_DEADLINE = float(os.environ.get('STREAM_RESOLVE_PROBE_DEADLINE', '3'))
+STREAM_RESOLVE_MEASUREMENT_MAX_AGE = float(os.environ.get('STREAM_RESOLVE_MEASUREMENT_MAX_AGE', '600'))
+STREAM_RESOLVE_GOOD_SCORE = 0.5
+
+
+def station_backup_urls(station_data: dict) -> List[str]:
+    backups = [station_data.get('urlBackup') or station_data.get('url_backup')]
+    alternatives = station_data.get('urlAlternatives') or station_data.get('url_alternatives') or []
+    if isinstance(alternatives, list):
+        backups.extend(alternatives)
+    return [url for url in backups if url]
+
+
+class StreamResolver:
+    """
+    Builds and ranks a station's stream candidates, with a short-lived
+    per-station (or per-URL) cache.
+    """
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, dict]]" = OrderedDict()
+        self._flights = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+        self.probes = 0
+
+    async def resolve(self, station_id: Optional[str], url: Optional[str]) -> Optional[dict]:
+        """
+        Returns {'url', 'playlist_type', 'details'} or None if the station
+        does not exist.
+        """
+        key = f"station:{station_id}" if station_id else f"url:{url}"
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, resolved = entry
+            if time.monotonic() < expires_at:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return resolved
+
+        self.misses += 1
+        return await self._flights.run(key, self._resolve_and_store, key, station_id, url)
+
+    async def _resolve_and_store(self, key: str, station_id: Optional[str], url: Optional[str]) -> Optional[dict]:
+        if station_id:
+            station_data = await station_cache.get(station_id)
+            if station_data is None:
+                return None
+            sources = [(u, 'station') for u in station_stream_candidates(station_data)]
+            sources += [(u, 'backup') for u in station_backup_urls(station_data)]
+        else:
+            sources = [(url, 'request')]
+        if not sources:
+            return None
+
+        # Expand playlists; the first source decides the reported type
+        expansions = await asyncio.gather(*(playlist_resolver.resolve(u, u) for u, _ in sources))
+        details: List[dict] = []
+        seen: Set[str] = set()
+
+        def add(candidate_url: str, source: str):
+            if candidate_url and candidate_url not in seen:
+                seen.add(candidate_url)
+                details.append({'url': candidate_url, 'source': source})
+
+        for (source_url, source), resolved in zip(sources, expansions):
+            if resolved['playlist_type'] in ('direct', 'hls'):
+                add(resolved['url'], source)
+                add(source_url, source)
+            else:
+                for entry in resolved['entries'] or [resolved['url']]:
+                    add(entry, 'playlist')
+
+        await self._measure([d['url'] for d in details])
+        ranked = self._rank(details)
+        result = {
+            'url': sources[0][0],
+            'playlist_type': expansions[0]['playlist_type'],
+            'details': ranked,
+        }
+
+        self._entries[key] = (time.monotonic() + self.ttl, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return result
+
+    async def _measure(self, urls: List[str]):
+        """
+        Probe candidates with no recent measurement, for at most
+        STREAM_RESOLVE_PROBE_DEADLINE seconds. Slower probes finish in the
+        background and count toward the next ranking.
+        """
+        stale = [u for u in urls if not stream_health.is_fresh(u, STREAM_RESOLVE_MEASUREMENT_MAX_AGE)]
+        if not stale:
+            return
+        self.probes += len(stale)
+        tasks = {asyncio.create_task(stream_health.probe(u, on_demand=True)) for u in stale}
+        await asyncio.wait(tasks, timeout=STREAM_RESOLVE_PROBE_DEADLINE)
+
+    @staticmethod
+    def _rank(details: List[dict]) -> List[dict]:
+        ranked = []
+        for detail in details:
+            record = stream_health.get(detail['url'])
+            measured = record is not None and stream_health.is_fresh(detail['url'], STREAM_RESOLVE_MEASUREMENT_MAX_AGE)
+            ranked.append({
+                **detail,
+                'score': record['score'] if measured else None,
+                'ttfb_ms': record['ttfb_avg_ms'] if measured else None,
+                'measured': measured,
+            })
+
+        def rank_key(candidate: dict):
+            # Healthy measured candidates first (best score, then fastest),
+            # then unmeasured ones, then known-bad ones; ties keep source order
+            if not candidate['measured']:
+                return (1, 0, 0)
+            tier = 0 if candidate['score'] >= STREAM_RESOLVE_GOOD_SCORE else 2
+            return (tier, -candidate['score'], candidate['ttfb_ms'] if candidate['ttfb_ms'] is not None else float('inf'))
+
+        return sorted(ranked, key=rank_key)
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'probes': self.probes,
+        }
+
+
+stream_resolver = StreamResolver(STREAM_RESOLVE_CACHE_TTL, STREAM_RESOLVE_CACHE_MAX_ENTRIES)
+
+
+@api_router.post("/stream/resolve", response_model=StreamResolveResponse)
+async def resolve_stream(body: StreamResolveRequest, request: Request):
+    """
+    Ranked stream candidates for a station (or a single stream URL).
+    The relay URL for the best cleartext candidate is appended last.
+    """
+    if not body.station_id and not body.url:
+        raise HTTPException(status_code=400, detail="station_id or url is required")
+    if body.url and not body.url.lower().startswith(('http://', 'https://')):
+        raise HTTPException(status_code=400, detail="url must be http(s)")
+    if body.url and not body.station_id:
+        # Playlist and probe fetches re-check every hop on the stream client;
+        # this turns an internal URL into a clear 403 up front
+        try:
+            await upstream_policy.check(body.url)
+        except UnsafeUpstreamError as e:
+            raise HTTPException(status_code=403, detail=str(e))
+        except HostUnavailableError as e:
+            raise HTTPException(status_code=502, detail=str(e))
+
+    try:
+        resolved = await stream_resolver.resolve(body.station_id, body.url)
+    except Exception as e:
+        logger.error("Error resolving stream: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+    if resolved is None:
+        raise HTTPException(status_code=404, detail="Station not found")
+
+    details = [StreamCandidate(**d) for d in resolved['details']]
+    cleartext = next((d.url for d in details if d.url.startswith('http://')), None)
+    if cleartext:
+        relay_url = f"{str(request.base_url).rstrip('/')}/api/stream/{quote(cleartext, safe='')}"
+        details.append(StreamCandidate(url=relay_url, source='proxy'))
+
+    return StreamResolveResponse(
+        success=True,
+        station_id=body.station_id,
+        url=resolved['url'],
+        playlist_type=resolved['playlist_type'],
+        candidates=[d.url for d in details],
+        details=details,
+    )
+
+
+# ============== Stream Relay ==============
+#
+# /api/stream/{encoded_url} lets Android play cleartext HTTP streams through
+# us. Each upstream stream is opened once and its audio is fanned out to every
+# listener; all listeners share the same chunk objects. Upstream ICY metadata
+# is always stripped and, for clients that send Icy-MetaData: 1, re-injected
+# (as UTF-8) at our own interval. A listener whose buffer fills up is
+# disconnected instead of buffering without bound.
+
+RELAY_CONNECT_TIMEOUT = float(os.environ.get('RELAY_CONNECT_TIMEOUT', '10'))
+RELAY_READ_TIMEOUT = float(os.environ.get('RELAY_READ_TIMEOUT', '30'))
+RELAY_CLIENT_BUFFER_BYTES = int(os.environ.get('RELAY_CLIENT_BUFFER_BYTES', str(512 * 1024)))
+RELAY_MAX_STREAMS = int(os.environ.get('RELAY_MAX_STREAMS', '200'))
+RELAY_MAX_LISTENERS_PER_STREAM = int(os.environ.get('RELAY_MAX_LISTENERS_PER_STREAM', '500'))
+# Keyed on the client address as seen by the app; run uvicorn with
+# --proxy-headers behind a load balancer so this is the real client
+RELAY_MAX_LISTENERS_PER_CLIENT = int(os.environ.get('RELAY_MAX_LISTENERS_PER_CLIENT', '8'))
+RELAY_METAINT = 16000
+
+RELAY_PASSTHROUGH_HEADERS = ('icy-name', 'icy-genre', 'icy-br', 'icy-description', 'icy-url')
+# Only audio is relayed: anything else served from our origin (text/html
+# in particular) would run with the app's origin
+RELAY_CONTENT_TYPES = {
+    'application/ogg',
+    'application/vnd.apple.mpegurl',
+    'application/x-mpegurl',
+}
+
+
+def decode_relay_url(encoded_url: str) -> str:
+    """
+    The upstream URL from the path parameter. The app percent-encodes the
+    whole URL; tolerate a second round of encoding.
+    """
+    url = encoded_url
+    if not url.lower().startswith(('http://', 'https://')):
+        url = unquote(url)
+    if not url.lower().startswith(('http://', 'https://')):
+        raise ValueError(f"Not an http(s) stream URL: {encoded_url}")
+    return url
+
+
+def relay_media_type(headers: httpx.Headers) -> Optional[str]:
+    """
+    The media type to relay an upstream response as, or None if it is not audio.
+    """
+    content_type = headers.get('content-type', '').split(';', 1)[0].strip().lower()
+    if content_type.startswith('audio/') or content_type in RELAY_CONTENT_TYPES:
+        return content_type
+    if not content_type and ('icy-metaint' in headers or 'icy-name' in headers):
+        # Old SHOUTcast servers send ICY headers but no content type
+        return 'audio/mpeg'
+    return None
+
+
+def build_icy_metadata_block(stream_title: Optional[str]) -> bytes:
+    """
+    Encode a StreamTitle as an ICY metadata block: length byte + padded body.
+    """
+    if not stream_title:
+        return b'\0'
+    body = f"StreamTitle='{stream_title}';".encode('utf-8')[:255 * 16]
+    length = -(-len(body) // 16)
+    return bytes([length]) + body.ljust(length * 16, b'\0')
+
+
+class RelayListener:
+    """
+    One client's bounded queue of audio chunks.
+    """
+
+    def __init__(self, max_buffer: int, client: Optional[str] = None):
+        self.max_buffer = max_buffer
+        self.client = client
+        self.buffered = 0
+        self.closed = False
+        self.overflowed = False
+        self._chunks: deque = deque()
+        self._ready = asyncio.Event()
+
+    def push(self, chunk: bytes) -> bool:
+        if self.closed:
+            return False
+        if self.buffered + len(chunk) > self.max_buffer:
+            # Slow client: cut it loose rather than grow without bound
+            self.overflowed = True
+            self.close()
+            return False
+        self._chunks.append(chunk)
+        self.buffered += len(chunk)
+        self._ready.set()
+        return True
+
+    def close(self):
+        self.closed = True
+        self._ready.set()
+
+    async def chunks(self):
+        while True:
+            while not self._chunks:
+                if self.closed:
+                    return
+                self._ready.clear()
+                await self._ready.wait()
+            if self.overflowed:
+                return
+            chunk = self._chunks.popleft()
+            self.buffered -= len(chunk)
+            yield chunk
+
+
+async def inject_icy_metadata(relay: "StreamRelay", listener: RelayListener):
+    """
+    Re-frame a listener's audio with ICY metadata every RELAY_METAINT bytes.
+    The current title is sent at the first boundary and after each change,
+    empty blocks otherwise.
+    """
+    remaining = RELAY_METAINT
+    sent_version = None
+    async for chunk in listener.chunks():
+        # Each listener cuts at its own offsets; slice views, not copies
+        view = memoryview(chunk)
+        pos = 0
+        while len(chunk) - pos >= remaining:
+            yield view[pos:pos + remaining] if pos or remaining < len(chunk) else chunk
+            pos += remaining
+            remaining = RELAY_METAINT
+            if sent_version != relay.metadata_version:
+                sent_version = relay.metadata_version
+                yield relay.metadata_block
+            else:
+                yield b'\0'
+        if pos < len(chunk):
+            yield view[pos:] if pos else chunk
+            remaining -= len(chunk) - pos
+
+
+class RelayStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse that hands memoryview chunks to the server as-is;
+    the pinned Starlette would try to `.encode()` anything but bytes.
+    """
+
+    async def stream_response(self, send) -> None:
+        await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
+        async for chunk in self.body_iterator:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+
+class StreamRelay:
+    """
+    A single upstream connection fanned out to any number of listeners.
+    """
+
+    def __init__(self, url: str, on_close):
+        self.url = url
+        self.headers: Dict[str, str] = {}
+        self.media_type = 'audio/mpeg'
+        self.listeners: Set[RelayListener] = set()
+        self.metadata_block = build_icy_metadata_block(None)
+        self.metadata_version = 0
+        self.error: Optional[str] = None
+        self.bytes_in = 0
+        self.chunks_in = 0
+        self.dropped_listeners = 0
+        self.started_at = time.monotonic()
+        self._on_close = on_close
+        self._ready = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._pump())
+
+    async def stop(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def wait_ready(self, timeout: float):
+        """
+        Wait for the upstream response headers. Raises on failure.
+        """
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            raise HostUnavailableError(f"Timed out connecting to {self.url}")
+        if self.error:
+            raise HostUnavailableError(self.error)
+
+    def add_listener(self, client: Optional[str] = None) -> RelayListener:
+        listener = RelayListener(RELAY_CLIENT_BUFFER_BYTES, client)
+        self.listeners.add(listener)
+        return listener
+
+    def remove_listener(self, listener: RelayListener):
+        listener.close()
+        self.listeners.discard(listener)
+        if not self.listeners and self._task and not self._task.done():
+            # Unregister right away so a new listener starts a fresh relay
+            self._on_close(self)
+            self._task.cancel()
+
+    async def _pump(self):
+        try:
+            request = http_pools.relays.build_request(
+                'GET',
+                self.url,
+                headers=ICY_REQUEST_HEADERS,
+                timeout=httpx.Timeout(RELAY_CONNECT_TIMEOUT, read=RELAY_READ_TIMEOUT),
+            )
+            async with host_breakers.guard(self.url):
+                response = await http_pools.relays.send(request, stream=True)
+            try:
+                if response.status_code != 200:
+                    raise HostUnavailableError(f"Upstream returned {response.status_code}")
+                media_type = relay_media_type(response.headers)
+                if media_type is None:
+                    content_type = response.headers.get('content-type') or 'no content type'
+                    raise HostUnavailableError(f"Upstream is not an audio stream ({content_type})")
+                self.media_type = media_type
+                self.headers = {
+                    name: response.headers[name]
+                    for name in RELAY_PASSTHROUGH_HEADERS if name in response.headers
+                }
+                self._ready.set()
+
+                metaint = icy_metaint(response)
+                parser = IcyMetadataParser(metaint) if metaint else None
+                async for chunk in response.aiter_raw():
+                    self.bytes_in += len(chunk)
+                    self.chunks_in += 1
+                    if parser is not None:
+                        chunk = self._strip_metadata(parser, chunk)
+                        if not chunk:
+                            continue
+                    self._fan_out(chunk)
+            finally:
+                await response.aclose()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.error = str(e) or type(e).__name__
+            logger.info("Stream relay for %s ended: %s", self.url, self.error)
+        finally:
+            self._ready.set()
+            for listener in self.listeners:
+                listener.close()
+            self._on_close(self)
+
+    def _strip_metadata(self, parser: IcyMetadataParser, chunk: bytes) -> bytes:
+        audio: List[memoryview] = []
+        for block in parser.feed(chunk, audio):
+            if block:
+                pairs, _ = title_normalizer.parse(None, block)
+                stream_title = pairs.get('StreamTitle', '').strip()
+                block = build_icy_metadata_block(stream_title)
+                if block != self.metadata_block:
+                    self.metadata_block = block
+                    self.metadata_version += 1
+        if len(audio) == 1 and len(audio[0]) == len(chunk):
+            # Pure audio chunk: pass the original object through uncopied
+            return chunk
+        return b''.join(audio)
+
+    def _fan_out(self, chunk: bytes):
+        dropped = [listener for listener in self.listeners if not listener.push(chunk)]
+        for listener in dropped:
+            self.listeners.discard(listener)
+            if listener.overflowed:
+                self.dropped_listeners += 1
+                logger.info("Dropped slow relay listener for %s", self.url)
+
+    def stats(self) -> dict:
+        return {
+            'url': self.url,
+            'listeners': len(self.listeners),
+            'bytes_in': self.bytes_in,
+            'chunks_in': self.chunks_in,
+            'dropped_listeners': self.dropped_listeners,
+            'uptime': round(time.monotonic() - self.started_at, 1),
+        }
+
+
+class RelayClientLimitError(HostUnavailableError):
+    """
+    Raised when a client already holds RELAY_MAX_LISTENERS_PER_CLIENT relays.
+    """
+
+
+class StreamRelayRegistry:
+    """
+    One StreamRelay per upstream URL, shared by all of its listeners.
+    """
+
+    def __init__(self, max_streams: int, max_listeners: int, max_per_client: int):
+        self.max_streams = max_streams
+        self.max_listeners = max_listeners
+        self.max_per_client = max_per_client
+        self._relays: Dict[str, StreamRelay] = {}
+        self._client_listeners: Dict[str, int] = {}
+        self.rejected = 0
+        self.client_rejected = 0
+
+    async def join(self, url: str, client: str) -> Tuple[StreamRelay, RelayListener]:
+        """
+        Join (or start) the relay for `url` once upstream headers are in.
+        Raises HostUnavailableError if the relay or the client is at its
+        limit, or upstream fails. Pair every join with `leave`.
+        """
+        if self._client_listeners.get(client, 0) >= self.max_per_client:
+            self.client_rejected += 1
+            raise RelayClientLimitError(f"Too many relayed streams for this client (max {self.max_per_client})")
+
+        relay = self._relays.get(url)
+        if relay is None:
+            if len(self._relays) >= self.max_streams:
+                self.rejected += 1
+                raise HostUnavailableError("Relay is at capacity")
+            relay = StreamRelay(url, self._closed)
+            self._relays[url] = relay
+            relay.start()
+        elif len(relay.listeners) >= self.max_listeners:
+            self.rejected += 1
+            raise HostUnavailableError(f"Relay for {url} is at capacity")
+
+        listener = relay.add_listener(client)
+        self._client_listeners[client] = self._client_listeners.get(client, 0) + 1
+        try:
+            await relay.wait_ready(RELAY_CONNECT_TIMEOUT)
+        except BaseException:
+            self.leave(relay, listener)
+            raise
+        return relay, listener
+
+    def leave(self, relay: StreamRelay, listener: RelayListener):
+        relay.remove_listener(listener)
+        client, listener.client = listener.client, None
+        if client is None:
+            return
+        remaining = self._client_listeners.get(client, 0) - 1
+        if remaining > 0:
+            self._client_listeners[client] = remaining
+        else:
+            self._client_listeners.pop(client, None)
+
+    def _closed(self, relay: StreamRelay):
+        if self._relays.get(relay.url) is relay:
+            del self._relays[relay.url]
+
+    async def stop(self):
+        relays = list(self._relays.values())
+        self._relays.clear()
+        for relay in relays:
+            await relay.stop()
+
+    def stats(self) -> dict:
+        return {
+            'streams': len(self._relays),
+            'listeners': sum(len(r.listeners) for r in self._relays.values()),
+            'max_streams': self.max_streams,
+            'clients': len(self._client_listeners),
+            'rejected': self.rejected,
+            'client_rejected': self.client_rejected,
+            'relays': [r.stats() for r in self._relays.values()],
+        }
+
+
+stream_relays = StreamRelayRegistry(RELAY_MAX_STREAMS, RELAY_MAX_LISTENERS_PER_STREAM, RELAY_MAX_LISTENERS_PER_CLIENT)
+
+
+@api_router.get("/stream/{encoded_url:path}")
+@api_router.head("/stream/{encoded_url:path}")
+async def relay_stream(encoded_url: str, request: Request):
+    """
+    Relay a radio stream (for cleartext HTTP streams on Android).
+    Send Icy-MetaData: 1 to receive ICY titles in the body.
+    """
+    try:
+        url = decode_relay_url(encoded_url)
+        await upstream_policy.check(url)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except UnsafeUpstreamError as e:
+        raise HTTPException(status_code=403, detail=str(e))
+    except HostUnavailableError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+
+    want_metadata = request.headers.get('icy-metadata', '').strip() == '1'
+    client_address = request.client.host if request.client else 'unknown'
+    try:
+        relay, listener = await stream_relays.join(url, client_address)
+    except RelayClientLimitError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    except HostUnavailableError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+
+    headers = dict(relay.headers)
+    headers['Cache-Control'] = 'no-cache, no-store'
+    headers['X-Content-Type-Options'] = 'nosniff'
+    if want_metadata:
+        headers['icy-metaint'] = str(RELAY_METAINT)
+
+    if request.method == 'HEAD':
+        stream_relays.leave(relay, listener)
+        return Response(status_code=200, headers=headers, media_type=relay.media_type)
+
+    async def body():
+        try:
+            chunks = inject_icy_metadata(relay, listener) if want_metadata else listener.chunks()
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            stream_relays.leave(relay, listener)
+
+    return RelayStreamingResponse(body(), headers=headers, media_type=relay.media_type)
+
+
+# ============== Operator Stats ==============
+
+@api_router.get("/stats")
+async def get_stats():
+    """
+    Runtime statistics for the now-playing subsystems.
+    """
+    return {
+        "http_pools": http_pools.stats(),
+        "upstream_checks": upstream_policy.stats(),
+        "icy_monitors": icy_monitors.stats(),
+        "icy_capabilities": icy_capabilities.stats(),
+        "host_breakers": host_breakers.stats(),
+        "catalog_requests": catalog_requests.stats(),
+        "playlist_resolver": playlist_resolver.stats(),
+        "hls_metadata": hls_metadata.stats(),
+        "title_normalizer": title_normalizer.stats(),
+        "track_history": track_history.stats(),
+        "carplay_logs": carplay_log_writer.stats(),
+        "artwork_enrichment": artwork_enricher.stats(),
+        "station_cache": station_cache.stats(),
+        "now_playing_flights": now_playing_flights.stats(),
+        "now_playing_subscriptions": now_playing_broadcaster.stats(),
+        "now_playing_prewarm": now_playing_warmer.stats(),
+        "shared_cache": shared_cache.stats(),
+        "stream_relays": stream_relays.stats(),
+        "stream_health": stream_health.stats(),
+        "stream_resolver": stream_resolver.stats(),
+    }
+
+# Include the router in the main app
+app.include_router(api_router)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_credentials=True,
+    allow_origins=["*"],
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+@app.on_event("startup")
+async def start_background_services():
+    await http_pools.open()
+    shared_cache.start()
+    icy_monitors.start()
+    track_history.start()
+    carplay_log_writer.start()
+    artwork_enricher.start()
+    stream_health.start()
+    now_playing_warmer.start()
+
+@app.on_event("shutdown")
+async def stop_background_services():
+    await now_playing_warmer.stop()
+    await now_playing_broadcaster.stop()
+    await artwork_enricher.stop()
+    await stream_relays.stop()
+    await stream_health.stop()
+    await icy_monitors.stop()
+    await http_pools.close()
+    await track_history.stop()
+    await carplay_log_writer.stop()
+    await shared_cache.stop()
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
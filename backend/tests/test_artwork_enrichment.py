@@ -0,0 +1,107 @@
+"""
+In-process tests for artwork enrichment
+Runs ArtworkEnricher against a local stub provider instead of a third-party API
+"""
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'megaradio_test')
+
+import server  # noqa: E402
+from server import ARTWORK_COLLECTION, ArtworkEnricher, ArtworkProvider  # noqa: E402
+
+
+class StubArtworkProvider(ArtworkProvider):
+    """Answers every lookup locally after `delay` seconds"""
+
+    name = 'stub'
+    enabled = True
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.lookups = []
+
+    async def lookup(self, artist, song):
+        self.lookups.append((artist, song))
+        await asyncio.sleep(self.delay)
+        return {'album': f"{artist} Greatest Hits", 'artwork': 'https://example.com/cover.jpg'}
+
+
+class InMemoryCollection:
+    """The subset of a Motor collection the enricher uses"""
+
+    def __init__(self):
+        self.docs = {}
+
+    async def find_one(self, query):
+        return self.docs.get(query['_id'])
+
+    async def replace_one(self, query, doc, upsert=False):
+        self.docs[query['_id']] = doc
+
+
+@pytest.fixture
+def artwork_db(monkeypatch):
+    collection = InMemoryCollection()
+    monkeypatch.setattr(server, 'db', {ARTWORK_COLLECTION: collection})
+    return collection
+
+
+class TestArtworkEnrichment:
+    """Test ArtworkEnricher memoization and lookup budget"""
+
+    def test_default_provider_is_disabled(self):
+        """Track titles should not leave the server unless a provider is configured"""
+        enricher = ArtworkEnricher(ArtworkProvider(), budget=0.3, max_entries=10)
+
+        result = asyncio.run(enricher.enrich("Daft Punk", "One More Time"))
+
+        assert result is None, "Disabled enrichment should return nothing"
+        assert enricher.misses == 0, "Disabled enrichment should not count lookups"
+
+    def test_same_track_is_looked_up_once(self, artwork_db):
+        """Spelling variants of one track should share a single provider lookup"""
+        provider = StubArtworkProvider()
+        enricher = ArtworkEnricher(provider, budget=0.3, max_entries=10)
+
+        async def scenario():
+            first = await enricher.enrich("Daft Punk", "One More Time")
+            second = await enricher.enrich("DAFT PUNK", "One More Time (Radio Edit)")
+            return first, second
+
+        first, second = asyncio.run(scenario())
+
+        assert first == second, "Both spellings should resolve to the same artwork"
+        assert first['album'] == "Daft Punk Greatest Hits"
+        assert len(provider.lookups) == 1, f"Expected one provider lookup, got {provider.lookups}"
+        assert enricher.hits == 1 and enricher.misses == 1
+        assert len(artwork_db.docs) == 1, "Result should be persisted for other workers"
+        print(f"✓ Enrichment stats: {enricher.stats()}")
+
+    def test_slow_lookup_is_served_on_next_request(self, artwork_db):
+        """A lookup over budget should return nothing now and the result later"""
+        provider = StubArtworkProvider(delay=0.2)
+        enricher = ArtworkEnricher(provider, budget=0.05, max_entries=10)
+
+        async def scenario():
+            first = await enricher.enrich("Massive Attack", "Teardrop")
+            await asyncio.sleep(0.3)
+            second = await enricher.enrich("Massive Attack", "Teardrop")
+            return first, second
+
+        first, second = asyncio.run(scenario())
+
+        assert first is None, "Over-budget lookup should not hold the request"
+        assert second is not None, "Finished lookup should be memoized"
+        assert enricher.over_budget == 1
+        assert len(provider.lookups) == 1, "The background lookup should not be repeated"
+        print(f"✓ Enrichment stats: {enricher.stats()}")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
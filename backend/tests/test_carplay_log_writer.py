@@ -0,0 +1,140 @@
+"""
+In-process tests for CarPlay log ingestion
+Covers CarPlayLogWriter buffering and write failures against an in-memory collection
+"""
+import asyncio
+import os
+import sys
+
+import pytest
+from fastapi import HTTPException
+from pymongo.errors import AutoReconnect, DocumentTooLarge
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'megaradio_test')
+
+import server  # noqa: E402
+from server import CarPlayLogEntry, CarPlayLogRequest, CarPlayLogWriter, submit_carplay_logs  # noqa: E402
+
+
+class InMemoryLogCollection:
+    """The insert_many subset of a Motor collection, failing with queued errors"""
+
+    def __init__(self):
+        self.docs = []
+        self.failures = []
+        self.block = None
+
+    async def insert_many(self, documents, ordered=True):
+        if self.block is not None:
+            block, self.block = self.block, None
+            await block.wait()
+        if self.failures:
+            raise self.failures.pop(0)
+        self.docs.extend(documents)
+
+
+@pytest.fixture
+def log_collection(monkeypatch):
+    collection = InMemoryLogCollection()
+    monkeypatch.setattr(server, 'db', type('FakeDatabase', (), {'carplay_logs': collection})())
+    return collection
+
+
+def upload(message: str = "Connected", context=None) -> dict:
+    return {'device_id': 'device-1', 'logs': [{'level': 'info', 'message': message, 'context': context}]}
+
+
+class TestCarPlayLogWriter:
+    """Test CarPlayLogWriter.submit and flush"""
+
+    def test_unencodable_upload_is_refused(self, log_collection):
+        """An int over 64 bits can't be stored and must not reach the buffer"""
+        writer = CarPlayLogWriter(batch_size=10, flush_interval=1, max_pending_bytes=10000, max_upload_bytes=1000)
+
+        with pytest.raises(HTTPException) as raised:
+            writer.submit(upload(context={'counter': 2 ** 70}))
+
+        assert raised.value.status_code == 400
+        assert writer.stats()['pending'] == 0 and writer.invalid == 1
+
+    def test_failed_batch_does_not_block_the_queue(self, log_collection):
+        """A batch that fails permanently is dropped and later uploads are written"""
+        writer = CarPlayLogWriter(batch_size=1, flush_interval=1, max_pending_bytes=10000, max_upload_bytes=1000)
+        log_collection.failures.append(DocumentTooLarge("too large"))
+        writer.submit(upload("first"))
+        writer.submit(upload("second"))
+
+        asyncio.run(writer.flush())
+
+        assert writer.dropped == 1 and writer.written == 1
+        assert [doc['logs'][0]['message'] for doc in log_collection.docs] == ["second"]
+        assert writer.stats()['pending_bytes'] == 0
+
+    def test_transient_failure_keeps_the_batch(self, log_collection):
+        """A lost connection should leave the batch for the next flush"""
+        writer = CarPlayLogWriter(batch_size=10, flush_interval=1, max_pending_bytes=10000, max_upload_bytes=1000)
+        log_collection.failures.append(AutoReconnect("connection reset"))
+        writer.submit(upload())
+
+        asyncio.run(writer.flush())
+        assert writer.stats()['pending'] == 1 and writer.flush_failures == 1
+
+        asyncio.run(writer.flush())
+        assert writer.written == 1 and writer.stats()['pending'] == 0
+
+    def test_stop_keeps_batch_being_written(self, log_collection):
+        """Stopping mid-write should write the interrupted batch in the final flush"""
+        writer = CarPlayLogWriter(batch_size=1, flush_interval=60, max_pending_bytes=10000, max_upload_bytes=1000)
+
+        async def scenario():
+            log_collection.block = asyncio.Event()
+            writer.start()
+            writer.submit(upload())
+            while log_collection.block is not None:
+                await asyncio.sleep(0.01)
+            await writer.stop()
+
+        asyncio.run(scenario())
+
+        assert writer.written == 1
+        assert len(log_collection.docs) == 1
+
+
+class TestCarPlayLogEndpoint:
+    """Test submit_carplay_logs status codes"""
+
+    def request(self, message: str = "Connected") -> CarPlayLogRequest:
+        return CarPlayLogRequest(device_id='device-1', logs=[CarPlayLogEntry(message=message)])
+
+    def test_full_buffer_answers_503(self, monkeypatch):
+        writer = CarPlayLogWriter(batch_size=100, flush_interval=1, max_pending_bytes=1000, max_upload_bytes=1000)
+        monkeypatch.setattr(server, 'carplay_log_writer', writer)
+        monkeypatch.setattr(server, 'CARPLAY_LOG_ECHO_SAMPLE', 0)
+
+        async def scenario():
+            # Each upload is over half the buffer
+            await submit_carplay_logs(self.request("x" * 400))
+            await submit_carplay_logs(self.request("x" * 400))
+
+        with pytest.raises(HTTPException) as raised:
+            asyncio.run(scenario())
+
+        assert raised.value.status_code == 503
+        assert 'Retry-After' in raised.value.headers
+        assert writer.accepted == 1 and writer.rejected == 1
+
+    def test_oversized_upload_answers_413(self, monkeypatch):
+        writer = CarPlayLogWriter(batch_size=100, flush_interval=1, max_pending_bytes=10000, max_upload_bytes=400)
+        monkeypatch.setattr(server, 'carplay_log_writer', writer)
+
+        with pytest.raises(HTTPException) as raised:
+            asyncio.run(submit_carplay_logs(self.request("x" * 1000)))
+
+        assert raised.value.status_code == 413
+        assert writer.rejected == 0, "An upload that can never fit is not a full buffer"
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -0,0 +1,65 @@
+"""
+Backend API Tests for MegaRadio CarPlay log ingestion
+Tests the /api/carplay/logs endpoints and the write-behind log buffer
+"""
+import pytest
+import requests
+import os
+import time
+import uuid
+
+# Backend URL from environment - DO NOT add default
+BASE_URL = os.environ.get('EXPO_PUBLIC_BACKEND_URL', 'https://audio-stream-verify.preview.emergentagent.com').rstrip('/')
+
+
+class TestCarPlayLogs:
+    """Test the /api/carplay/logs endpoints"""
+
+    def test_submit_is_acknowledged(self):
+        """Submitting logs should be acknowledged with the received count"""
+        payload = {
+            "device_id": f"TEST_{uuid.uuid4().hex[:8]}",
+            "logs": [
+                {"level": "info", "message": "TEST_CarPlay connected"},
+                {"level": "error", "message": "TEST_Playback failed", "context": {"code": 42}},
+            ]
+        }
+        response = requests.post(f"{BASE_URL}/api/carplay/logs", json=payload, timeout=15)
+
+        assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+        data = response.json()
+        assert data["success"] is True
+        assert data["received_count"] == 2
+        print(f"✓ Submit response: {data}")
+
+    def test_submitted_logs_are_written(self):
+        """Buffered logs should be readable once their batch has been written"""
+        device_id = f"TEST_{uuid.uuid4().hex[:8]}"
+        payload = {"device_id": device_id, "logs": [{"level": "warn", "message": "TEST_Buffered"}]}
+        requests.post(f"{BASE_URL}/api/carplay/logs", json=payload, timeout=15)
+
+        logs = []
+        for _ in range(10):
+            logs = requests.get(f"{BASE_URL}/api/carplay/logs", params={"device_id": device_id}, timeout=15).json()["logs"]
+            if logs:
+                break
+            time.sleep(1)
+
+        assert len(logs) == 1, "Submitted logs should be written within a few flush intervals"
+        assert logs[0]["logs"][0]["message"] == "TEST_Buffered"
+        print(f"✓ Written log: {logs[0]}")
+
+    def test_stats_report_log_buffer(self):
+        """Stats should report the CarPlay log buffer"""
+        data = requests.get(f"{BASE_URL}/api/stats").json()
+
+        buffer = data.get("carplay_logs")
+        assert buffer is not None, "Missing carplay_logs section"
+        assert buffer["pending_bytes"] <= buffer["max_pending_bytes"], "Buffer should stay within its bound"
+        for field in ["accepted", "rejected", "written", "flush_failures"]:
+            assert field in buffer, f"Missing field: {field}"
+        print(f"✓ CarPlay log buffer: {buffer}")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -0,0 +1,106 @@
+"""
+In-process tests for adaptive catalog requests
+Covers HedgedCatalogRequests timeouts and hedging against a local mock transport
+"""
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'megaradio_test')
+
+import server  # noqa: E402
+from server import CATALOG_LATENCY_MIN_SAMPLES, CATALOG_TIMEOUT_MAX, CATALOG_TIMEOUT_MIN, HedgedCatalogRequests  # noqa: E402
+
+
+def catalog_with_delays(delays):
+    """Serve the catalog locally; the n-th request waits delays[n] seconds"""
+    served = []
+
+    async def handler(request):
+        delay = delays[min(len(served), len(delays) - 1)]
+        served.append(request.url.path)
+        await asyncio.sleep(delay)
+        return httpx.Response(200, json={'attempt': len(served)})
+
+    def client():
+        return httpx.AsyncClient(base_url="http://catalog.test", transport=httpx.MockTransport(handler))
+
+    return served, client
+
+
+def warmed_up(hedging: bool, latency: float) -> HedgedCatalogRequests:
+    requests = HedgedCatalogRequests(hedging)
+    for _ in range(CATALOG_LATENCY_MIN_SAMPLES):
+        requests.latency.observe(latency)
+    return requests
+
+
+class TestAdaptiveTimeout:
+    """Test HedgedCatalogRequests.timeout"""
+
+    def test_timeout_starts_at_maximum(self):
+        """Without enough samples the fixed maximum applies"""
+        assert HedgedCatalogRequests(hedging=True).timeout() == CATALOG_TIMEOUT_MAX
+
+    def test_timeout_is_clamped(self):
+        """Observed latency moves the timeout, within [min, max]"""
+        assert warmed_up(False, 0.001).timeout() == CATALOG_TIMEOUT_MIN
+        assert warmed_up(False, 60).timeout() == CATALOG_TIMEOUT_MAX
+
+
+class TestHedging:
+    """Test HedgedCatalogRequests.get"""
+
+    def test_slow_primary_is_hedged(self, monkeypatch):
+        """A primary slower than p95 should get a duplicate that wins"""
+        served, client = catalog_with_delays([0.4, 0.0])
+        requests = warmed_up(True, 0.02)
+
+        async def scenario():
+            async with client() as catalog:
+                monkeypatch.setattr(server, 'http_pools', SimpleNamespace(catalog=catalog))
+                return await requests.get("/api/station/1")
+
+        response = asyncio.run(scenario())
+
+        assert response.json() == {'attempt': 2}, "The hedge should answer first"
+        assert len(served) == 2
+        assert requests.hedges_fired == 1 and requests.hedges_won == 1
+
+    def test_fast_primary_is_not_hedged(self, monkeypatch):
+        """A primary faster than p95 should not send duplicate traffic"""
+        served, client = catalog_with_delays([0.0])
+        requests = warmed_up(True, 0.2)
+
+        async def scenario():
+            async with client() as catalog:
+                monkeypatch.setattr(server, 'http_pools', SimpleNamespace(catalog=catalog))
+                return await requests.get("/api/station/1")
+
+        asyncio.run(scenario())
+
+        assert len(served) == 1
+        assert requests.hedges_fired == 0
+
+    def test_hedging_disabled_sends_one_request(self, monkeypatch):
+        """With hedging off a slow primary is simply awaited"""
+        served, client = catalog_with_delays([0.1])
+        requests = warmed_up(False, 0.01)
+
+        async def scenario():
+            async with client() as catalog:
+                monkeypatch.setattr(server, 'http_pools', SimpleNamespace(catalog=catalog))
+                return await requests.get("/api/station/1")
+
+        assert asyncio.run(scenario()).json() == {'attempt': 1}
+        assert len(served) == 1 and requests.hedges_fired == 0
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -0,0 +1,144 @@
+"""
+In-process tests for HLS timed metadata parsing
+Covers ID3 tags in packed audio and MPEG-TS segments, and media playlists
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'megaradio_test')
+
+from server import (  # noqa: E402
+    TS_PACKET_SIZE, extract_segment_tags, parse_hls_extinf_title, parse_m3u8, segment_tag_complete,
+)
+
+ID3_PID = 0x102
+AUDIO_PID = 0x101
+
+
+def syncsafe(size: int) -> bytes:
+    return bytes([(size >> 21) & 0x7f, (size >> 14) & 0x7f, (size >> 7) & 0x7f, size & 0x7f])
+
+
+def id3_frame(frame_id: str, text: str, version: int = 4, encoding: int = 3) -> bytes:
+    codec = {0: 'latin-1', 1: 'utf-16', 3: 'utf-8'}[encoding]
+    body = bytes([encoding]) + text.encode(codec)
+    size = syncsafe(len(body)) if version == 4 else len(body).to_bytes(4, 'big')
+    return frame_id.encode() + size + b'\0\0' + body
+
+
+def id3_tag(*frames: bytes, version: int = 4) -> bytes:
+    body = b''.join(frames)
+    return b'ID3' + bytes([version, 0, 0]) + syncsafe(len(body)) + body
+
+
+def ts_packets(payload: bytes, pid: int) -> bytes:
+    """Split `payload` over 188-byte TS packets, padding the last one"""
+    packets = bytearray()
+    chunk_size = TS_PACKET_SIZE - 4
+    for start in range(0, len(payload), chunk_size):
+        chunk = payload[start:start + chunk_size]
+        header = bytes([0x47, (pid >> 8) & 0x1f, pid & 0xff, 0x10])
+        if len(chunk) < chunk_size:
+            # Pad with an adaptation field so the payload ends the packet
+            padding = chunk_size - len(chunk) - 1
+            header = bytes([0x47, (pid >> 8) & 0x1f, pid & 0xff, 0x30, padding]) + b'\xff' * padding
+        packets += header + chunk
+    return bytes(packets)
+
+
+TAG = id3_tag(id3_frame('TPE1', "Röyksopp"), id3_frame('TIT2', "Eple " + "x" * 300))
+
+
+class TestSegmentTags:
+    """Test extract_segment_tags and segment_tag_complete"""
+
+    def test_packed_audio_tag(self):
+        """AAC/MP3 segments start with the tag itself"""
+        segment = TAG + b'\xff\xf1' * 500
+        tags = extract_segment_tags(segment)
+        assert tags['TPE1'] == "Röyksopp"
+        assert tags['TIT2'].startswith("Eple ")
+        assert segment_tag_complete(segment)
+
+    @pytest.mark.parametrize("version", [3, 4])
+    @pytest.mark.parametrize("encoding", [0, 1, 3])
+    def test_frame_versions_and_encodings(self, version, encoding):
+        tag = id3_tag(
+            id3_frame('TPE1', "Daft Punk", version, encoding),
+            id3_frame('TIT2', "Aerodynamic", version, encoding),
+            version=version,
+        )
+        assert extract_segment_tags(tag) == {'TPE1': "Daft Punk", 'TIT2': "Aerodynamic"}
+
+    def test_ts_tag_split_across_packets(self):
+        """A tag spread over several TS packets should be reassembled per PID"""
+        audio = ts_packets(b'\xaa' * 400, AUDIO_PID)
+        segment = audio[:TS_PACKET_SIZE] + ts_packets(TAG, ID3_PID) + audio[TS_PACKET_SIZE:]
+
+        tags = extract_segment_tags(segment)
+
+        assert tags['TPE1'] == "Röyksopp"
+        assert tags['TIT2'] == "Eple " + "x" * 300
+        assert segment_tag_complete(segment)
+
+    def test_truncated_tag_is_incomplete(self):
+        """A partial download must not report a cut-off title"""
+        segment = ts_packets(TAG, ID3_PID)[:TS_PACKET_SIZE]
+        assert not segment_tag_complete(segment)
+        assert 'TIT2' not in extract_segment_tags(segment)
+        assert not segment_tag_complete(TAG[:-10])
+
+    def test_untagged_segment(self):
+        segment = ts_packets(b'\xaa' * 1000, AUDIO_PID)
+        assert extract_segment_tags(segment) == {}
+        assert not segment_tag_complete(segment)
+
+
+class TestParseM3u8:
+    """Test parse_m3u8 and #EXTINF titles"""
+
+    def test_master_playlist_variants(self):
+        text = (
+            "#EXTM3U\n"
+            "#EXT-X-STREAM-INF:BANDWIDTH=64000,CODECS=\"mp4a.40.5\"\n"
+            "low/index.m3u8\n"
+            "#EXT-X-STREAM-INF:BANDWIDTH=128000\n"
+            "https://cdn.example.com/high/index.m3u8\n"
+        )
+        playlist = parse_m3u8(text, "https://radio.example.com/live/master.m3u8")
+        assert playlist['variants'] == [
+            (64000, "https://radio.example.com/live/low/index.m3u8"),
+            (128000, "https://cdn.example.com/high/index.m3u8"),
+        ]
+        assert playlist['segments'] == []
+
+    def test_media_playlist_segments(self):
+        text = (
+            "#EXTM3U\n"
+            "#EXT-X-TARGETDURATION:6\n"
+            "#EXT-X-MEDIA-SEQUENCE:1042\n"
+            "#EXTINF:6.0,title=\"Teardrop\",artist=\"Massive Attack\"\n"
+            "seg1042.aac\n"
+            "#EXTINF:6.0,\n"
+            "seg1043.aac\n"
+        )
+        playlist = parse_m3u8(text, "https://radio.example.com/live/index.m3u8")
+        assert playlist['media_sequence'] == 1042
+        assert playlist['target_duration'] == 6.0
+        assert playlist['segments'][1] == ("https://radio.example.com/live/seg1043.aac", '')
+
+        title = parse_hls_extinf_title(playlist['segments'][0][1])
+        assert title == {'artist': "Massive Attack", 'song': "Teardrop", 'title': "Massive Attack - Teardrop"}
+
+    def test_plain_extinf_title(self):
+        title = parse_hls_extinf_title("Daft Punk - One More Time")
+        assert title['artist'] == "Daft Punk" and title['song'] == "One More Time"
+        assert parse_hls_extinf_title("") is None
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
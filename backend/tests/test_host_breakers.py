@@ -0,0 +1,81 @@
+"""
+In-process tests for the per-host circuit breakers
+Covers HostBreakers.guard without a running backend
+"""
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'megaradio_test')
+
+from server import CircuitBreaker, HostBreakers, HostUnavailableError  # noqa: E402
+
+UPSTREAM_URL = "http://stream.example.com:8000/live"
+
+
+def trip(breakers: HostBreakers):
+    breaker = breakers.get(UPSTREAM_URL)
+    breaker.record_failure()
+    # Skip the cooldown so the next call is the half-open trial
+    breaker.opened_at -= breakers.cooldown
+    return breaker
+
+
+class TestHostBreakers:
+    """Test HostBreakers.guard state transitions"""
+
+    def test_cancelled_trial_releases_half_open_slot(self):
+        """A cancelled half-open trial must not leave the host rejected forever"""
+        breakers = HostBreakers(failure_threshold=1, cooldown=30)
+        breaker = trip(breakers)
+
+        async def scenario():
+            started = asyncio.Event()
+
+            async def trial():
+                async with breakers.guard(UPSTREAM_URL):
+                    started.set()
+                    await asyncio.sleep(60)
+
+            task = asyncio.create_task(trial())
+            await started.wait()
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+            # The next caller gets to run the trial instead of failing fast
+            async with breakers.guard(UPSTREAM_URL):
+                pass
+
+        asyncio.run(scenario())
+
+        assert breaker.state == CircuitBreaker.CLOSED, f"Expected closed, got {breaker.state}"
+        assert breaker.rejected == 0, "No request should have been rejected"
+        print(f"✓ Breaker after cancelled trial: {breaker.stats()}")
+
+    def test_failed_trial_reopens_breaker(self):
+        """A failing half-open trial should open the breaker again"""
+        breakers = HostBreakers(failure_threshold=1, cooldown=30)
+        breaker = trip(breakers)
+
+        async def scenario():
+            with pytest.raises(ConnectionError):
+                async with breakers.guard(UPSTREAM_URL):
+                    raise ConnectionError("refused")
+            with pytest.raises(HostUnavailableError):
+                async with breakers.guard(UPSTREAM_URL):
+                    pass
+
+        asyncio.run(scenario())
+
+        assert breaker.state == CircuitBreaker.OPEN, f"Expected open, got {breaker.state}"
+        assert breaker.trips == 2, "Re-opening from half-open should count as a trip"
+        print(f"✓ Breaker after failed trial: {breaker.stats()}")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
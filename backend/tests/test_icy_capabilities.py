@@ -0,0 +1,87 @@
+"""
+In-process tests for the ICY negative cache
+Covers IcyCapabilityCache back-off, expiry and error counting without a running backend
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'megaradio_test')
+
+import server  # noqa: E402
+from server import IcyCapabilityCache  # noqa: E402
+
+STREAM_URL = "http://stream.example.com:8000/live"
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(server.time, 'monotonic', fake.monotonic)
+    return fake
+
+
+def new_cache():
+    return IcyCapabilityCache(base_ttl=300, max_ttl=1200, max_entries=100, error_threshold=3)
+
+
+class TestIcyCapabilityCache:
+    """Test IcyCapabilityCache"""
+
+    def test_unsupported_url_is_skipped_until_expiry(self, clock):
+        """A URL without ICY should be skipped for base_ttl, then probed once"""
+        cache = new_cache()
+        cache.record_unsupported(STREAM_URL, 'no_metaint')
+
+        assert not cache.should_probe(STREAM_URL)
+        clock.now += 301
+        assert cache.should_probe(STREAM_URL), "Entry should expire after base_ttl"
+        assert not cache.should_probe(STREAM_URL), "Only one caller should re-probe at a time"
+        assert cache.stats()['skipped'] == 2 and cache.stats()['reprobes'] == 1
+
+    def test_backoff_doubles_up_to_max_ttl(self, clock):
+        """Repeated failures should double the back-off, capped at max_ttl"""
+        cache = new_cache()
+        waits = []
+        for _ in range(4):
+            cache.record_unsupported(STREAM_URL, 'empty_metadata')
+            waits.append(cache._entries[STREAM_URL]['retry_at'] - clock.now)
+
+        assert waits == [300, 600, 1200, 1200]
+
+    def test_single_error_is_not_cached(self, clock):
+        """Errors should only be cached after error_threshold in a row"""
+        cache = new_cache()
+        cache.record_error(STREAM_URL)
+        cache.record_error(STREAM_URL)
+        assert cache.should_probe(STREAM_URL), "Two errors may be transient"
+
+        cache.record_error(STREAM_URL)
+        assert not cache.should_probe(STREAM_URL)
+        assert cache.stats()['reasons'] == {'error': 1}
+
+    def test_success_clears_errors_and_entries(self, clock):
+        """A supported probe should reset the error count and drop the entry"""
+        cache = new_cache()
+        cache.record_error(STREAM_URL)
+        cache.record_error(STREAM_URL)
+        cache.record_supported(STREAM_URL)
+        cache.record_error(STREAM_URL)
+
+        assert cache.should_probe(STREAM_URL), "Error count should restart after a success"
+        assert cache.stats()['pending_errors'] == 1
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -0,0 +1,64 @@
+"""
+In-process tests for ICY station monitors
+Covers IcyStationMonitor reconnect handling without a running backend
+"""
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'megaradio_test')
+
+import server  # noqa: E402
+from server import IcyStationMonitor, UnsafeUpstreamError  # noqa: E402
+
+PRIVATE_STREAM_URL = "http://10.0.0.5:8000/live"
+
+
+class TestIcyStationMonitor:
+    """Test IcyStationMonitor._run"""
+
+    def test_unsafe_url_stops_monitor_and_is_negative_cached(self, monkeypatch):
+        """A stream on a private address should not be retried while requested"""
+        monitor = IcyStationMonitor("station-1", PRIVATE_STREAM_URL)
+        attempts = []
+
+        async def refuse():
+            attempts.append(1)
+            raise UnsafeUpstreamError(f"{PRIVATE_STREAM_URL} resolves to non-public address 10.0.0.5")
+
+        monkeypatch.setattr(monitor, '_consume', refuse)
+        asyncio.run(asyncio.wait_for(monitor._run(), 1))
+
+        assert len(attempts) == 1, "An unsafe URL should be tried once"
+        assert monitor.supported is False
+        assert not server.icy_capabilities.should_probe(PRIVATE_STREAM_URL), "URL should be negative-cached"
+        assert server.icy_capabilities.stats()['reasons'].get('unsafe_address') == 1
+
+    def test_unavailable_host_backs_off(self, monkeypatch):
+        """Retries for a tripped host should wait longer each time"""
+        monitor = IcyStationMonitor("station-2", "http://stream.example.com/live")
+        delays = []
+
+        async def unavailable():
+            raise server.HostUnavailableError("Circuit open for stream.example.com")
+
+        async def record_sleep(delay):
+            delays.append(delay)
+            if len(delays) == 3:
+                raise asyncio.CancelledError
+
+        monkeypatch.setattr(monitor, '_consume', unavailable)
+        monkeypatch.setattr(server.asyncio, 'sleep', record_sleep)
+        with pytest.raises(asyncio.CancelledError):
+            asyncio.run(monitor._run())
+
+        assert delays[0] < delays[1] < delays[2], f"Expected growing delays, got {delays}"
+        assert monitor.supported is None, "A tripped host should not mark the station unsupported"
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -0,0 +1,126 @@
+"""
+In-process tests for ICY stream parsing
+Covers IcyMetadataParser and parse_icy_metadata without a running backend
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'megaradio_test')
+
+from server import IcyMetadataParser, decode_icy_text, parse_icy_metadata  # noqa: E402
+
+METAINT = 32
+
+
+def metadata_block(text: str) -> bytes:
+    body = text.encode('utf-8')
+    length = -(-len(body) // 16)
+    return bytes([length]) + body.ljust(length * 16, b'\0')
+
+
+def icy_body(*titles: str) -> bytes:
+    """Audio runs of METAINT bytes, each followed by a metadata block"""
+    body = b''
+    for index, title in enumerate(titles):
+        body += bytes([index]) * METAINT
+        body += metadata_block(f"StreamTitle='{title}';") if title else b'\0'
+    return body
+
+
+class TestIcyMetadataParser:
+    """Test IcyMetadataParser.feed"""
+
+    def test_blocks_split_across_chunks(self):
+        """Blocks should be reassembled whatever the chunk boundaries"""
+        body = icy_body("Artist - Song", "", "Other - Track")
+        for chunk_size in [1, 7, 16, METAINT + 1, len(body)]:
+            parser = IcyMetadataParser(METAINT)
+            blocks = []
+            for start in range(0, len(body), chunk_size):
+                blocks += parser.feed(body[start:start + chunk_size])
+
+            assert [parse_icy_metadata(b).get('StreamTitle') for b in blocks] == ["Artist - Song", None, "Other - Track"], \
+                f"Wrong blocks for chunk size {chunk_size}"
+            assert parser.blocks == 3
+            assert parser.audio_bytes == 3 * METAINT
+
+    def test_empty_block_is_reported(self):
+        """A zero length byte should produce an empty block"""
+        parser = IcyMetadataParser(METAINT)
+
+        assert parser.feed(b'a' * METAINT + b'\0') == [b'']
+
+    def test_block_longer_than_255_bytes(self):
+        """Length bytes above 15 (over 255 metadata bytes) should be read in full"""
+        title = "A" * 150 + " - " + "B" * 150
+        parser = IcyMetadataParser(METAINT)
+
+        blocks = parser.feed(icy_body(title))
+
+        assert len(blocks[0]) > 255
+        assert parse_icy_metadata(blocks[0])['StreamTitle'] == title
+
+    def test_audio_runs_are_collected_without_metadata(self):
+        """Audio slices should exclude length bytes and metadata"""
+        parser = IcyMetadataParser(METAINT)
+        audio = []
+
+        parser.feed(icy_body("Artist - Song", "Other - Track"), audio)
+
+        assert b''.join(audio) == bytes([0]) * METAINT + bytes([1]) * METAINT
+
+
+class TestParseIcyMetadata:
+    """Test parse_icy_metadata"""
+
+    @pytest.mark.parametrize("raw,expected", [
+        (b"StreamTitle='Guns N' Roses - Sweet Child O' Mine';", "Guns N' Roses - Sweet Child O' Mine"),
+        (b"StreamTitle='Artist - Song';StreamUrl='http://example.com';", "Artist - Song"),
+        (b"StreamTitle='It's; Complicated';StreamUrl='';", "It's; Complicated"),
+        (b"StreamTitle='';", ""),
+        (b"StreamTitle='Artist - Song'\0\0\0\0", "Artist - Song"),
+    ])
+    def test_stream_title_values(self, raw, expected):
+        """Values may contain apostrophes and semicolons"""
+        assert parse_icy_metadata(raw)['StreamTitle'] == expected
+
+    def test_all_pairs_are_returned(self):
+        """Every Key='value' pair should be parsed"""
+        pairs = parse_icy_metadata(b"StreamTitle='Artist - Song';StreamUrl='http://example.com/art.jpg';")
+
+        assert pairs == {'StreamTitle': 'Artist - Song', 'StreamUrl': 'http://example.com/art.jpg'}
+
+
+class TestDecodeIcyText:
+    """Test decode_icy_text charset detection"""
+
+    @pytest.mark.parametrize("title,codec", [
+        ("Céline Dion - Pour que tu m'aimes encore", 'utf-8'),
+        ("Кино - Группа крови", 'cp1251'),
+        ("ДДТ - Осень", 'cp1251'),
+        ("Tarkan - Şımarık", 'cp1254'),
+        ("Barış Manço - Dağlar Dağlar", 'cp1254'),
+        ("Ğ - İ", 'cp1254'),
+        ("ŞİİR", 'cp1254'),
+        ("Céline Dion - Pour que tu m'aimes encore", 'cp1252'),
+        ("Björk - Jóga", 'cp1252'),
+    ])
+    def test_detected_charsets(self, title, codec):
+        """Each code page should round-trip its own titles"""
+        assert decode_icy_text(title.encode(codec)) == title
+
+    def test_configured_encoding_wins(self):
+        """A station's encoding overrides detection"""
+        raw = "Tarkan - Şımarık".encode('cp1254')
+        assert decode_icy_text(raw, 'iso-8859-9') == "Tarkan - Şımarık"
+
+    def test_undefined_cp1252_bytes_fall_back_to_latin1(self):
+        assert decode_icy_text(b"Artist \x81 Song") == "Artist \x81 Song"
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
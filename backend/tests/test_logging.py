@@ -0,0 +1,63 @@
+"""
+In-process tests for queued structured logging
+Covers DeferredFormatQueueHandler and JsonLogFormatter without a running backend
+"""
+import json
+import logging
+import os
+import queue
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'megaradio_test')
+
+from server import DeferredFormatQueueHandler, JsonLogFormatter  # noqa: E402
+
+
+@pytest.fixture
+def queued_logger():
+    log_queue = queue.SimpleQueue()
+    test_logger = logging.getLogger('megaradio.test.queued')
+    test_logger.propagate = False
+    handler = DeferredFormatQueueHandler(log_queue)
+    test_logger.addHandler(handler)
+    yield test_logger, log_queue
+    test_logger.removeHandler(handler)
+
+
+class TestQueuedLogging:
+    """Test that formatting happens on the listener, not the caller"""
+
+    def test_traceback_is_formatted_by_listener(self, queued_logger):
+        """exc_info should reach the listener and end up in its own JSON field"""
+        test_logger, log_queue = queued_logger
+        try:
+            raise ValueError("bad station")
+        except ValueError:
+            test_logger.exception("Lookup failed for %s", "station-1")
+
+        record = log_queue.get_nowait()
+        assert record.exc_info is not None, "exc_info should be kept for the listener"
+        assert record.msg == "Lookup failed for station-1", "Only the arguments should be merged"
+        assert record.exc_text is None, "The traceback should not be formatted on the caller"
+
+        entry = json.loads(JsonLogFormatter().format(record))
+        assert entry["message"] == "Lookup failed for station-1"
+        assert "ValueError: bad station" in entry["exc_info"]
+        print(f"✓ Log entry: {entry}")
+
+    def test_fields_are_merged_into_entry(self, queued_logger):
+        """Structured fields should become top-level JSON keys"""
+        test_logger, log_queue = queued_logger
+        test_logger.warning("Relay dropped", extra={'fields': {'station_id': 'station-1', 'listeners': 3}})
+
+        entry = json.loads(JsonLogFormatter().format(log_queue.get_nowait()))
+        assert entry["station_id"] == "station-1"
+        assert entry["listeners"] == 3
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
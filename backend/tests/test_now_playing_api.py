@@ -208,6 +208,198 @@ class TestNowPlayingResponseTypes:
         
         print(f"✓ All response types valid")
 
+    def test_response_matches_openapi_schema(self):
+        """Repeated (cached) responses should carry exactly the NowPlayingResponse fields"""
+        station_id = SAMPLE_STATION_IDS[0]
+        documented = {"station_id", "title", "artist", "song", "album", "artwork", "timestamp"}
+
+        for _ in range(2):
+            response = requests.get(f"{BASE_URL}/api/now-playing/{station_id}")
+            assert response.status_code == 200
+            assert response.headers["content-type"].startswith("application/json")
+            assert set(response.json()) == documented, "Response fields should match NowPlayingResponse"
+
+
+class TestNowPlayingConditionalGet:
+    """Test ETag / If-None-Match support on /api/now-playing/{station_id}"""
+    
+    def test_response_has_etag_and_cache_control(self):
+        """Now Playing responses should carry an ETag and Cache-Control max-age"""
+        station_id = SAMPLE_STATION_IDS[0]
+        response = requests.get(f"{BASE_URL}/api/now-playing/{station_id}")
+        
+        assert response.status_code == 200
+        assert response.headers.get("etag"), "Response should have an ETag"
+        assert "max-age" in response.headers.get("cache-control", ""), "Response should have a max-age hint"
+        print(f"✓ ETag: {response.headers['etag']}, Cache-Control: {response.headers['cache-control']}")
+    
+    def test_matching_etag_returns_304(self):
+        """Repeating the request with the ETag should return 304 while the song is unchanged"""
+        station_id = SAMPLE_STATION_IDS[1]
+        first = requests.get(f"{BASE_URL}/api/now-playing/{station_id}")
+        etag = first.headers["etag"]
+        
+        response = requests.get(
+            f"{BASE_URL}/api/now-playing/{station_id}",
+            headers={"If-None-Match": etag}
+        )
+        
+        # The song may have changed in between; then a new ETag comes back
+        assert response.status_code in [200, 304], f"Unexpected status: {response.status_code}"
+        if response.status_code == 304:
+            assert response.content == b"", "304 should have no body"
+        else:
+            assert response.headers["etag"] != etag, "200 should only be returned for a new song"
+        print(f"✓ Conditional GET returned {response.status_code}")
+    
+    def test_stale_etag_returns_200(self):
+        """An unknown ETag should return the full response"""
+        station_id = SAMPLE_STATION_IDS[0]
+        response = requests.get(
+            f"{BASE_URL}/api/now-playing/{station_id}",
+            headers={"If-None-Match": 'W/"0000000000000000"'}
+        )
+        
+        assert response.status_code == 200
+        assert response.json()["station_id"] == station_id
+
+
+class TestNowPlayingLongPoll:
+    """Test long-poll mode (?since=<etag>&wait=<seconds>) on /api/now-playing/{station_id}"""
+    
+    def test_long_poll_returns_after_wait_or_change(self):
+        """Long-poll should return 304 after the wait, or 200 with a new ETag on change"""
+        station_id = SAMPLE_STATION_IDS[1]
+        etag = requests.get(f"{BASE_URL}/api/now-playing/{station_id}").headers["etag"]
+        
+        start = datetime.now()
+        response = requests.get(
+            f"{BASE_URL}/api/now-playing/{station_id}",
+            params={"since": etag, "wait": 3},
+            timeout=15
+        )
+        elapsed = (datetime.now() - start).total_seconds()
+        
+        assert response.status_code in [200, 304], f"Unexpected status: {response.status_code}"
+        if response.status_code == 304:
+            assert elapsed >= 2.5, f"304 should only come after the wait, got {elapsed:.1f}s"
+        else:
+            assert response.headers["etag"] != etag, "200 should carry the new song's ETag"
+        print(f"✓ Long-poll returned {response.status_code} after {elapsed:.1f}s")
+    
+    def test_long_poll_with_outdated_etag_returns_immediately(self):
+        """A since value that no longer matches should return the current song at once"""
+        station_id = SAMPLE_STATION_IDS[0]
+        
+        start = datetime.now()
+        response = requests.get(
+            f"{BASE_URL}/api/now-playing/{station_id}",
+            params={"since": 'W/"0000000000000000"', "wait": 10},
+            timeout=15
+        )
+        elapsed = (datetime.now() - start).total_seconds()
+        
+        assert response.status_code == 200
+        assert elapsed < 10, "Outdated since should not wait"
+        assert response.json()["station_id"] == station_id
+
+
+class TestNowPlayingBatchAPI:
+    """Test the POST /api/now-playing/batch endpoint"""
+    
+    def test_batch_returns_result_per_station(self):
+        """Batch endpoint should return one result per requested station"""
+        response = requests.post(
+            f"{BASE_URL}/api/now-playing/batch",
+            json={"station_ids": SAMPLE_STATION_IDS}
+        )
+        
+        assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+        data = response.json()
+        
+        assert data["count"] == len(SAMPLE_STATION_IDS), "Expected one result per station"
+        returned_ids = [item["station_id"] for item in data["results"]]
+        assert returned_ids == SAMPLE_STATION_IDS, "Results should keep request order"
+        
+        for item in data["results"]:
+            if item["success"]:
+                assert item["data"]["station_id"] == item["station_id"]
+                assert item["data"]["title"], "Successful items should have a title"
+            else:
+                assert item["error"], "Failed items should carry an error"
+            print(f"✓ {item['station_id']}: success={item['success']} title={(item['data'] or {}).get('title')}")
+    
+    def test_batch_deduplicates_station_ids(self):
+        """Duplicate station IDs should be resolved once"""
+        station_id = SAMPLE_STATION_IDS[0]
+        response = requests.post(
+            f"{BASE_URL}/api/now-playing/batch",
+            json={"station_ids": [station_id, station_id]}
+        )
+        
+        assert response.status_code == 200
+        assert response.json()["count"] == 1, "Duplicate IDs should be collapsed"
+    
+    def test_batch_rejects_oversized_request(self):
+        """Batches above the station limit should be rejected with 400"""
+        station_ids = [f"station_{i}" for i in range(1000)]
+        response = requests.post(
+            f"{BASE_URL}/api/now-playing/batch",
+            json={"station_ids": station_ids}
+        )
+        
+        assert response.status_code == 400, f"Expected 400, got {response.status_code}"
+        print(f"✓ Oversized batch rejected: {response.json()}")
+
+
+class TestNowPlayingHistoryAPI:
+    """Test the /api/now-playing/{station_id}/history endpoint"""
+    
+    def test_history_response_structure(self):
+        """History should return a page of entries, newest first"""
+        station_id = SAMPLE_STATION_IDS[0]
+        # Make sure the station has been resolved at least once
+        requests.get(f"{BASE_URL}/api/now-playing/{station_id}")
+        
+        response = requests.get(f"{BASE_URL}/api/now-playing/{station_id}/history", params={"limit": 5})
+        
+        assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+        data = response.json()
+        
+        assert data["success"] is True
+        assert data["count"] == len(data["items"])
+        assert data["count"] <= 5, "Page should respect the limit"
+        
+        played_at = [item["played_at"] for item in data["items"]]
+        assert played_at == sorted(played_at, reverse=True), "Items should be newest first"
+        for item in data["items"]:
+            assert item["station_id"] == station_id
+        print(f"✓ History returned {data['count']} items, next_cursor={data['next_cursor']}")
+    
+    def test_history_cursor_pagination(self):
+        """Following next_cursor should not repeat entries"""
+        station_id = SAMPLE_STATION_IDS[0]
+        url = f"{BASE_URL}/api/now-playing/{station_id}/history"
+        first = requests.get(url, params={"limit": 1}).json()
+        
+        if not first["next_cursor"]:
+            pytest.skip("Not enough history for pagination")
+        
+        second = requests.get(url, params={"limit": 1, "cursor": first["next_cursor"]}).json()
+        assert second["count"] == 1
+        assert second["items"][0]["played_at"] <= first["items"][0]["played_at"]
+        print(f"✓ Second page: {second['items'][0]['title']}")
+    
+    def test_history_invalid_cursor(self):
+        """Malformed cursors should be rejected with 400"""
+        station_id = SAMPLE_STATION_IDS[0]
+        response = requests.get(
+            f"{BASE_URL}/api/now-playing/{station_id}/history",
+            params={"cursor": "not-a-cursor"}
+        )
+        
+        assert response.status_code == 400, f"Expected 400, got {response.status_code}"
+
 
 class TestStatusEndpoint:
     """Test the status endpoints"""
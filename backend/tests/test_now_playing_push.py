@@ -0,0 +1,71 @@
+"""
+Backend API Tests for MegaRadio push-based Now Playing updates
+Tests the SSE (/api/now-playing/{station_id}/events) and WebSocket
+(/api/now-playing/{station_id}/ws) subscription endpoints
+"""
+import pytest
+import requests
+import os
+import json
+
+# Backend URL from environment - DO NOT add default
+BASE_URL = os.environ.get('EXPO_PUBLIC_BACKEND_URL', 'https://audio-stream-verify.preview.emergentagent.com').rstrip('/')
+
+SAMPLE_STATION_ID = "68a8c47dbd66579311ab228c"  # Station with ICY metadata
+
+
+def read_first_sse_event(response):
+    """Read SSE lines until the first data event and return its payload"""
+    event_name = None
+    for line in response.iter_lines(decode_unicode=True):
+        if line.startswith("event:"):
+            event_name = line.split(":", 1)[1].strip()
+        elif line.startswith("data:"):
+            return event_name, json.loads(line.split(":", 1)[1])
+    return event_name, None
+
+
+class TestNowPlayingSSE:
+    """Test the Server-Sent Events subscription endpoint"""
+    
+    def test_sse_sends_current_title_on_connect(self):
+        """SSE stream should immediately send the current now playing payload"""
+        with requests.get(
+            f"{BASE_URL}/api/now-playing/{SAMPLE_STATION_ID}/events",
+            stream=True,
+            timeout=15
+        ) as response:
+            assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+            assert response.headers["content-type"].startswith("text/event-stream")
+            
+            event_name, data = read_first_sse_event(response)
+        
+        assert event_name == "now-playing", f"Unexpected event name: {event_name}"
+        assert data is not None, "No data event received"
+        assert data["station_id"] == SAMPLE_STATION_ID
+        for field in ["title", "artist", "song", "album", "artwork", "timestamp"]:
+            assert field in data, f"Missing NowPlayingResponse field: {field}"
+        print(f"✓ SSE initial event: {data['title']}")
+
+
+class TestNowPlayingWebSocket:
+    """Test the WebSocket subscription endpoint"""
+    
+    def test_websocket_sends_current_title_on_connect(self):
+        """WebSocket should send the current now playing payload after connect"""
+        websockets_client = pytest.importorskip("websockets.sync.client")
+        ws_url = BASE_URL.replace("https://", "wss://").replace("http://", "ws://")
+        
+        with websockets_client.connect(
+            f"{ws_url}/api/now-playing/{SAMPLE_STATION_ID}/ws",
+            open_timeout=10
+        ) as websocket:
+            data = json.loads(websocket.recv(timeout=15))
+        
+        assert data["station_id"] == SAMPLE_STATION_ID
+        assert data.get("title"), "Title should not be empty"
+        print(f"✓ WebSocket initial message: {data['title']}")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
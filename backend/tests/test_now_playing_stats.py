@@ -0,0 +1,120 @@
+"""
+Backend API Tests for MegaRadio runtime stats
+Tests the /api/stats endpoint exposing now-playing subsystem counters
+"""
+import pytest
+import requests
+import os
+
+# Backend URL from environment - DO NOT add default
+BASE_URL = os.environ.get('EXPO_PUBLIC_BACKEND_URL', 'https://audio-stream-verify.preview.emergentagent.com').rstrip('/')
+
+SAMPLE_STATION_ID = "68a8c47dbd66579311ab228c"  # Station with ICY metadata
+
+
+class TestStatsEndpoint:
+    """Test the /api/stats endpoint"""
+    
+    def test_stats_returns_200(self):
+        """Stats endpoint should return 200 with a JSON object"""
+        response = requests.get(f"{BASE_URL}/api/stats")
+        
+        assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+        assert isinstance(response.json(), dict), "Stats should be a JSON object"
+        assert response.json()["shared_cache"]["backend"] in ["memory", "mongo"], "Unexpected cache backend"
+        print(f"✓ Stats sections: {list(response.json().keys())}")
+    
+    def test_http_pools_are_open(self):
+        """Shared HTTP client pools should be open while the app is running"""
+        data = requests.get(f"{BASE_URL}/api/stats").json()
+        
+        pools = data.get("http_pools")
+        assert pools is not None, "Missing http_pools section"
+        assert pools["open"] is True, "HTTP client pools should be open"
+        for pool_name in ["catalog", "streams"]:
+            assert pool_name in pools, f"Missing pool: {pool_name}"
+            assert "connections" in pools[pool_name], f"{pool_name} pool should report connections"
+            assert "requests" in pools[pool_name], f"{pool_name} pool should report requests"
+        
+        print(f"✓ Catalog pool: {pools['catalog']}")
+        print(f"✓ Streams pool: {pools['streams']}")
+    
+    def test_now_playing_starts_icy_monitor(self):
+        """Requesting now playing should leave a monitor running for the station"""
+        response = requests.get(f"{BASE_URL}/api/now-playing/{SAMPLE_STATION_ID}")
+        assert response.status_code == 200
+        
+        data = requests.get(f"{BASE_URL}/api/stats").json()
+        monitors = data.get("icy_monitors")
+        assert monitors is not None, "Missing icy_monitors section"
+        
+        station_ids = [m["station_id"] for m in monitors["stations"]]
+        assert SAMPLE_STATION_ID in station_ids, "Expected a monitor for the requested station"
+        print(f"✓ Active ICY monitors: {monitors['active']}")
+
+    def test_repeat_lookup_hits_station_cache(self):
+        """A repeated now-playing request should be served from the station cache"""
+        requests.get(f"{BASE_URL}/api/now-playing/{SAMPLE_STATION_ID}")
+        before = requests.get(f"{BASE_URL}/api/stats").json()
+        
+        response = requests.get(f"{BASE_URL}/api/now-playing/{SAMPLE_STATION_ID}")
+        assert response.status_code == 200
+        after = requests.get(f"{BASE_URL}/api/stats").json()
+        
+        # A pre-warmed station is answered before the station cache is consulted
+        cache_before, cache_after = before["station_cache"], after["station_cache"]
+        cached_hits = (cache_after["hits"] + cache_after["stale_hits"]) - (cache_before["hits"] + cache_before["stale_hits"])
+        warm_hits = after["now_playing_prewarm"]["hits"] - before["now_playing_prewarm"]["hits"]
+        assert cached_hits + warm_hits >= 1, "Repeat lookup should be a cache hit"
+        assert cache_after["misses"] == cache_before["misses"], "Repeat lookup should not miss the cache"
+        print(f"✓ Station cache: {cache_after}")
+
+    def test_artwork_enrichment_reports_provider(self):
+        """Artwork enrichment should report its provider and cache counters"""
+        requests.get(f"{BASE_URL}/api/now-playing/{SAMPLE_STATION_ID}")
+        data = requests.get(f"{BASE_URL}/api/stats").json()
+        
+        enrichment = data.get("artwork_enrichment")
+        assert enrichment is not None, "Missing artwork_enrichment section"
+        assert enrichment["provider"], "Provider name should be reported"
+        assert enrichment["budget"] <= 1, "Enrichment budget should stay small"
+        print(f"✓ Artwork enrichment: {enrichment}")
+
+    def test_resolved_candidates_get_health_scores(self):
+        """Resolving a station should leave its probed candidates scored by stream health"""
+        response = requests.post(
+            f"{BASE_URL}/api/stream/resolve",
+            json={"station_id": SAMPLE_STATION_ID},
+            timeout=15
+        )
+        assert response.status_code == 200
+        measured = [d for d in response.json()["details"] if d["measured"]]
+        assert measured, "At least one candidate should have a health measurement"
+        for candidate in measured:
+            assert 0 <= candidate["score"] <= 1, f"Score out of range: {candidate}"
+        
+        health = requests.get(f"{BASE_URL}/api/stats").json()["stream_health"]
+        assert health["urls"] >= len(measured), "Measured candidates should be tracked"
+        assert health["dead"] <= health["urls"], "Dead URLs must be a subset of tracked URLs"
+        print(f"✓ Measured candidates: {measured}")
+
+
+    def test_warmed_station_is_served_from_memory(self):
+        """A pre-warmed station's request should be a warm hit, not a lookup"""
+        requests.get(f"{BASE_URL}/api/now-playing/{SAMPLE_STATION_ID}")
+        before = requests.get(f"{BASE_URL}/api/stats").json()
+        if SAMPLE_STATION_ID not in before["now_playing_prewarm"]["stations"]:
+            pytest.skip("Sample station is not warmed yet (ranked every PREWARM_RANK_INTERVAL)")
+        
+        response = requests.get(f"{BASE_URL}/api/now-playing/{SAMPLE_STATION_ID}")
+        assert response.status_code == 200
+        after = requests.get(f"{BASE_URL}/api/stats").json()
+        
+        assert after["now_playing_prewarm"]["hits"] + after["now_playing_prewarm"]["stale_hits"] > \
+            before["now_playing_prewarm"]["hits"] + before["now_playing_prewarm"]["stale_hits"], "Expected a warm hit"
+        assert after["station_cache"]["misses"] == before["station_cache"]["misses"], "Warm hit should not miss"
+        print(f"✓ Pre-warming: {after['now_playing_prewarm']['hits']} hits")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
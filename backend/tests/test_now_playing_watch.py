@@ -0,0 +1,59 @@
+"""
+In-process tests for now playing push watchers
+Covers NowPlayingBroadcaster wakeups without a running backend
+"""
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'megaradio_test')
+
+import server  # noqa: E402
+from server import NowPlayingBroadcaster, NowPlayingResponse  # noqa: E402
+
+STATION_ID = "hls-station"
+
+
+class TestNowPlayingWatch:
+    """Test NowPlayingBroadcaster._watch"""
+
+    def test_title_change_without_local_monitor_is_pushed(self, monkeypatch):
+        """A station with no local ICY monitor should not wait out the monitor interval"""
+        broadcaster = NowPlayingBroadcaster()
+        titles = iter(["Artist - First", "Artist - Second"])
+        lookups = []
+
+        async def lookup_now_playing(station_id):
+            # Stands in for an HLS read or a result another worker published
+            title = next(titles, "Artist - Second")
+            lookups.append(title)
+            now_playing = NowPlayingResponse(station_id=station_id, title=title)
+            broadcaster.publish(station_id, now_playing)
+            return now_playing
+
+        monkeypatch.setattr(server, 'lookup_now_playing', lookup_now_playing)
+        monkeypatch.setattr(server, 'NOW_PLAYING_WATCH_INTERVAL', 60)
+        monkeypatch.setattr(server, 'NOW_PLAYING_POLL_INTERVAL', 0.05)
+        assert server.icy_monitors.get(STATION_ID) is None
+
+        async def scenario():
+            received = []
+            async with broadcaster.subscribe(STATION_ID) as subscriber:
+                while len(received) < 2:
+                    now_playing = await asyncio.wait_for(subscriber.get(), 2)
+                    received.append(now_playing.title)
+            await broadcaster.stop()
+            return received
+
+        received = asyncio.run(scenario())
+
+        assert received == ["Artist - First", "Artist - Second"]
+        print(f"✓ Watcher lookups: {lookups}")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -0,0 +1,124 @@
+"""
+In-process tests for playlist detection and parsing
+Covers detect_playlist_type and parse_playlist without fetching anything
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'megaradio_test')
+
+from server import detect_playlist_type, parse_playlist  # noqa: E402
+
+BASE_URL = "http://radio.example.com/listen/station.pls"
+
+PLS_BODY = """[playlist]
+NumberOfEntries=2
+File1=http://stream1.example.com:8000/live
+Title1=Main
+File2=http://stream2.example.com:8000/live
+Version=2
+"""
+
+M3U_BODY = """#EXTM3U
+#EXTINF:-1,Example Radio
+http://stream.example.com/live.mp3
+"""
+
+HLS_BODY = """#EXTM3U
+#EXT-X-VERSION:3
+#EXT-X-TARGETDURATION:6
+#EXTINF:6.0,
+segment1.ts
+"""
+
+ASX_BODY = """<ASX version="3.0">
+  <Entry><REF HREF="http://stream.example.com/live.wma" /></Entry>
+  <Entry><Ref href = "mms://backup.example.com/live" /></Entry>
+</ASX>
+"""
+
+
+class TestDetectPlaylistType:
+    """Test detect_playlist_type classification"""
+
+    @pytest.mark.parametrize("body,kind", [
+        (PLS_BODY, 'pls'),
+        (M3U_BODY, 'm3u'),
+        (HLS_BODY, 'hls'),
+        (ASX_BODY, 'asx'),
+        ("\n  " + PLS_BODY.upper(), 'pls'),
+    ])
+    def test_body_is_sniffed(self, body, kind):
+        """The body should classify the playlist regardless of headers"""
+        assert detect_playlist_type("http://example.com/stream", 'audio/mpeg', body.encode()) == kind
+
+    @pytest.mark.parametrize("content_type,kind", [
+        ('audio/x-scpls', 'pls'),
+        ('audio/x-mpegurl; charset=utf-8', 'm3u'),
+        ('application/vnd.apple.mpegurl', 'hls'),
+        ('video/x-ms-asf', 'asx'),
+        ('AUDIO/MPEGURL', 'm3u'),
+    ])
+    def test_content_type_is_used(self, content_type, kind):
+        """Known playlist content types should classify an unsniffable body"""
+        assert detect_playlist_type("http://example.com/stream", content_type) == kind
+
+    @pytest.mark.parametrize("url,kind", [
+        ("http://example.com/station.pls", 'pls'),
+        ("http://example.com/station.M3U", 'm3u'),
+        ("http://example.com/live/index.m3u8?token=1", 'hls'),
+        ("http://example.com/station.asx", 'asx'),
+        ("http://example.com/live", None),
+    ])
+    def test_extension_is_used_for_untyped_responses(self, url, kind):
+        """The URL extension should only decide for untyped or text responses"""
+        assert detect_playlist_type(url, '') == kind
+        assert detect_playlist_type(url, 'text/plain') == kind
+
+    def test_audio_content_type_beats_extension(self):
+        """A stream served as audio is direct even if its URL looks like a playlist"""
+        assert detect_playlist_type("http://example.com/station.pls", 'audio/mpeg') is None
+
+
+class TestParsePlaylist:
+    """Test parse_playlist entry extraction"""
+
+    def test_pls_entries(self):
+        assert parse_playlist('pls', PLS_BODY, BASE_URL) == [
+            "http://stream1.example.com:8000/live",
+            "http://stream2.example.com:8000/live",
+        ]
+
+    def test_m3u_skips_comments_and_resolves_relative_urls(self):
+        body = M3U_BODY + "\n../backup/live.aac\n"
+        assert parse_playlist('m3u', body, BASE_URL) == [
+            "http://stream.example.com/live.mp3",
+            "http://radio.example.com/backup/live.aac",
+        ]
+
+    def test_asx_refs_are_case_insensitive(self):
+        assert parse_playlist('asx', ASX_BODY, BASE_URL) == [
+            "http://stream.example.com/live.wma",
+            "mms://backup.example.com/live",
+        ]
+
+    def test_mislabelled_pls_falls_back_to_lines(self):
+        """A .pls that is really a URL list should still yield its streams"""
+        assert parse_playlist('pls', "http://stream.example.com/live\n", BASE_URL) == [
+            "http://stream.example.com/live",
+        ]
+
+    def test_duplicates_are_dropped_in_order(self):
+        body = "http://a.example.com/live\nhttp://b.example.com/live\nhttp://a.example.com/live\n"
+        assert parse_playlist('m3u', body, BASE_URL) == [
+            "http://a.example.com/live",
+            "http://b.example.com/live",
+        ]
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
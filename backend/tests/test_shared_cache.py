@@ -0,0 +1,161 @@
+"""
+In-process tests for the shared cache
+Covers SharedCache lease handling against local backends
+"""
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'megaradio_test')
+
+import server  # noqa: E402
+from server import CacheBackend, MemoryCacheBackend, SharedCache  # noqa: E402
+
+
+class CountingSharedBackend(MemoryCacheBackend):
+    """Memory backend that claims to be shared and counts its writes"""
+
+    name = 'counting'
+    shared = True
+
+    def __init__(self):
+        super().__init__(max_entries=100)
+        self.lease_calls = 0
+        self.sets = 0
+
+    async def set(self, key, value, ttl):
+        self.sets += 1
+        await super().set(key, value, ttl)
+
+    async def acquire_lease(self, key, ttl):
+        self.lease_calls += 1
+        return self.lease_granted
+
+    lease_granted = True
+
+
+async def load_title(key):
+    return {'station_id': key, 'title': 'Artist - Song'}
+
+
+class TestSharedCache:
+    """Test SharedCache.elected_load"""
+
+    def test_unshared_backend_is_not_written(self):
+        """With a single-process backend, elected results should not be stored"""
+        backend = MemoryCacheBackend(max_entries=100)
+        cache = SharedCache(backend, max_entries=100)
+
+        value = asyncio.run(cache.elected_load('now_playing', 'station-1', load_title, stale_ttl=60))
+
+        assert value['title'] == 'Artist - Song'
+        assert backend.stats()['entries'] == 0, "Nothing reads now-playing entries from a memory backend"
+
+    def test_lease_is_renewed_only_near_expiry(self):
+        """Repeat lookups by the lease holder should not renew the lease each time"""
+        backend = CountingSharedBackend()
+        cache = SharedCache(backend, max_entries=100)
+
+        async def scenario():
+            for _ in range(5):
+                await cache.elected_load('now_playing', 'station-1', load_title, stale_ttl=60)
+
+        asyncio.run(scenario())
+
+        assert backend.lease_calls == 1, f"Expected one lease round trip, got {backend.lease_calls}"
+        assert backend.sets == 5, "Each result should still be published"
+        assert cache.leases_won == 5
+        print(f"✓ Shared cache: {cache.stats()}")
+
+    def test_lease_loser_waits_for_published_value(self, monkeypatch):
+        """A worker without the lease should serve the holder's result, not load its own"""
+        monkeypatch.setattr(server, 'SHARED_CACHE_POLL_INTERVAL', 0.01)
+        backend = CountingSharedBackend()
+        backend.lease_granted = False
+        cache = SharedCache(backend, max_entries=100)
+        loads = []
+
+        async def load_locally(key):
+            loads.append(key)
+            return {'station_id': key, 'title': 'Loser - Title'}
+
+        async def scenario():
+            async def holder_publishes():
+                await asyncio.sleep(0.05)
+                await backend.set('now_playing:station-1', {'title': 'Artist - Song'}, 60)
+
+            publisher = asyncio.create_task(holder_publishes())
+            value = await cache.elected_load('now_playing', 'station-1', load_locally, stale_ttl=60)
+            await publisher
+            return value
+
+        value = asyncio.run(scenario())
+
+        assert value == {'title': 'Artist - Song'}
+        assert loads == [], "The loader should only run on the lease holder"
+        assert cache.remote_results == 1
+
+    def test_lease_loser_falls_back_without_publishing(self, monkeypatch):
+        """With nothing published in time, the fallback answers and is not stored"""
+        monkeypatch.setattr(server, 'SHARED_CACHE_WAIT', 0.05)
+        monkeypatch.setattr(server, 'SHARED_CACHE_POLL_INTERVAL', 0.01)
+        backend = CountingSharedBackend()
+        backend.lease_granted = False
+        cache = SharedCache(backend, max_entries=100)
+
+        async def genre_only(key):
+            return {'station_id': key, 'title': 'Jazz'}
+
+        value = asyncio.run(cache.elected_load('now_playing', 'station-1', load_title, stale_ttl=60, fallback=genre_only))
+
+        assert value['title'] == 'Jazz'
+        assert backend.sets == 0, "A fallback must not overwrite the holder's value"
+        assert cache.fallbacks == 1
+
+    def test_published_value_is_decoded_once(self):
+        """Lookups served from one publication should share one decoded value"""
+        backend = CountingSharedBackend()
+        backend.lease_granted = False
+        cache = SharedCache(backend, max_entries=100)
+        decoded = []
+
+        def decode(data):
+            decoded.append(data)
+            return dict(data)
+
+        async def scenario():
+            await backend.set('now_playing:station-1', {'title': 'Artist - Song'}, 60)
+            first = await cache.elected_load('now_playing', 'station-1', load_title, stale_ttl=60, decode=decode)
+            second = await cache.elected_load('now_playing', 'station-1', load_title, stale_ttl=60, decode=decode)
+            return first, second
+
+        first, second = asyncio.run(scenario())
+
+        assert first is second
+        assert len(decoded) == 1
+
+    def test_unshared_backend_does_not_cache_station_documents(self):
+        """The station cache already holds documents; a memory backend should not duplicate them"""
+        backend = MemoryCacheBackend(max_entries=100)
+        cache = SharedCache(backend, max_entries=100)
+
+        asyncio.run(cache.cached_load('station', 'station-1', load_title, ttl=600))
+
+        assert backend.stats()['entries'] == 0
+
+    def test_backend_interface_is_abstract(self):
+        """A backend missing part of the interface should not be instantiable"""
+        class IncompleteBackend(CacheBackend):
+            async def get(self, key):
+                return None
+
+        with pytest.raises(TypeError):
+            IncompleteBackend()
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -0,0 +1,83 @@
+"""
+In-process tests for request coalescing
+Covers SingleFlight sharing and cancellation shielding without a running backend
+"""
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'megaradio_test')
+
+from server import SingleFlight  # noqa: E402
+
+
+class TestSingleFlight:
+    """Test SingleFlight.run"""
+
+    def test_concurrent_calls_share_one_execution(self):
+        """Concurrent callers with the same key should get one shared result"""
+        flights = SingleFlight()
+        calls = []
+
+        async def lookup(station_id):
+            calls.append(station_id)
+            await asyncio.sleep(0.05)
+            return f"title for {station_id}"
+
+        async def scenario():
+            return await asyncio.gather(*(flights.run("station-1", lookup, "station-1") for _ in range(5)))
+
+        results = asyncio.run(scenario())
+
+        assert results == ["title for station-1"] * 5
+        assert calls == ["station-1"], f"Expected one execution, got {calls}"
+        assert flights.stats() == {'executed': 1, 'coalesced': 4, 'inflight': 0}
+
+    def test_exception_is_shared_and_not_cached(self):
+        """Every waiter should see the failure, and the next call should run again"""
+        flights = SingleFlight()
+        calls = []
+
+        async def failing():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            raise ConnectionError("catalog down")
+
+        async def scenario():
+            results = await asyncio.gather(
+                flights.run("key", failing), flights.run("key", failing), return_exceptions=True,
+            )
+            with pytest.raises(ConnectionError):
+                await flights.run("key", failing)
+            return results
+
+        results = asyncio.run(scenario())
+
+        assert all(isinstance(r, ConnectionError) for r in results)
+        assert len(calls) == 2, "A failed flight should not be reused"
+
+    def test_cancelled_caller_does_not_cancel_shared_call(self):
+        """A caller going away should leave the operation running for the others"""
+        flights = SingleFlight()
+
+        async def lookup():
+            await asyncio.sleep(0.05)
+            return "done"
+
+        async def scenario():
+            leaving = asyncio.create_task(flights.run("key", lookup))
+            staying = asyncio.create_task(flights.run("key", lookup))
+            await asyncio.sleep(0.01)
+            leaving.cancel()
+            return await staying
+
+        assert asyncio.run(scenario()) == "done"
+        assert flights.executed == 1
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -0,0 +1,74 @@
+"""
+In-process tests for the stream health prober
+Covers availability scoring without a running backend
+"""
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'megaradio_test')
+
+from server import STREAM_HEALTH_DEAD_FAILURES, StreamHealthProber  # noqa: E402
+
+STREAM_URL = "http://stream.example.com:8000/live"
+
+
+def probe_result(ttfb_ms=None, error=None):
+    return {'status': 200 if error is None else None, 'content_type': 'audio/mpeg', 'bitrate': 128,
+            'icy': True, 'ttfb_ms': ttfb_ms, 'error': error}
+
+
+class TestStreamHealthScores:
+    """Test StreamHealthProber record keeping"""
+
+    def test_probe_records_score_and_checked_at(self):
+        """A probed URL should get a score, checked_at and its station"""
+        prober = StreamHealthProber(interval=300, concurrency=2, on_demand_concurrency=2, max_urls=10)
+
+        record = prober._record(STREAM_URL, "station-1", True, probe_result(ttfb_ms=120))
+
+        assert record['score'] == 1.0
+        assert record['checked_at'] is not None
+        assert record['station_ids'] == ["station-1"]
+        assert prober.is_fresh(STREAM_URL), "A new record should be fresh"
+        print(f"✓ Record: {record}")
+
+    def test_repeated_failures_lower_score_and_mark_dead(self):
+        """Consecutive failures should decay the score and mark the URL dead"""
+        prober = StreamHealthProber(interval=300, concurrency=2, on_demand_concurrency=2, max_urls=10)
+        prober._record(STREAM_URL, None, True, probe_result(ttfb_ms=100))
+
+        for _ in range(STREAM_HEALTH_DEAD_FAILURES):
+            record = prober._record(STREAM_URL, None, False, probe_result(error="timeout"))
+
+        assert 0 < record['score'] < 1, f"Score should decay gradually, got {record['score']}"
+        assert prober.is_dead(STREAM_URL), "URL should be considered dead"
+        assert prober.pick([STREAM_URL, "http://backup.example.com/live"]) != STREAM_URL
+        print(f"✓ Record: {record}")
+
+
+class TestProbeSlots:
+    """Test that on-demand probes don't queue behind background rounds"""
+
+    def test_on_demand_probe_skips_busy_round_slots(self):
+        """With every round slot taken, an on-demand probe should still run"""
+        prober = StreamHealthProber(interval=300, concurrency=1, on_demand_concurrency=1, max_urls=10)
+
+        async def scenario():
+            await prober._slots.acquire()
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(prober.probe(STREAM_URL), 0.2)
+            return await asyncio.wait_for(prober.probe(STREAM_URL, on_demand=True), 2)
+
+        record = asyncio.run(scenario())
+
+        assert record['checks'] == 1, "Only the on-demand probe should have completed"
+        print(f"✓ Record: {record}")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -0,0 +1,134 @@
+"""
+Backend API Tests for MegaRadio stream relay and resolution
+Tests the /api/stream/{encoded_url} relay used for cleartext HTTP streams on Android
+and the /api/stream/resolve candidate ranking endpoint
+"""
+import pytest
+import requests
+import os
+from urllib.parse import quote
+
+# Backend URL from environment - DO NOT add default
+BASE_URL = os.environ.get('EXPO_PUBLIC_BACKEND_URL', 'https://audio-stream-verify.preview.emergentagent.com').rstrip('/')
+
+# Cleartext HTTP stream with ICY metadata
+HTTP_STREAM_URL = "http://yayin.arabeskfm.biz:8042/"
+
+SAMPLE_STATION_ID = "68a8c47dbd66579311ab228c"
+
+
+class TestStreamRelay:
+    """Test the /api/stream/{encoded_url} relay endpoint"""
+
+    def test_relay_head_returns_audio_headers(self):
+        """HEAD should return 200 with the upstream content type"""
+        encoded_url = quote(HTTP_STREAM_URL, safe='')
+        response = requests.head(f"{BASE_URL}/api/stream/{encoded_url}", timeout=15)
+
+        assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+        assert response.headers.get("content-type", "").startswith("audio/"), "Expected an audio content type"
+        print(f"✓ Relay headers: {dict(response.headers)}")
+
+    def test_relay_streams_audio_without_metadata(self):
+        """Without Icy-MetaData the relay should stream plain audio"""
+        encoded_url = quote(HTTP_STREAM_URL, safe='')
+        with requests.get(f"{BASE_URL}/api/stream/{encoded_url}", stream=True, timeout=15) as response:
+            assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+            assert "icy-metaint" not in response.headers, "Metadata should be stripped by default"
+
+            chunk = next(response.iter_content(chunk_size=16384))
+            assert len(chunk) > 0, "Relay should deliver audio bytes"
+            print(f"✓ Received {len(chunk)} audio bytes")
+
+    def test_relay_reinjects_metadata_on_request(self):
+        """With Icy-MetaData: 1 the relay should advertise its metadata interval"""
+        encoded_url = quote(HTTP_STREAM_URL, safe='')
+        with requests.get(
+            f"{BASE_URL}/api/stream/{encoded_url}",
+            headers={"Icy-MetaData": "1"},
+            stream=True,
+            timeout=15
+        ) as response:
+            assert response.status_code == 200
+            assert response.headers.get("icy-metaint", "").isdigit(), "Expected an icy-metaint header"
+            print(f"✓ icy-metaint: {response.headers['icy-metaint']}")
+
+    def test_relay_rejects_non_http_url(self):
+        """Non-http(s) URLs should be rejected with 400"""
+        encoded_url = quote("ftp://example.com/stream", safe='')
+        response = requests.get(f"{BASE_URL}/api/stream/{encoded_url}", timeout=15)
+
+        assert response.status_code == 400, f"Expected 400, got {response.status_code}"
+
+    def test_relay_rejects_internal_addresses(self):
+        """Loopback, private and metadata addresses should be rejected with 403"""
+        for internal_url in ["http://127.0.0.1:8001/api/stats", "http://169.254.169.254/latest/meta-data/", "http://10.0.0.1/"]:
+            encoded_url = quote(internal_url, safe='')
+            response = requests.get(f"{BASE_URL}/api/stream/{encoded_url}", timeout=15)
+
+            assert response.status_code == 403, f"Expected 403 for {internal_url}, got {response.status_code}"
+        print("✓ Internal addresses rejected")
+
+
+class TestStreamResolve:
+    """Test the POST /api/stream/resolve endpoint"""
+
+    def test_resolve_station_returns_ranked_candidates(self):
+        """Resolving a station should return candidates and a playlistType"""
+        response = requests.post(
+            f"{BASE_URL}/api/stream/resolve",
+            json={"station_id": SAMPLE_STATION_ID},
+            timeout=15
+        )
+
+        assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+        data = response.json()
+
+        assert len(data["candidates"]) > 0, "Expected at least one candidate"
+        assert data["playlistType"] in ["direct", "pls", "m3u", "hls", "asx"]
+        assert data["candidates"] == [d["url"] for d in data["details"]], "details should follow candidate order"
+        print(f"✓ Candidates: {data['candidates']}")
+
+    def test_resolve_direct_url(self):
+        """Resolving a direct stream URL should report playlistType 'direct'"""
+        response = requests.post(
+            f"{BASE_URL}/api/stream/resolve",
+            json={"url": HTTP_STREAM_URL},
+            timeout=15
+        )
+
+        assert response.status_code == 200
+        data = response.json()
+        assert data["playlistType"] == "direct", f"Expected 'direct', got {data['playlistType']}"
+        assert data["details"][-1]["source"] == "proxy", "Cleartext streams should end with the relay URL"
+
+    def test_repeat_resolve_is_cached(self):
+        """A repeated resolve should be served from the resolution cache"""
+        payload = {"station_id": SAMPLE_STATION_ID}
+        requests.post(f"{BASE_URL}/api/stream/resolve", json=payload, timeout=15)
+        before = requests.get(f"{BASE_URL}/api/stats").json()["stream_resolver"]
+
+        requests.post(f"{BASE_URL}/api/stream/resolve", json=payload, timeout=15)
+        after = requests.get(f"{BASE_URL}/api/stats").json()["stream_resolver"]
+
+        assert after["hits"] >= before["hits"] + 1, "Repeat resolve should hit the cache"
+
+    def test_resolve_rejects_internal_url(self):
+        """Resolving an internal address should be rejected with 403"""
+        response = requests.post(
+            f"{BASE_URL}/api/stream/resolve",
+            json={"url": "http://169.254.169.254/latest/meta-data/"},
+            timeout=15
+        )
+
+        assert response.status_code == 403, f"Expected 403, got {response.status_code}"
+
+    def test_resolve_requires_station_or_url(self):
+        """An empty request should be rejected with 400"""
+        response = requests.post(f"{BASE_URL}/api/stream/resolve", json={}, timeout=15)
+
+        assert response.status_code == 400, f"Expected 400, got {response.status_code}"
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
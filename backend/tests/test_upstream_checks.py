@@ -0,0 +1,146 @@
+"""
+In-process tests for upstream address checks and relay content types
+Covers the SSRF guards on stream URLs without a running backend
+"""
+import asyncio
+import os
+import socket
+import sys
+
+import httpx
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'megaradio_test')
+
+from server import UnsafeUpstreamError, UpstreamAddressPolicy, checked_transport, relay_media_type  # noqa: E402
+
+PUBLIC_ADDRESS = "93.184.216.34"
+
+
+class TestUpstreamAddressPolicy:
+    """Test UpstreamAddressPolicy.check"""
+
+    @pytest.mark.parametrize("url", [
+        "http://127.0.0.1:8001/api/stats",
+        "http://localhost/",
+        "http://169.254.169.254/latest/meta-data/",
+        "http://10.1.2.3:8000/stream",
+        "http://192.168.1.1/",
+        "http://[::1]/",
+        "http://[::ffff:127.0.0.1]/",
+        "http://0.0.0.0/",
+        "ftp://93.184.216.34/stream",
+    ])
+    def test_rejects_non_public_upstreams(self, url):
+        """Loopback, private, link-local and non-http URLs should be rejected"""
+        policy = UpstreamAddressPolicy(ttl=300, max_entries=100, allow_private=False)
+
+        with pytest.raises(UnsafeUpstreamError):
+            asyncio.run(policy.check(url))
+        assert policy.rejected == 1
+
+    def test_allows_public_address(self):
+        """A public address should pass and its verdict should be cached"""
+        policy = UpstreamAddressPolicy(ttl=300, max_entries=100, allow_private=False)
+
+        async def scenario():
+            await policy.check("http://93.184.216.34:8000/stream")
+            await policy.check("http://93.184.216.34:8000/other")
+
+        asyncio.run(scenario())
+        assert policy.lookups == 1, "Second check should use the cached verdict"
+
+
+async def serve_locally(received: list):
+    """A loopback HTTP server that records every request it reads"""
+    async def handle(reader, writer):
+        data = await reader.read(65536)
+        if data:
+            received.append(data)
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\nConnection: close\r\n\r\nok")
+            await writer.drain()
+        writer.close()
+
+    return await asyncio.start_server(handle, '127.0.0.1', 0)
+
+
+def rebinding_resolver(monkeypatch, local_port: int):
+    """Resolve to a public address for the check, then to loopback"""
+    lookups = []
+
+    async def getaddrinfo(host, port, *args, **kwargs):
+        lookups.append(host)
+        address = PUBLIC_ADDRESS if len(lookups) == 1 else '127.0.0.1'
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', (address, local_port))]
+
+    monkeypatch.setattr(asyncio.get_running_loop(), 'getaddrinfo', getaddrinfo)
+    return lookups
+
+
+class TestCheckedTransport:
+    """Test that connections are checked after they are made"""
+
+    def test_rebound_name_is_refused(self, monkeypatch):
+        """A name that resolves publicly for the check but locally on connect is rejected"""
+        policy = UpstreamAddressPolicy(ttl=300, max_entries=100, allow_private=False)
+        received = []
+
+        async def scenario():
+            server = await serve_locally(received)
+            port = server.sockets[0].getsockname()[1]
+            lookups = rebinding_resolver(monkeypatch, port)
+            async with httpx.AsyncClient(
+                transport=checked_transport(policy),
+                event_hooks={'request': [policy.check_request]},
+            ) as client:
+                with pytest.raises(UnsafeUpstreamError):
+                    await client.get(f"http://rebind.example.com:{port}/latest/meta-data/")
+            server.close()
+            await server.wait_closed()
+            return lookups
+
+        lookups = asyncio.run(scenario())
+
+        assert len(lookups) == 2, "The check and the connect should each resolve the name"
+        assert received == [], "No request should reach the private address"
+        assert policy.rejected == 1
+
+    def test_private_connections_allowed_when_configured(self, monkeypatch):
+        """UPSTREAM_ALLOW_PRIVATE should let connections through"""
+        policy = UpstreamAddressPolicy(ttl=300, max_entries=100, allow_private=True)
+        received = []
+
+        async def scenario():
+            server = await serve_locally(received)
+            port = server.sockets[0].getsockname()[1]
+            async with httpx.AsyncClient(transport=checked_transport(policy)) as client:
+                response = await client.get(f"http://127.0.0.1:{port}/stream")
+            server.close()
+            await server.wait_closed()
+            return response
+
+        assert asyncio.run(scenario()).text == "ok"
+        assert len(received) == 1
+
+
+class TestRelayMediaType:
+    """Test which upstream content types the relay serves"""
+
+    @pytest.mark.parametrize("headers,expected", [
+        ({"content-type": "audio/mpeg"}, "audio/mpeg"),
+        ({"content-type": "audio/aacp; charset=utf-8"}, "audio/aacp"),
+        ({"content-type": "application/ogg"}, "application/ogg"),
+        ({"icy-metaint": "16000"}, "audio/mpeg"),
+        ({"content-type": "text/html"}, None),
+        ({"content-type": "image/svg+xml"}, None),
+        ({}, None),
+    ])
+    def test_only_audio_is_relayed(self, headers, expected):
+        """Only audio, ogg and mpegurl responses should be relayed"""
+        assert relay_media_type(httpx.Headers(headers)) == expected
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])